@@ -57,6 +57,9 @@ setup(
             'bodhi.find_detections = solarprod.scripts:find_detections',
             'bodhi.ibis = solarprod.scripts:ibis_connection',
             'bodhi.streamlit = solarprod.scripts:streamlit',
+            'bodhi.benchmark = solarprod.scripts:benchmark',
+            'bodhi.replay = solarprod.scripts:replay',
+            'bodhi.maintain = solarprod.scripts:maintain',
         ]
     }
 )
@@ -0,0 +1,418 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from .constants import (
+    CLUSTERED_TABLE_NAMES,
+    DEFAULT_LOCAL_DB_FILENAME,
+    HOMEOWNER_TABLE_NAME,
+    LOCAL_DB_FILENAME,
+    MIN_DAILY_PRODUCTION,
+)
+
+from .duckdb_tools import (
+    BufferedTableWriter,
+    cluster_table,
+    get_duckdb_connection,
+    table_exists,
+    transaction,
+)
+
+from .metrics import measured
+
+# Metro areas (lat, lng, relative number of homes) the synthetic fleet is clustered around
+BENCHMARK_CITIES = np.array([
+    [33.45, -112.07, 8],   # Phoenix
+    [34.05, -118.24, 10],  # Los Angeles
+    [32.72, -117.16, 5],   # San Diego
+    [37.77, -122.42, 6],   # San Francisco
+    [39.74, -104.99, 6],   # Denver
+    [40.76, -111.89, 3],   # Salt Lake City
+    [36.17, -115.14, 4],   # Las Vegas
+    [29.76, -95.37, 5],    # Houston
+    [32.78, -96.80, 5],    # Dallas
+    [33.75, -84.39, 3],    # Atlanta
+    [40.71, -74.01, 4],    # New York
+    [42.36, -71.06, 3],    # Boston
+    [47.61, -122.33, 2],   # Seattle
+])
+
+# Table holding the drops injected into the synthetic production
+BENCHMARK_DROPS_TABLE_NAME = '_benchmark_drops'
+
+BENCHMARK_SIZES = [1_000, 10_000, 100_000]
+
+
+def make_homeowners(num_homes, seed=0):
+    """
+    Makes a homeowners frame with homes scattered ~20 miles around the benchmark cities
+    """
+    rng = np.random.default_rng(seed)
+    weights = BENCHMARK_CITIES[:, 2] / BENCHMARK_CITIES[:, 2].sum()
+    city = rng.choice(len(BENCHMARK_CITIES), num_homes, p=weights)
+    return pd.DataFrame({
+        'homeowner_id': np.arange(1, num_homes + 1),
+        'lat': BENCHMARK_CITIES[city, 0] + rng.normal(0, .25, num_homes),
+        'lng': BENCHMARK_CITIES[city, 1] + rng.normal(0, .3, num_homes),
+        'city': city,
+    })
+
+
+def make_production(homeowners, dates, seed=0, gap_rate=.02, outage_rate=.01, drop_rate=.02):
+    """
+    Makes daily production for a batch of homes.  Returns a tuple of (prod_history, drops).
+
+    Args:
+         homeowners: A frame from make_homeowners
+              dates: The days to make production for
+               seed: Seed for the random numbers
+           gap_rate: The fraction of days with no record at all
+        outage_rate: The fraction of homes with a multi-day outage (no records)
+          drop_rate: The fraction of homes whose production permanently drops partway through.
+                     These are what the detector should find.
+    """
+    rng = np.random.default_rng(seed)
+    num_homes, num_days = len(homeowners), len(dates)
+    lat = homeowners.lat.to_numpy()
+
+    # Bigger systems produce more, and production is seasonal with bigger swings up north
+    capacity = rng.uniform(20, 60, num_homes)
+    day_of_year = dates.dayofyear.to_numpy()
+    amplitude = .15 + .5 * (lat - 25) / 25
+    season = 1 + amplitude[:, None] * np.cos(2 * np.pi * (day_of_year[None, :] - 172) / 365.25)
+
+    # Cloudy days hit every home in a city at once (this is what neighbor muting is for)
+    city_weather = rng.beta(5, 1.5, (len(BENCHMARK_CITIES), num_days))
+    weather = city_weather[homeowners.city.to_numpy()] * rng.uniform(.9, 1.1, (num_homes, num_days))
+
+    production = capacity[:, None] * season * weather
+
+    # Injected drops: production falls to a fraction of normal from some day on
+    has_drop = rng.random(num_homes) < drop_rate
+    drop_day = rng.integers(num_days // 2, num_days, num_homes)
+    drop_factor = rng.uniform(.2, .5, num_homes)
+    is_dropped = has_drop[:, None] & (np.arange(num_days)[None, :] >= drop_day[:, None])
+    production = np.where(is_dropped, production * drop_factor[:, None], production)
+
+    # Random missing days and multi-day outages
+    is_missing = rng.random((num_homes, num_days)) < gap_rate
+    has_outage = rng.random(num_homes) < outage_rate
+    outage_start = rng.integers(0, num_days, num_homes)
+    outage_days = rng.integers(3, 30, num_homes)
+    day = np.arange(num_days)[None, :]
+    is_missing |= (
+        has_outage[:, None] & (day >= outage_start[:, None]) & (day < (outage_start + outage_days)[:, None])
+    )
+
+    # Low production days are never synced, so they don't exist in prod_history either
+    keep = ~is_missing & (production > MIN_DAILY_PRODUCTION)
+    rows, cols = np.nonzero(keep)
+    prod_history = pd.DataFrame({
+        'homeowner_id': homeowners.homeowner_id.to_numpy()[rows],
+        'date': dates[cols],
+        'total_production': production[rows, cols],
+    })
+    drops = pd.DataFrame({
+        'homeowner_id': homeowners.homeowner_id.to_numpy()[has_drop],
+        'date': dates[drop_day[has_drop]],
+        'drop_factor': drop_factor[has_drop],
+    })
+    return prod_history, drops
+
+
+def check_scratch_db(db_file):
+    """
+    Raises a ValueError unless db_file is a scratch database the benchmarks may wipe.  The
+    default local database (the detector's real data) is never a scratch database.
+    """
+    if os.path.realpath(db_file) == os.path.realpath(DEFAULT_LOCAL_DB_FILENAME):
+        raise ValueError(f'Refusing to overwrite the local database at {db_file}.  Use a scratch file.')
+
+
+def _check_pointed_at(db_file):
+    """
+    The detector stages always use the local database, so benchmarking them against a scratch
+    database needs the process pointed at it
+    """
+    check_scratch_db(db_file)
+    if os.path.realpath(db_file) != os.path.realpath(LOCAL_DB_FILENAME):
+        raise ValueError(f'Set SOLARPROD_LOCAL_DB={db_file} before benchmarking the stages against it')
+
+
+def populate_local_db(db_file, num_homes, num_days, seed=0, chunk_size=5000):
+    """
+    Replaces the homeowners and production history in a scratch database with a synthetic
+    fleet whose production runs through yesterday.  Every other table is dropped, so this
+    refuses to run against the default local database.
+
+    Args:
+            db_file: The scratch database file
+          num_homes: The number of homes in the fleet
+           num_days: The days of production history for every home
+               seed: Seed for the synthetic fleet
+         chunk_size: The number of homes to make production for at a time
+    """
+    check_scratch_db(db_file)
+
+    end_date = pd.Timestamp.now().floor('D') - pd.Timedelta(days=1)
+    dates = pd.date_range(end=end_date, periods=num_days)
+    homeowners = make_homeowners(num_homes, seed)
+
+    conn = duckdb.connect(db_file)
+    try:
+        with transaction(conn):
+            # Tables kept in the parquet store show up as views
+            rows = conn.execute('SELECT table_name, table_type FROM information_schema.tables').fetchall()
+            for table_name, table_type in rows:
+                conn.execute(f"DROP {'VIEW' if table_type == 'VIEW' else 'TABLE'} {table_name}")
+
+            writers = [
+                BufferedTableWriter(conn, HOMEOWNER_TABLE_NAME),
+                BufferedTableWriter(conn, 'prod_history'),
+                BufferedTableWriter(conn, BENCHMARK_DROPS_TABLE_NAME),
+            ]
+            writers[0].append(homeowners[['homeowner_id', 'lat', 'lng']])
+
+            # Production is made a chunk of homes at a time to bound memory
+            for num, start in enumerate(range(0, num_homes, chunk_size)):
+                chunk = homeowners.iloc[start: start + chunk_size]
+                prod_history, drops = make_production(chunk, dates, seed=seed + num + 1)
+                writers[1].append(prod_history)
+                writers[2].append(drops)
+
+            for writer in writers:
+                writer.flush()
+    finally:
+        conn.close()
+
+    return {'num_homes': num_homes, 'num_days': num_days, 'num_rows': writers[1].rows_written}
+
+
+def _count_rows(table_name):
+    conn = get_duckdb_connection()
+    try:
+        # A stage that found nothing to write never creates its table
+        if not table_exists(conn, table_name):
+            return 0
+        return conn.execute(f'SELECT count(*) FROM {table_name}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_stages(db_file, num_homes, num_days, seed=0, workers=1, engine='sql'):
+    """
+    Fills a scratch database with a synthetic fleet and times every detector stage against it.
+    The process must be pointed at the scratch database (through SOLARPROD_LOCAL_DB).  Memory
+    is sampled while each stage runs, so peak_rss_mb is the peak during that stage alone and
+    rss_growth_mb is how far it rose above where the stage started.  Returns a frame with one
+    row per stage.
+    """
+    # Imported here so the generator can be used without the detector's dependencies
+    from .data_plumbing import update_neighbors
+    from .detector_lib import Detector, NominalProd
+    from .ibis_tools import connection_session
+
+    _check_pointed_at(db_file)
+    rows = []
+
+    def record(measurement, rows_in, rows_out):
+        seconds = measurement.wall_seconds
+        rows.append({
+            'num_homes': num_homes,
+            'stage': measurement.stage,
+            'seconds': seconds,
+            'homes_per_second': num_homes / seconds if seconds else np.nan,
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'rows_per_second': rows_in / seconds if seconds else np.nan,
+            'peak_rss_mb': measurement.peak_rss_bytes / 2 ** 20,
+            'rss_growth_mb': (measurement.peak_rss_bytes - measurement.start_rss_bytes) / 2 ** 20,
+        })
+
+    with measured('populate') as measurement:
+        info = populate_local_db(db_file, num_homes, num_days, seed)
+    record(measurement, 0, info['num_rows'])
+
+    detector = Detector()
+    stages = [
+        ('update_neighbors', lambda: update_neighbors(incremental=False), HOMEOWNER_TABLE_NAME, 'neighbors'),
+        (
+            'update_nominal_prod',
+            lambda: NominalProd().update_nominal_prod(workers=workers),
+            'prod_history',
+            'nominal_prod',
+        ),
+        ('compute_raw_detections', detector.compute_raw_detections, 'nominal_prod', 'raw_detections'),
+        ('compute_detections', lambda: detector.compute_detections(engine=engine), 'raw_detections', 'detections'),
+    ]
+
+    with connection_session():
+        for stage, func, input_table, output_table in stages:
+            with measured(stage) as measurement:
+                func()
+            record(measurement, _count_rows(input_table), _count_rows(output_table))
+
+    return pd.DataFrame(rows)
+
+
+def time_lookups(num_lookups=100, seed=0):
+    """
+    Times per-home lookups (every row of one random home) against each table in
+    CLUSTERED_TABLE_NAMES.  Returns a frame with one row per table.
+    """
+    rng = np.random.default_rng(seed)
+    conn = get_duckdb_connection()
+    try:
+        homeowner_ids = conn.execute(f'SELECT homeowner_id FROM {HOMEOWNER_TABLE_NAME}').fetchnumpy()['homeowner_id']
+        homeowner_ids = rng.choice(homeowner_ids, num_lookups)
+
+        rows = []
+        for table_name in CLUSTERED_TABLE_NAMES:
+            if not table_exists(conn, table_name):
+                continue
+
+            seconds, num_rows = [], 0
+            for homeowner_id in homeowner_ids:
+                then = time.perf_counter()
+                df = conn.execute(f'SELECT * FROM {table_name} WHERE homeowner_id = ?', [int(homeowner_id)]).df()
+                seconds.append(time.perf_counter() - then)
+                num_rows += len(df)
+
+            rows.append({
+                'table': table_name,
+                'median_ms': 1000 * np.median(seconds),
+                'p95_ms': 1000 * np.percentile(seconds, 95),
+                'rows_per_lookup': num_rows / num_lookups,
+            })
+    finally:
+        conn.close()
+    return pd.DataFrame(rows)
+
+
+def run_lookups(db_file, num_homes, num_days, seed=0, num_lookups=100):
+    """
+    Fills a scratch database with a synthetic fleet, runs the detector stages and times per-home
+    lookups twice: with every table in date order (the order the nightly stages append in), and
+    after cluster_tables has ordered them by home.  The process must be pointed at the scratch
+    database (through SOLARPROD_LOCAL_DB).  Returns a frame with one row per (layout, table).
+    """
+    from .data_plumbing import cluster_tables
+
+    run_stages(db_file, num_homes, num_days, seed)
+
+    conn = get_duckdb_connection()
+    try:
+        with transaction(conn):
+            for table_name in CLUSTERED_TABLE_NAMES:
+                if table_exists(conn, table_name):
+                    cluster_table(conn, table_name, order_by=('date', 'homeowner_id'))
+    finally:
+        conn.close()
+    before = time_lookups(num_lookups, seed)
+
+    then = time.perf_counter()
+    cluster_tables(max_unclustered_fraction=0)
+    cluster_seconds = time.perf_counter() - then
+    after = time_lookups(num_lookups, seed)
+
+    df = pd.concat([before.assign(layout='by date'), after.assign(layout='by home')], ignore_index=True)
+    df.insert(0, 'num_homes', num_homes)
+    df['cluster_seconds'] = cluster_seconds
+    return df
+
+
+def _run_in_scratch_db(db_file, args):
+    """
+    Runs this module in a fresh process pointed at db_file (through SOLARPROD_LOCAL_DB) and
+    returns the frame it prints
+    """
+    check_scratch_db(db_file)
+    env = dict(os.environ, SOLARPROD_LOCAL_DB=db_file)
+    command = [sys.executable, '-m', 'solarprod.benchmark', args[0], db_file] + [str(arg) for arg in args[1:]]
+    # Only the results are captured.  Logs and any traceback go straight to stderr.
+    output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return pd.DataFrame(json.loads(output.strip().splitlines()[-1]))
+
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, num_days=180, seed=0, workers=1, engine='sql', db_dir=None):
+    """
+    Runs the stage benchmarks for every fleet size.  A synthetic fleet (homes clustered around
+    real metro areas with seasonal, weather driven production, gaps, outages and injected
+    drops) is written to a scratch database and every detector stage is timed against it.
+    Each size runs in a fresh process pointed at its own database (through SOLARPROD_LOCAL_DB),
+    so peak memory is measured per size.  Returns a frame with one row per (size, stage).
+
+    Args:
+           sizes: The fleet sizes (number of homes) to benchmark
+        num_days: The days of production history for every home
+            seed: Seed for the synthetic fleet
+         workers: Passed on to NominalProd.update_nominal_prod
+          engine: Passed on to Detector.compute_detections
+          db_dir: Where to put the scratch databases (a temp dir that is removed afterwards by default)
+    """
+    frames = []
+    with tempfile.TemporaryDirectory(dir=db_dir) as tmp_dir:
+        for num_homes in sizes:
+            db_file = os.path.join(tmp_dir, f'benchmark_{num_homes}.ddb')
+            frames.append(_run_in_scratch_db(db_file, ['stages', num_homes, num_days, seed, workers, engine]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def run_lookup_benchmarks(sizes=BENCHMARK_SIZES, num_days=180, seed=0, num_lookups=100, db_dir=None):
+    """
+    Benchmarks per-home lookup latency before and after the tables are ordered by home (see
+    run_lookups) for every fleet size, each in a fresh process against its own scratch database.
+    Returns a frame with one row per (size, layout, table).
+
+    Args:
+              sizes: The fleet sizes (number of homes) to benchmark
+           num_days: The days of production history for every home
+               seed: Seed for the synthetic fleet and the homes looked up
+        num_lookups: The number of homes looked up in every table
+             db_dir: Where to put the scratch databases (a temp dir that is removed afterwards by default)
+    """
+    frames = []
+    with tempfile.TemporaryDirectory(dir=db_dir) as tmp_dir:
+        for num_homes in sizes:
+            db_file = os.path.join(tmp_dir, f'lookups_{num_homes}.ddb')
+            frames.append(_run_in_scratch_db(db_file, ['lookups', num_homes, num_days, seed, num_lookups]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def format_report(df):
+    """
+    Formats benchmark results as a table
+    """
+    df = df.copy()
+    for col in ['seconds', 'homes_per_second', 'rows_per_second', 'peak_rss_mb', 'rss_growth_mb']:
+        df[col] = df[col].round(1)
+    return df.to_string(index=False)
+
+
+def format_lookup_report(df):
+    """
+    Formats lookup benchmark results as a table of median lookup times in each layout
+    """
+    table = df.pivot_table(index=['num_homes', 'table'], columns='layout', values='median_ms', sort=False)
+    table['speedup'] = table['by date'] / table['by home']
+    table['cluster_seconds'] = df.groupby(['num_homes', 'table'], sort=False).cluster_seconds.first()
+    return table.round(2).to_string()
+
+
+if __name__ == '__main__':
+    # Runs one fleet size and prints the results as json (see run_benchmarks and run_lookup_benchmarks)
+    mode, db_file, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if mode == 'lookups':
+        num_homes, num_days, seed, num_lookups = args
+        results = run_lookups(db_file, int(num_homes), int(num_days), int(seed), int(num_lookups))
+    else:
+        num_homes, num_days, seed, workers, engine = args
+        results = run_stages(db_file, int(num_homes), int(num_days), int(seed), int(workers), engine)
+    print(results.to_json(orient='records'))
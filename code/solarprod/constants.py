@@ -1,15 +1,52 @@
+import os
+
 import pandas as pd
 
 # Database connection stuff
 PRODUCTION_CONN_NAME = 'production'
 ANALYITICS_CONN_NAME = 'analytics'
 LOCAL_CONN_NAME = 'local'
-LOCAL_DB_FILENAME = '/detector_data/solar.ddb'
+
+# Point SOLARPROD_LOCAL_DB at another file to run against a scratch database (the benchmarks do this)
+DEFAULT_LOCAL_DB_FILENAME = '/detector_data/solar.ddb'
+LOCAL_DB_FILENAME = os.environ.get('SOLARPROD_LOCAL_DB', DEFAULT_LOCAL_DB_FILENAME)
+
+# The local table holding the latest date written to each date-indexed table
+WATERMARK_TABLE_NAME = '_watermarks'
+
+# The local table holding the homes each interrupted stage has already committed
+CHECKPOINT_TABLE_NAME = '_checkpoints'
+
+# The local table listing the committed parquet files of tables kept in the parquet store
+PARQUET_FILE_TABLE_NAME = '_parquet_files'
+
+# Buffered writes to the local db get flushed when either of these is exceeded
+WRITE_BUFFER_MAX_ROWS = 1_000_000
+WRITE_BUFFER_MAX_BYTES = 256 * 2 ** 20
 
 
 # Data plumbing stuff
 EARLIEST_DATE = pd.Timestamp('1/1/2020')
 MIN_NEIGHBOR_MILES, MAX_NEIGHBOR_MILES = .125, 50
+MAX_NEIGHBORS = 100
+R_EARTH_MILES = 3963
+NEIGHBOR_TABLE_NAME = 'neighbors'
+HOMEOWNER_TABLE_NAME = 'homeowners'
+
+# Homeowner positions changed by sync_homeowners that update_neighbors hasn't processed yet
+HOMEOWNER_CHANGES_TABLE_NAME = '_homeowner_changes'
+
+# Daily production at or below this is ignored when syncing
+MIN_DAILY_PRODUCTION = 10
+
+# Streaming production syncs run one query per this many days and hold at most this many rows
+PROD_SYNC_CHUNK_DAYS = 31
+PROD_SYNC_CHUNK_ROWS = 250_000
+
+# Partitioned production syncs query this many days per partition over at most this many
+# concurrent connections.  Keep the connection cap low to go easy on the production primary.
+PROD_SYNC_PARTITION_DAYS = 7
+PROD_SYNC_MAX_CONNECTIONS = 4
 
 
 # Detector stuff
@@ -20,8 +57,41 @@ NEIGHBOR_RADIUS_MILES = 50
 NEIGHBOR_COUNT_THRESH = 4
 NOMINAL_PROD_TABLE_NAME = 'nominal_prod'
 RAW_DETECTION_TABLE_NAME = 'raw_detections'
+
+# Raw detections compare each day of nominal production with the day before, so extracting
+# detections from a start date only needs to look this many days further back
+RAW_DETECTION_LOOKBACK_DAYS = 1
 DETECTION_TABLE_NAME = 'detections'
 
+# Per-home lookups filter on homeowner_id, so these tables are rewritten in (homeowner_id, date)
+# order once more than this fraction of their rows arrived after they were last ordered
+CLUSTERED_TABLE_NAMES = ['prod_history', NOMINAL_PROD_TABLE_NAME, RAW_DETECTION_TABLE_NAME, DETECTION_TABLE_NAME]
+CLUSTER_MAX_UNCLUSTERED_FRACTION = .1
+
+# Per-home trailing windows carried between incremental nominal production runs
+NOMINAL_PROD_STATE_TABLE_NAME = 'nominal_prod_state'
+
+# Smoothed production cached by smoother settings (least recently used entries go past the cap)
+NOMINAL_PROD_CACHE_DIR = '/detector_data/nominal_prod_cache'
+NOMINAL_PROD_CACHE_MAX_BYTES = 2 * 2 ** 30
+
+# Set SOLARPROD_STORAGE=parquet to keep production history, nominal production and raw
+# detections as parquet files partitioned by month under PARQUET_STORE_DIR (see parquet_store)
+STORAGE_BACKEND = os.environ.get('SOLARPROD_STORAGE', 'duckdb')
+PARQUET_STORE_DIR = os.environ.get('SOLARPROD_PARQUET_DIR', '/detector_data/parquet')
+PARQUET_TABLE_NAMES = ['prod_history', NOMINAL_PROD_TABLE_NAME, RAW_DETECTION_TABLE_NAME]
+
+# Months are further split into this many homeowner_id buckets (0 for no buckets).  Parquet
+# files are written in row groups of this many rows sorted by homeowner_id and date.
+PARQUET_HOMEOWNER_BUCKETS = int(os.environ.get('SOLARPROD_PARQUET_BUCKETS', 0))
+PARQUET_ROW_GROUP_ROWS = 100_000
+
+# Per-stage run metrics are appended here as json lines (see metrics)
+METRICS_FILENAME = os.environ.get('SOLARPROD_METRICS', '/detector_data/metrics.jsonl')
+
+# Profiled runs write per-stage profiles into a directory named for the run under here (see profiling)
+PROFILE_DIR = '/detector_data/profiles'
+
 
 VALID_CONNECTION_NAMES = [
     PRODUCTION_CONN_NAME,
@@ -1,4 +1,6 @@
+import contextlib
 import datetime
+import os
 
 import numpy as np
 import fleming
@@ -6,7 +8,6 @@ import easier as ezr
 from dateutil.relativedelta import relativedelta
 import pandas as pd
 import ibis
-from ibis import _
 
 ibis.options.sql.default_limit = None
 
@@ -16,30 +17,106 @@ from .constants import (
     EARLIEST_DATE,
     MIN_NEIGHBOR_MILES,
     MAX_NEIGHBOR_MILES,
+    MAX_NEIGHBORS,
+    NEIGHBOR_TABLE_NAME,
+    HOMEOWNER_TABLE_NAME,
+    HOMEOWNER_CHANGES_TABLE_NAME,
+    R_EARTH_MILES,
     ANALYITICS_CONN_NAME,
+    PROD_SYNC_CHUNK_DAYS,
+    PROD_SYNC_CHUNK_ROWS,
+    PROD_SYNC_PARTITION_DAYS,
+    PROD_SYNC_MAX_CONNECTIONS,
+    MIN_DAILY_PRODUCTION,
+    PARQUET_TABLE_NAMES,
+    CLUSTERED_TABLE_NAMES,
+    CLUSTER_MAX_UNCLUSTERED_FRACTION,
 )
 
 from .ibis_tools import (
     get_connections,
 )
 
+from .duckdb_tools import (
+    advance_watermark,
+    cluster_table,
+    get_duckdb_connection,
+    get_last_date,
+    insert_frame,
+    read_watermark,
+    replace_table,
+    stage_writer,
+    table_exists as local_table_exists,
+    transaction,
+)
+
+from .spatial import (
+    compute_neighbors,
+    homes_near,
+)
+
+from .parquet_store import get_parquet_store
+
+from . import postgres_tools as pgtools
+from .production_standin import (
+    get_production_standin,
+    get_raw_history as get_standin_raw_history,
+)
+
+from .metrics import (
+    count_round_trips,
+    count_rows_read,
+)
+
+from .utils import (
+    chunked,
+    ordered_pool_map,
+)
+
+
+# Set this to a date (like 2024-06-01) to run as though it were that day.  The replay harness
+# uses it to simulate consecutive nightly runs.
+TODAY_ENV_VAR = 'SOLARPROD_TODAY'
+
 
 def get_yesterday():
     """
     Several places in the code need access to "yesterday", so write a small
     utility to get that.
     """
-    today = fleming.floor(datetime.datetime.now(), day=1)
+    if os.environ.get(TODAY_ENV_VAR):
+        today = pd.Timestamp(os.environ[TODAY_ENV_VAR]).floor('D').to_pydatetime()
+    else:
+        today = fleming.floor(datetime.datetime.now(), day=1)
     yesterday = today - relativedelta(days=1)
     return yesterday
 
 
+@contextlib.contextmanager
+def pretend_today(today):
+    """
+    A manager that makes everything run inside of it think today is the given date
+    """
+    previous = os.environ.get(TODAY_ENV_VAR)
+    os.environ[TODAY_ENV_VAR] = str(pd.Timestamp(today).date())
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop(TODAY_ENV_VAR, None)
+        else:
+            os.environ[TODAY_ENV_VAR] = previous
+
+
 def get_start_date(connection_or_connection_name, table_name, default_start_date=EARLIEST_DATE):
     """
     This function solves for the pattern of updating a database with records later than the latest
     record it already contains.  Its purpose is to retrieve the earliest date with no corresponding
     records in the table.
 
+    Local tables (and production tables we push to) have their latest date recorded in a watermark
+    table, so this is a constant-time lookup for them.  A missing watermark is rebuilt from the table.
+
     Args:
         connection_or_connection_name: Either the name of a connection or the connection itself
                                        that contains the table to be updated
@@ -49,70 +126,212 @@ def get_start_date(connection_or_connection_name, table_name, default_start_date
     # I never want to populate "today" because not everything for today has happened already
     yesterday = get_yesterday()
 
-    # create a utility function that knows how to get start date from a connection
-    def extract_starting_from_table(conn):
-        # If the table exists
-        if table_name in conn.list_tables():
-            # Get an ibis table object
-            table = conn.table(table_name)
-            
-            # Handle empty tables
-            if table.count().execute() == 0:
-                return default_start_date
+    # create a utility function that knows how to get the last date from a connection
+    def extract_last_date_from_table(conn):
+        # If the table doesn't exist, then must populate all
+        if table_name not in conn.list_tables():
+            return False, None
+
+        # Get the latest date that was pushed (this is null for empty tables)
+        table = conn.table(table_name)
+        return True, table.date.max().execute()
+
+    # Local tables get their last date from the watermark table
+    if connection_or_connection_name == LOCAL_CONN_NAME:
+        conn = get_duckdb_connection()
+        try:
+            table_exists, last_pushed_date = get_last_date(conn, table_name)
+        finally:
+            conn.close()
+
+    # Production tables are watermarked locally, but only verified against production
+    elif connection_or_connection_name == PRODUCTION_CONN_NAME:
+        table_exists, last_pushed_date = _get_production_last_date(table_name)
+
+    # If a connection name was provided, get the last date using that name
+    elif isinstance(connection_or_connection_name, str):
+        # Get the connection the table lives in
+        with get_connections(connection_or_connection_name) as conn:
+            table_exists, last_pushed_date = extract_last_date_from_table(conn)
 
-            # Get the latest date that was pushed
-            last_pushed_date = table.date.max().execute()
+    # Otherwise a connection was provided.  Get the last date using the connection
+    else:
+        table_exists, last_pushed_date = extract_last_date_from_table(connection_or_connection_name)
 
-            # Set the start date to one day after the last pushed date
-            start_date = last_pushed_date + relativedelta(days=1)
+    # Missing and empty tables must populate all
+    if not table_exists or last_pushed_date is None or pd.isnull(last_pushed_date):
+        return default_start_date
 
-            # If asking for a date after yesterday, no valid start date
-            if start_date > yesterday:
-                start_date = None
+    # Set the start date to one day after the last pushed date
+    start_date = pd.Timestamp(last_pushed_date) + relativedelta(days=1)
 
-        # If the table doesn't exist, then must populate all
-        else:
-            start_date = default_start_date
+    # If asking for a date after yesterday, no valid start date
+    if start_date > yesterday:
+        start_date = None
 
-        return start_date
+    # Return the start date
+    return start_date
 
-    # If a connection name was provided, get start date using that name
-    if isinstance(connection_or_connection_name, str):
-        # Get the connection the table lives in
-        with get_connections(connection_or_connection_name) as conn:
-            start_date = extract_starting_from_table(conn)
 
-    # Otherwise a connection was provided.  Get the start date using the connection
+def _get_production_last_date(table_name):
+    """
+    Gets the last date of a production table we push to.  The watermark saved in the local db
+    limits the production query to records at or after the watermark, which an index on date
+    makes cheap.  Anything pushed without updating the watermark is still picked up.
+    """
+    key = f'{PRODUCTION_CONN_NAME}.{table_name}'
+    conn = get_duckdb_connection()
+    try:
+        _, watermark = read_watermark(conn, key)
+    finally:
+        conn.close()
+
+    with get_connections(PRODUCTION_CONN_NAME) as production_conn:
+        if table_name not in production_conn.list_tables():
+            return False, None
+
+        table = production_conn.table(table_name)
+        if watermark is not None:
+            table = table[table.date >= watermark]
+        last_date = table.date.max().execute()
+
+    if last_date is None or pd.isnull(last_date):
+        last_date = watermark
     else:
-        start_date = extract_starting_from_table(connection_or_connection_name)
+        last_date = pd.Timestamp(last_date)
+        set_production_watermark(table_name, last_date)
 
-    # Return the start date
-    return start_date
+    return True, last_date
+
+
+def set_production_watermark(table_name, last_date):
+    """
+    Record the latest date pushed to a production table
+    """
+    conn = get_duckdb_connection()
+    try:
+        advance_watermark(conn, f'{PRODUCTION_CONN_NAME}.{table_name}', last_date)
+    finally:
+        conn.close()
 
 
-def sync_homeowners():
+def get_production_homeowners():
     """
-    This function wipes out the homeowners table in the local db and repoppulates
-    it with values from production
+    Gets a frame of all production homeowners that have coordinates specified
     """
-    with get_connections(PRODUCTION_CONN_NAME, LOCAL_CONN_NAME) as (production_conn, local_conn):
-        # Get all homeowners that have coordinates specified
-        homeowner_tablename = 'homeowners'
+    with get_connections(PRODUCTION_CONN_NAME) as production_conn:
         homeowners = production_conn.table('homeowners')
-        homeowners = homeowners['id', 'lat', 'lng'].relabel({'id': 'homeowner_id'})
+        homeowners = homeowners.select(homeowner_id=homeowners.id, lat=homeowners.lat, lng=homeowners.lng)
         homeowners = homeowners[homeowners.lat.notnull() & homeowners.lng.notnull()]
 
         # Make sure the datatypes are right
         homeowners = homeowners.mutate(homeowner_id=homeowners.homeowner_id.cast('int'))
         homeowners = homeowners.mutate(lat=homeowners.lat.cast('float'), lng=homeowners.lng.cast('float'))
 
-        # Grab a frame of the results and push it to local db
-        df = homeowners.execute()
-        local_conn.raw_sql(f"drop table if exists {homeowner_tablename}")
-        local_conn.insert(homeowner_tablename, df)
+        return count_rows_read(homeowners.execute())
+
+
+def diff_homeowners(old, new):
+    """
+    Compares two frames of homeowner_id, lat, lng and returns a tuple of frames
+    (inserted, removed, moved).  Inserted and moved have the new coordinates and
+    removed has the old ones.
+    """
+    merged = old.merge(new, on='homeowner_id', how='outer', suffixes=('_old', '_new'), indicator=True)
+    inserted = merged[merged._merge == 'right_only']
+    removed = merged[merged._merge == 'left_only']
+    both = merged[merged._merge == 'both']
+    moved = both[(both.lat_old != both.lat_new) | (both.lng_old != both.lng_new)]
+
+    def coords(df, suffix):
+        return df[['homeowner_id', f'lat{suffix}', f'lng{suffix}']].rename(
+            columns={f'lat{suffix}': 'lat', f'lng{suffix}': 'lng'}).reset_index(drop=True)
+
+    return coords(inserted, '_new'), coords(removed, '_old'), coords(moved, '_new').merge(
+        coords(moved, '_old'), on='homeowner_id', suffixes=('', '_old'))
+
+
+def sync_homeowners(incremental=True):
+    """
+    This function syncs the homeowners table in the local db with values from production.
+
+    Args:
+        incremental: If True (default), only apply the inserted, removed and moved homes to the
+                     local table, and record the positions they moved from and to so that
+                     update_neighbors() can limit itself to the homes they affect.  Otherwise
+                     wipe out the table, repopulate it, and flag the neighbors for a full rebuild.
+    """
+    df = get_production_homeowners()
+
+    conn = get_duckdb_connection()
+    try:
+        with transaction(conn):
+            # Without a local copy to compare to, this is a full reload
+            if not incremental or not local_table_exists(conn, HOMEOWNER_TABLE_NAME):
+                replace_table(conn, HOMEOWNER_TABLE_NAME, df)
+                _record_homeowner_changes(conn, None)
+                return
+
+            local = count_rows_read(conn.execute(f'SELECT homeowner_id, lat, lng FROM {HOMEOWNER_TABLE_NAME}').df())
+            inserted, removed, moved = diff_homeowners(local, df)
+
+            # Apply the diff to the local table
+            stale_ids = pd.concat([removed.homeowner_id, moved.homeowner_id]).tolist()
+            if stale_ids:
+                conn.execute(
+                    f'DELETE FROM {HOMEOWNER_TABLE_NAME} WHERE homeowner_id IN (SELECT unnest(?))', [stale_ids])
+            new_rows = pd.concat([inserted, moved[['homeowner_id', 'lat', 'lng']]], ignore_index=True)
+            if not new_rows.empty:
+                insert_frame(conn, HOMEOWNER_TABLE_NAME, new_rows)
+
+            # Every position a home appeared at or disappeared from
+            changes = pd.concat([
+                inserted,
+                removed,
+                moved[['homeowner_id', 'lat', 'lng']],
+                moved[['homeowner_id', 'lat_old', 'lng_old']].rename(columns={'lat_old': 'lat', 'lng_old': 'lng'}),
+            ], ignore_index=True)
+            _record_homeowner_changes(conn, changes)
+
+        logger = ezr.get_logger('sync_homeowners')
+        logger.info(f'homeowners inserted: {len(inserted)}, removed: {len(removed)}, moved: {len(moved)}')
+    finally:
+        conn.close()
+
+
+def _ensure_homeowner_changes_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {HOMEOWNER_CHANGES_TABLE_NAME} (
+            homeowner_id BIGINT,
+            lat DOUBLE,
+            lng DOUBLE
+        )
+    """)
+
+
+def _record_homeowner_changes(conn, changes):
+    """
+    Appends changed homeowner positions to the pending changes table.  Passing None records
+    a change with a null homeowner_id, which means the neighbors need a full rebuild.
+    """
+    _ensure_homeowner_changes_table(conn)
+
+    if changes is None:
+        changes = pd.DataFrame({'homeowner_id': [None], 'lat': [None], 'lng': [None]})
+    if changes.empty:
+        return
 
+    changes = changes[['homeowner_id', 'lat', 'lng']].astype({'homeowner_id': 'Int64', 'lat': float, 'lng': float})
+    insert_frame(conn, HOMEOWNER_CHANGES_TABLE_NAME, changes)
 
-def sync_prod_history(show_progress_bar=False, memory_friendly=True):
+
+def sync_prod_history(
+        show_progress_bar=False,
+        memory_friendly=True,
+        streaming=False,
+        chunk_days=PROD_SYNC_CHUNK_DAYS,
+        chunk_rows=PROD_SYNC_CHUNK_ROWS,
+        max_connections=0):
     """
     The history report table has daily production history for all homes at all times.
     This needs to be synced over to the local db, but it's a lot of data.
@@ -121,30 +340,50 @@ def sync_prod_history(show_progress_bar=False, memory_friendly=True):
         show_progress_bar: Set to True if you are running in a notebook and want to see a progress bar
         memory_friendly: If set to True, will make one call to the production db for each day.
                          Otherwise, it will ram the entire history table into memeory at once.
+              streaming: If set to True, ignore memory_friendly and make one call to the production db
+                         for each chunk_days date range.  Each range is streamed back as Arrow record
+                         batches of at most chunk_rows rows that are appended as they arrive.  This is
+                         the mode to use for large backfills.
+             chunk_days: The number of days in each date range when streaming
+             chunk_rows: The maximum number of rows held in memory at once when streaming
+        max_connections: If greater than zero, ignore the other modes and extract date partitions
+                         concurrently over this many production connections
+                         (see sync_prod_history_partitioned)
     """
+    if max_connections > 0:
+        sync_prod_history_partitioned(show_progress_bar, max_connections=max_connections)
+        return
 
-    # Grab the databse connections
-    with get_connections(PRODUCTION_CONN_NAME, LOCAL_CONN_NAME) as (production_conn, local_conn):
+    # Grab the databse connection.  Local writes go through a stage writer.
+    with get_connections(PRODUCTION_CONN_NAME) as production_conn:
 
         # Don't want to do anything for today, since there is more that can still happen today
         yesterday = get_yesterday()
 
         # I will ignore all production levels below this number
-        prod_threshold = 10
+        prod_threshold = MIN_DAILY_PRODUCTION
 
         # This is the name of the target table I am populating
         table_to_populate = 'prod_history'
 
         # Get the production history data and filter / clean it the way I like
         hist = production_conn.table('history_report')
-        hist = hist['date', 'homeownerId', 'totalProduction']
-        hist = hist.mutate(date=hist.date.cast('timestamp'))
-        hist = hist.relabel(ezr.slugify(hist.columns, kill_camel=True, as_dict=True))
+        hist = hist.select(
+            date=hist.date.cast('timestamp'),
+            homeowner_id=hist.homeownerId,
+            total_production=hist.totalProduction,
+        )
         hist = hist[hist.total_production > prod_threshold]
-        hist = hist.sort_by(['date', 'homeowner_id'])
+
+        # Cast to the compact types in the query, so the frames pulled over are small from the start
+        hist = hist.mutate(
+            homeowner_id=hist.homeowner_id.cast('int32'),
+            total_production=hist.total_production.cast('float32'),
+        )
+        hist = hist.order_by(['date', 'homeowner_id'])
 
         # Get a start date for syncing from the target db
-        start_date = get_start_date(local_conn, table_to_populate)
+        start_date = get_start_date(LOCAL_CONN_NAME, table_to_populate)
 
         # If couldn't get valid start date, do nothing
         if start_date is None:
@@ -153,105 +392,207 @@ def sync_prod_history(show_progress_bar=False, memory_friendly=True):
         # Create a range of days over which to compute production
         days = pd.date_range(start_date, yesterday)
 
+        if streaming:
+            _stream_prod_history(hist, table_to_populate, days, chunk_days, chunk_rows, show_progress_bar)
+            return
+
         # If you want to show progress bar, wrap in tqdm
         if show_progress_bar and memory_friendly:
             days = ezr.tqdm_flex(days)
 
-        # Use this branch if you don't have enough memory to hold all production
-        # for all homes within the specified date ranges.
-        if memory_friendly:
-            # Loop over all days, transfering data from production to target
-            for day in days:
-                batch = hist[hist.date == day]
-                df_batch = batch.execute()
-                if not df_batch.empty:
-                    local_conn.insert(table_to_populate, df_batch)
-        else:
-            df_batch = hist[hist.date.between(start_date, yesterday)].execute()
-            local_conn.insert(table_to_populate, df_batch)
+        # All writes land in one transaction along with the table's watermark
+        with stage_writer(table_to_populate) as writer:
+            # Use this branch if you don't have enough memory to hold all production
+            # for all homes within the specified date ranges.
+            if memory_friendly:
+                # Loop over all days, transfering data from production to target
+                for day in days:
+                    batch = hist[hist.date == day]
+                    writer.append(count_rows_read(batch.execute()))
+            else:
+                writer.append(count_rows_read(hist[hist.date.between(start_date, yesterday)].execute()))
 
 
-def update_neighbors():
+def _stream_prod_history(hist, table_to_populate, days, chunk_days, chunk_rows, show_progress_bar):
     """
-    A key aspect of the detector is that it will mute itself if a bunch
-    of neighboring homes also generate detections.  In order to do this, we need
-    a list of neighbors and their distances.  This function populates the neighbors
-    table.
+    Copies production history over in date-range chunks.  Each chunk is a single query whose
+    results are pulled as Arrow record batches, so memory is bounded by chunk_rows no matter
+    how long the date range is.
     """
-    # Grab the connection
-    with get_connections(LOCAL_CONN_NAME) as local_conn:
-        # We will be creating this table in the target database
-        neighbor_table_name = 'neighbors'
+    # Split the days into contiguous ranges of at most chunk_days days
+    ranges = [(chunk[0], chunk[-1] + relativedelta(days=1)) for chunk in chunked(days, chunk_days)]
 
-        # Define the earth radius for computing distance
-        r_earth_miles = 3963
+    # If you want to show progress bar, wrap in tqdm
+    if show_progress_bar:
+        ranges = ezr.tqdm_flex(ranges)
 
-        # Don't consider more than this many neighbors
-        max_neighbors = 100
+    # Flushing every chunk_rows rows keeps at most one chunk buffered
+    with stage_writer(table_to_populate, max_rows=chunk_rows) as writer:
+        for starting, ending in ranges:
+            batch = hist[(hist.date >= starting) & (hist.date < ending)]
+            for record_batch in batch.to_pyarrow_batches(chunk_size=chunk_rows):
+                writer.append(count_rows_read(record_batch.to_pandas()))
 
-        # Distance range for eligible neighbors
-        min_miles, max_miles = .125, 50
-        min_miles, max_miles = MIN_NEIGHBOR_MILES, MAX_NEIGHBOR_MILES
 
-        # Get a reference to the table and transform coords to radians
-        homeowners = local_conn.table('homeowners')
-        homeowners = homeowners.mutate(
-            lat=_.lat * np.pi / 180,
-            lng=_.lng * np.pi / 180
-        )
+def sync_prod_history_partitioned(
+        show_progress_bar=False,
+        partition_days=PROD_SYNC_PARTITION_DAYS,
+        max_connections=PROD_SYNC_MAX_CONNECTIONS):
+    """
+    Syncs production history by splitting the sync window into date partitions and extracting
+    them concurrently through the bodi_get_raw_history() postgres function (see
+    postgres_tools.create_postgres_functions).  Partitions are written in date order by this
+    thread alone, so DuckDB only ever sees a single writer.  When a local file stands in for
+    production (see production_standin), partitions are read from it instead.
 
-        # Make two copies of homeowners with different names
-        # (for some reason cross joining a table with itself didn't work in ibis)
-        owners1 = homeowners.relabel({c: f'{c}1' for c in homeowners.columns})
-        owners2 = homeowners.relabel({c: f'{c}2' for c in homeowners.columns})
+    Args:
+        show_progress_bar: Set to True if you are running in a notebook and want to see a progress bar
+           partition_days: The number of days extracted by each production query
+          max_connections: The most production connections (and so concurrent queries) to use
+    """
+    table_to_populate = 'prod_history'
 
-        # Cross join the homeowner copies
-        neighbors = owners1.cross_join(owners2)
+    # Get a start date for syncing from the target db
+    start_date = get_start_date(LOCAL_CONN_NAME, table_to_populate)
 
-        # A home can't be a neighbor to itself, so only keep record with different ids
-        neighbors = neighbors.mutate(is_different=_.homeowner_id1 != _.homeowner_id2)
-        neighbors = neighbors[neighbors.is_different].drop('is_different')
+    # If couldn't get valid start date, do nothing
+    if start_date is None:
+        return
 
-        # Compute approximate dx, dy distances in miles.  We are only using this
-        # to limit which homes we look at, so accurate distances are really not important
-        neighbors = neighbors.mutate(
-            dy=r_earth_miles * (_.lat2 - _.lat1),
-            dx=r_earth_miles * _.lat1.cos() * (_.lng2 - _.lng1)
-        )
+    # Split the sync window into contiguous partitions of at most partition_days days
+    days = pd.date_range(start_date, get_yesterday())
+    partitions = [(chunk[0], chunk[-1] + relativedelta(days=1)) for chunk in chunked(days, partition_days)]
 
-        # Compute the distance between neighbors
-        neighbors = neighbors.mutate(distance_miles=(_.dx ** 2 + _.dy ** 2).sqrt())
-        neighbors = neighbors[
-            'homeowner_id1',
-            'homeowner_id2',
-            'distance_miles'
-        ]
+    standin = get_production_standin()
+    if standin is None:
+        pool_manager = pgtools.get_postgres_connection_pool(PRODUCTION_CONN_NAME, max_connections)
+    else:
+        pool_manager = contextlib.nullcontext()
 
-        # Only keep homes between a min and max distance. Some homes are listed
-        # multiple times under different ids, so you want to rule these out
-        neighbors = neighbors[neighbors.distance_miles.between(min_miles, max_miles)]
+    with pool_manager as pool:
+        def extract(partition):
+            starting, ending = partition
+            count_round_trips()
+            if standin is not None:
+                return count_rows_read(get_standin_raw_history(standin, starting, ending, MIN_DAILY_PRODUCTION))
+            return count_rows_read(pgtools.get_raw_history(pool, starting, ending, MIN_DAILY_PRODUCTION))
 
-        # Create a window that will group records by homeowner_id and order records in the group
-        # by distance
-        window = ibis.window(group_by=neighbors.homeowner_id1, order_by=neighbors.distance_miles)
+        # Partitions are extracted concurrently but come back in date order
+        results = ordered_pool_map(extract, partitions, workers=max_connections, threads=True)
 
-        # Create an integer index of neighbors for each home that increases as a function of distance
-        neighbors = neighbors.mutate(ind=ibis.row_number().over(window))
+        # If you want to show progress bar, wrap in tqdm
+        if show_progress_bar:
+            results = ezr.tqdm_flex(results)
 
-        # Only consider the N nearest neighbors, where N = max_neighbors
-        neighbors = neighbors[neighbors.ind < max_neighbors].drop('ind')
+        # All writes land in one transaction along with the table's watermark
+        with stage_writer(table_to_populate) as writer:
+            for df in results:
+                writer.append(df)
 
-        # Ibis does something funny with metadata that I don't understand.
-        # Resetting the connection fixes it
-        local_conn.reconnect()
 
-        # Drop the neighbors table if it exists
-        local_conn.raw_sql(f"drop table if exists {neighbor_table_name}")
+def update_neighbors(spatial_index=True, incremental=True):
+    """
+    A key aspect of the detector is that it will mute itself if a bunch
+    of neighboring homes also generate detections.  In order to do this, we need
+    a list of neighbors and their distances.  This function populates the neighbors
+    table.
 
-        # Create the new neighbors table.  Note that data should never be sent over
-        # the wire for this.  It's just a query that is used to create the table
-        # all within the db.
-        local_conn.create_table(neighbor_table_name, neighbors, force=True)
+    Args:
+        spatial_index: If True (default), find neighbors with a kd-tree (see spatial.compute_neighbors).
+                       Otherwise cross join all homes in the database with sql, which is quadratic
+                       in the number of homes.
+          incremental: If True (default) and using the spatial index, only recompute neighbors of
+                       homes affected by the changes recorded by sync_homeowners()
+    """
+    if spatial_index:
+        _update_neighbors_with_spatial_index(incremental)
+        return
+
+    # Cross join every pair of homes in the database.  Distances are approximate dx, dy
+    # distances in miles, which are only used to rank neighbors, so accuracy isn't important.
+    # Some homes are listed multiple times under different ids, so neighbors closer than
+    # min_miles are ruled out, and only the max_neighbors closest ones are kept.
+    params = {
+        'r_earth_miles': R_EARTH_MILES,
+        'min_miles': MIN_NEIGHBOR_MILES,
+        'max_miles': MAX_NEIGHBOR_MILES,
+        'max_neighbors': MAX_NEIGHBORS,
+    }
+    conn = get_duckdb_connection()
+    try:
+        with transaction(conn):
+            conn.execute(
+                f"""
+                CREATE OR REPLACE TABLE {NEIGHBOR_TABLE_NAME} AS
+                WITH owners AS (
+                    SELECT homeowner_id, lat * pi() / 180 AS lat, lng * pi() / 180 AS lng
+                    FROM {HOMEOWNER_TABLE_NAME}
+                ),
+                pairs AS (
+                    SELECT
+                        a.homeowner_id AS homeowner_id1,
+                        b.homeowner_id AS homeowner_id2,
+                        sqrt(
+                            ($r_earth_miles * cos(a.lat) * (b.lng - a.lng)) ** 2 +
+                            ($r_earth_miles * (b.lat - a.lat)) ** 2
+                        ) AS distance_miles
+                    FROM owners a CROSS JOIN owners b
+                    WHERE a.homeowner_id != b.homeowner_id
+                )
+                SELECT homeowner_id1, homeowner_id2, distance_miles
+                FROM pairs
+                WHERE distance_miles BETWEEN $min_miles AND $max_miles
+                QUALIFY row_number() OVER (
+                    PARTITION BY homeowner_id1 ORDER BY distance_miles, homeowner_id2) <= $max_neighbors
+                """,
+                params
+            )
+
+            # Any pending homeowner changes are covered by the full rebuild
+            conn.execute(f'DROP TABLE IF EXISTS {HOMEOWNER_CHANGES_TABLE_NAME}')
+    finally:
+        conn.close()
+
+
+def _update_neighbors_with_spatial_index(incremental=True):
+    """
+    Updates the neighbors table from the homeowners table using a kd-tree.  If incremental,
+    only the homes affected by homeowner changes recorded by sync_homeowners() are recomputed.
+    """
+    conn = get_duckdb_connection()
+    try:
+        homeowners = count_rows_read(conn.execute(f'SELECT homeowner_id, lat, lng FROM {HOMEOWNER_TABLE_NAME}').df())
+
+        _ensure_homeowner_changes_table(conn)
+        changes = count_rows_read(
+            conn.execute(f'SELECT homeowner_id, lat, lng FROM {HOMEOWNER_CHANGES_TABLE_NAME}').df())
+
+        # Incremental updates need an existing table and no pending request for a full rebuild
+        has_neighbors = local_table_exists(conn, NEIGHBOR_TABLE_NAME)
+        is_full_rebuild = not incremental or not has_neighbors or changes.homeowner_id.isnull().any()
+
+        with transaction(conn):
+            if is_full_rebuild:
+                # Swap in the new table all at once
+                replace_table(conn, NEIGHBOR_TABLE_NAME, compute_neighbors(homeowners))
+            elif not changes.empty:
+                # Changed homes plus every home that had a change within neighbor range
+                affected_ids = np.union1d(changes.homeowner_id.to_numpy(), homes_near(homeowners, changes))
+                new_neighbors = compute_neighbors(homeowners, homeowner_ids=affected_ids)
+
+                conn.execute(
+                    f'DELETE FROM {NEIGHBOR_TABLE_NAME} WHERE homeowner_id1 IN (SELECT unnest(?))',
+                    [affected_ids.tolist()]
+                )
+                insert_frame(conn, NEIGHBOR_TABLE_NAME, new_neighbors)
+
+                logger = ezr.get_logger('update_neighbors')
+                logger.info(f'recomputed neighbors for {len(affected_ids)} homes')
+
+            # Pending changes have been consumed
+            conn.execute(f'DELETE FROM {HOMEOWNER_CHANGES_TABLE_NAME}')
+    finally:
+        conn.close()
 
 
 def get_unique_homes(start_date):
@@ -259,12 +600,14 @@ def get_unique_homes(start_date):
     This function returns a list of unique homeowner ids that
     had production since the specified start_date
     """
-    with get_connections(LOCAL_CONN_NAME) as local_conn:
-        hist = local_conn.table('prod_history')
-        hist = hist[hist.date > start_date]
-        hist = hist[['homeowner_id']].distinct()
-        hist = hist.sort_by('homeowner_id')
-        return list(hist.homeowner_id.execute())
+    conn = get_duckdb_connection()
+    try:
+        rows = conn.execute(
+            'SELECT DISTINCT homeowner_id FROM prod_history WHERE date > ? ORDER BY homeowner_id', [start_date]
+        ).fetchall()
+    finally:
+        conn.close()
+    return [homeowner_id for (homeowner_id,) in rows]
 
 
 # def push_detections():
@@ -287,11 +630,107 @@ def push_detections():
         if start_date is None:
             return
 
+        # compute_detections doesn't create the table until it has something to save
+        if 'detections' not in conn_local.list_tables():
+            return
+
         detections = conn_local.table('detections')
         detections = detections[detections.date >= start_date]
-        df = detections.execute()
+        df = count_rows_read(detections.execute())
         logger = ezr.get_logger('push_detections')
         logger.info(f'pushing {len(df)} detections')
         if not df.empty:
             print(df.dtypes)
             conn_target.insert('low_production_detection_events', df)
+            set_production_watermark('low_production_detection_events', df.date.max())
+
+
+def maintain_parquet_store(migrate=False, vacuum=False):
+    """
+    Maintenance for the tables kept in the parquet store (see parquet_store).  Rows are only
+    appended after a table's watermark, so every month before the watermark's month is closed.
+    Each closed month is compacted into one file per partition, after which it never changes.
+    Run this between pipeline runs, since it replaces files the stages read.
+
+    Args:
+        migrate: First move any of the tables still in the local db into the store
+         vacuum: Remove files the manifest doesn't list (left by crashed or compacted runs)
+    """
+    logger = ezr.get_logger('maintain_parquet_store')
+    for table_name in PARQUET_TABLE_NAMES:
+        store = get_parquet_store(table_name)
+        if store is None:
+            logger.info(f'{table_name} is not kept in the parquet store')
+            continue
+
+        conn = get_duckdb_connection()
+        try:
+            if migrate:
+                with transaction(conn):
+                    num_rows = store.migrate(conn, table_name)
+                logger.info(f'{table_name}: moved {num_rows} rows to {store.root}')
+
+            _, last_date = get_last_date(conn, table_name)
+            if last_date is not None:
+                with transaction(conn):
+                    replaced = store.compact(conn, table_name, f'{last_date:%Y-%m}')
+                store.remove_files(replaced)
+                logger.info(f'{table_name}: compacted {len(replaced)} files')
+
+            if vacuum:
+                logger.info(f'{table_name}: vacuumed {len(store.vacuum(conn, table_name))} files')
+        finally:
+            conn.close()
+
+
+def cluster_tables(table_names=CLUSTERED_TABLE_NAMES, max_unclustered_fraction=CLUSTER_MAX_UNCLUSTERED_FRACTION):
+    """
+    Keeps the tables read a home at a time ordered by (homeowner_id, date), so per-home lookups
+    skip most row groups (see duckdb_tools.cluster_table).  New rows arrive a night at a time,
+    so they land in row groups spanning every home.  A table is rewritten once more than
+    max_unclustered_fraction of its rows are dated after the last date it was ordered through,
+    which is kept in the watermark table.  Tables in the parquet store are skipped, since their
+    files are written sorted.  Returns the names of the tables rewritten.
+
+    Args:
+                     table_names: The tables to keep ordered
+        max_unclustered_fraction: Rewrite a table once this fraction of its rows is out of order
+    """
+    logger = ezr.get_logger('cluster_tables')
+    clustered = []
+    conn = get_duckdb_connection()
+    try:
+        for table_name in table_names:
+            if get_parquet_store(table_name) is not None or not local_table_exists(conn, table_name):
+                continue
+
+            key = f'{table_name}:clustered'
+            _, clustered_through = read_watermark(conn, key)
+            if clustered_through is None:
+                num_rows = num_unclustered = conn.execute(f'SELECT count(*) FROM {table_name}').fetchone()[0]
+            else:
+                num_rows, num_unclustered = conn.execute(
+                    f'SELECT count(*), count(*) FILTER (WHERE date > ?) FROM {table_name}', [clustered_through]
+                ).fetchone()
+
+            if num_unclustered == 0 or num_unclustered <= max_unclustered_fraction * num_rows:
+                continue
+
+            with transaction(conn):
+                cluster_table(conn, table_name)
+                last_date = conn.execute(f'SELECT max(date) FROM {table_name}').fetchone()[0]
+                advance_watermark(conn, key, last_date)
+            logger.info(f'{table_name}: ordered {num_rows} rows ({num_unclustered} were out of order)')
+            clustered.append(table_name)
+    finally:
+        conn.close()
+    return clustered
+
+
+def maintain_tables():
+    """
+    The nightly maintenance step.  Keeps the local tables ordered for per-home lookups and
+    compacts the closed months of tables in the parquet store.
+    """
+    cluster_tables()
+    maintain_parquet_store()
@@ -1,9 +1,12 @@
+import functools
+
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import easier as ezr
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import stats
 from dateutil.relativedelta import relativedelta
-from ibis import _
 
 from .data_plumbing import (
     get_connections,
@@ -20,8 +23,31 @@ from .constants import (
     NEIGHBOR_RADIUS_MILES,
     NEIGHBOR_COUNT_THRESH,
     NOMINAL_PROD_TABLE_NAME,
+    NOMINAL_PROD_STATE_TABLE_NAME,
     RAW_DETECTION_TABLE_NAME,
-    DETECTION_TABLE_NAME
+    RAW_DETECTION_LOOKBACK_DAYS,
+    DETECTION_TABLE_NAME,
+    NEIGHBOR_TABLE_NAME,
+)
+
+from .duckdb_tools import (
+    StageCheckpoint,
+    get_duckdb_connection,
+    get_last_date,
+    read_checkpoint,
+    stage_writer,
+    table_exists,
+)
+from .parquet_store import get_parquet_store
+from .metrics import (
+    count_rows_read,
+    measured_batches,
+)
+from .neighbor_matrix import NeighborMatrix
+
+from .utils import (
+    chunked,
+    ordered_pool_map,
 )
 
 
@@ -41,7 +67,9 @@ class NominalProd:
             lag_days=LAG_DAYS,
             neighor_radius_miles=NEIGHBOR_RADIUS_MILES,
             neighbor_count_thresh=NEIGHBOR_COUNT_THRESH,
-            overwrite=False):
+            overwrite=False,
+            vectorized=True,
+            cache=None):
         """
         This class computes a nominal production for each home.  This is basically a smoothed
         daily production where higher production values are weighted more heavily than lower.
@@ -54,11 +82,18 @@ class NominalProd:
                          lag_days: The number of days to use for computimg the log production derivative
             neighbor_radius_miles: Neighbors within this radius will be searched to see if muting is required
             neighbor_count_thresh: If this many neighbors also have detections, than this detection is muted.
+                       vectorized: If True (default), smooth all windows of a home in one batched numpy
+                                   computation.  Set to False to use the original rolling().apply() path.
+                            cache: An optional NominalProdCache.  If supplied, smoothed production read
+                                   through get_nominal_production_for_home(s) is cached by smoother
+                                   settings and prod_history watermark.
         """
         self.smoothing_days = smoothing_days
         self.lag_days = lag_days
         self.neighor_radius_miles = neighor_radius_miles
         self.neighbor_count_thresh = neighbor_count_thresh
+        self.vectorized = vectorized
+        self.cache = cache
 
         self.earliest_start_date = EARLIEST_DATE
 
@@ -71,13 +106,17 @@ class NominalProd:
         self.smoothing_dist = stats.beta(a + 1, b + 1)
 
     def get_raw_production_for_home(self, homeowner_id, starting=None):
+        if get_parquet_store('prod_history') is not None:
+            df = self.get_raw_production_for_homes([homeowner_id], starting)
+            return df[['date', 'total_production']].sort_values('date').set_index('date')
+
         with get_connections(LOCAL_CONN_NAME) as conn:
             hist = conn.table('prod_history')
             hist = hist[hist.homeowner_id == homeowner_id]
             hist = hist['date', 'total_production']
             if starting is not None:
                 hist = hist[hist.date >= starting]
-            df = hist.execute().set_index('date')
+            df = count_rows_read(hist.execute()).set_index('date')
         return df
 
     def _rank_weighted_smoother(self, ser):
@@ -95,6 +134,41 @@ class NominalProd:
         # The sum of values * normalized weights is just the weighted mean
         return np.sum(ser.values * w)
 
+    def _batched_rank_weighted_smoother(self, values, window):
+        """
+        Computes the same thing as rolling(window).apply(self._rank_weighted_smoother), but
+        for all windows at once.  Each row of the window matrix is one rolling window, so
+        ranking, weighting and summing are all done with a single numpy call each.
+        """
+        values = np.asarray(values, dtype=float)
+
+        # The rolling smoother returns NaN until a full window is available
+        out = np.full(len(values), np.nan)
+        if len(values) < window:
+            return out
+
+        # A (num_windows x window) view of the series.  No data is copied here.
+        windows = sliding_window_view(values, window)
+
+        # Percent ranks within each window (average ranks for ties, just like pandas)
+        w = stats.rankdata(windows, axis=1) / window
+        w = self.smoothing_dist.pdf(w)
+
+        # Normalize the weights of each window
+        w = w / np.sum(w, axis=1, keepdims=True)
+
+        # Weighted mean of each window
+        out[window - 1:] = np.sum(windows * w, axis=1)
+        return out
+
+    def _smooth(self, ser):
+        """
+        Run the rank-weighted smoother over a gap-free production series
+        """
+        if self.vectorized:
+            return pd.Series(self._batched_rank_weighted_smoother(ser.values, self.smoothing_days), index=ser.index)
+        return ser.rolling(self.smoothing_days).apply(self._rank_weighted_smoother)
+
     def _curtail_small_history(self, df, smoothing_days):
         has_enough = True
         if len(df) <= 2 * smoothing_days:
@@ -103,25 +177,104 @@ class NominalProd:
 
         return df, has_enough
 
-    def get_nominal_production_for_home(self, homeowner_id, starting=None):
+    def get_raw_production_for_homes(self, homeowner_ids, starting=None):
         """
-        Uses a rank-weighted smoothing algorithm to come up with nominal production
-        and potential detections
+        Gets production for a batch of homes with a single query against prod_history.  When
+        prod_history is kept in the parquet store, only the files that can hold the homes are read.
         """
-        # Get all prodution for this home
-        df = self.get_raw_production_for_home(homeowner_id, starting)
+        store = get_parquet_store('prod_history')
+        if store is not None:
+            conn = get_duckdb_connection()
+            try:
+                return store.read(
+                    conn, 'prod_history', ['homeowner_id', 'date', 'total_production'], homeowner_ids, starting)
+            finally:
+                conn.close()
+
+        with get_connections(LOCAL_CONN_NAME) as conn:
+            hist = conn.table('prod_history')
+            hist = hist[hist.homeowner_id.isin(list(homeowner_ids))]
+            hist = hist['homeowner_id', 'date', 'total_production']
+            if starting is not None:
+                hist = hist[hist.date >= starting]
+            df = count_rows_read(hist.execute())
+        return df
 
+    def smoothed_production(self, df):
+        """
+        Gap-fills a frame of raw production for a single home indexed by date and adds the
+        nominal production.  Nothing here depends on lag_days.  Returns None if the home
+        doesn't have enough history.
+        """
         df, has_enough = self._curtail_small_history(df, self.smoothing_days)
         if not has_enough:
-            return pd.DataFrame(columns=df.columns)
+            return None
 
         # Make sure there are production values for every day (fill in zeros for missing days
         df = df.resample('D').asfreq()
         df['total_production'] = df.total_production.fillna(0)
 
         # Apply the rank-weighted smoothing to obtain nominal production
-        df['nominal_prod'] = df['total_production'].rolling(self.smoothing_days).apply(self._rank_weighted_smoother)
+        df['nominal_prod'] = self._smooth(df['total_production'])
+        return df
+
+    def smoothed_production_for_batch(self, raw):
+        """
+        Smoothed production (see smoothed_production) for every home in a frame of raw
+        production, as one frame with a homeowner_id column
+        """
+        frames = []
+        for homeowner_id, df in raw.groupby('homeowner_id', sort=True):
+            df = self.smoothed_production(df[['date', 'total_production']].set_index('date').sort_index())
+            if df is not None:
+                df = df.reset_index()
+                df.insert(0, 'homeowner_id', homeowner_id)
+                frames.append(df)
+
+        if not frames:
+            return pd.DataFrame(columns=['homeowner_id', 'date', 'total_production', 'nominal_prod'])
+        return pd.concat(frames, ignore_index=True)
+
+    def cache_key(self, starting, watermark):
+        """
+        The key smoothed production from this smoother is cached under
+        """
+        return self.cache.make_key(self.smoothing_days, self.SMOOTHER_N, self.SMOOTHER_RATIO, starting, watermark)
+
+    def get_prod_history_watermark(self):
+        """
+        The last date in the local production history
+        """
+        conn = get_duckdb_connection()
+        try:
+            _, last_date = get_last_date(conn, 'prod_history')
+        finally:
+            conn.close()
+        return last_date
+
+    def smoothed_production_for_homes(self, homeowner_ids, starting=None):
+        """
+        Smoothed production for a batch of homes.  With a cache, only homes missing from the
+        cache are read and smoothed.
+        """
+        if self.cache is None:
+            return self.smoothed_production_for_batch(self.get_raw_production_for_homes(homeowner_ids, starting))
+
+        key = self.cache_key(starting, self.get_prod_history_watermark())
+        cached, missing = self.cache.get(key, homeowner_ids)
+        frames = [] if cached is None else [cached]
+        if len(missing):
+            df = self.smoothed_production_for_batch(self.get_raw_production_for_homes(missing, starting))
+            self.cache.put(key, df, missing)
+            frames.append(df)
+
+        df = pd.concat(frames, ignore_index=True)
+        return df.sort_values(['homeowner_id', 'date']).reset_index(drop=True)
 
+    def add_baseline(self, df):
+        """
+        Adds the lagged baseline to the smoothed production of a single home indexed by date
+        """
         # You want to compute something like the d/dt(log(nominal_production)) over some number of lagged days
         df['baseline_nominal_prod'] = (df.nominal_prod).shift(self.lag_days)
 
@@ -130,12 +283,119 @@ class NominalProd:
 
         return df
 
-    def update_nominal_prod(self, show_progress_bar=False):
+    def compute_nominal_production(self, df):
+        """
+        Uses a rank-weighted smoothing algorithm to compute nominal production from
+        a frame of raw production for a single home indexed by date.
+        """
+        columns = df.columns
+        df = self.smoothed_production(df)
+        if df is None:
+            return pd.DataFrame(columns=columns)
+        return self.add_baseline(df)
+
+    def get_nominal_production_for_home(self, homeowner_id, starting=None):
+        """
+        Uses a rank-weighted smoothing algorithm to come up with nominal production
+        and potential detections
+        """
+        if self.cache is not None:
+            df = self.smoothed_production_for_homes([homeowner_id], starting)
+            if df.empty:
+                return pd.DataFrame(columns=['total_production'])
+            return self.add_baseline(df.drop(columns='homeowner_id').set_index('date'))
+
+        # Get all prodution for this home
+        df = self.get_raw_production_for_home(homeowner_id, starting)
+        return self.compute_nominal_production(df)
+
+    def _records_to_insert(self, homeowner_id, df, start_date):
+        """
+        Limits a nominal production frame to the records that need inserting and tags
+        it with the homeowner_id
+        """
+        # I only care about records that need to be inserted
+        df = df.loc[start_date:, :].reset_index()
+
+        # Tag the frame with the homeowner_id
+        if not df.empty:
+            df.insert(0, 'homeowner_id', homeowner_id)
+        return df
+
+    def nominal_production_for_batch(self, raw, start_date):
+        """
+        Computes the nominal production records to insert from a frame of raw production
+        for a batch of homes.  This does no database access, so it can be run in a worker process.
+        """
+        frames = []
+        for homeowner_id, df in raw.groupby('homeowner_id', sort=True):
+            df = df[['date', 'total_production']].set_index('date').sort_index()
+            df = self._records_to_insert(homeowner_id, self.compute_nominal_production(df), start_date)
+            if not df.empty:
+                frames.append(df)
+
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def get_nominal_production_for_homes(self, homeowner_ids, prod_start_date, start_date):
+        """
+        Computes the nominal production records to insert for a batch of homes.  Production
+        for the whole batch is read in one scan and then smoothed home by home.
+        """
+        raw = self.get_raw_production_for_homes(homeowner_ids, prod_start_date)
+        return self.nominal_production_for_batch(raw, start_date)
+
+    def update_nominal_prod(
+            self, show_progress_bar=False, bulk=False, chunk_size=1000, workers=1, incremental=False):
+        """
+        Computes nominal production for all days not yet in the nominal production table.
+
+        Args:
+            show_progress_bar: Set to True to show a progress bar
+                         bulk: If True, read production for chunks of homes in one query each and
+                               write each chunk with a single insert.  Otherwise run one query per home.
+                   chunk_size: The number of homes per chunk when running in bulk mode.  This bounds
+                               the memory used by the bulk mode.
+                      workers: If greater than one, chunks are smoothed in a pool of this many processes.
+                               This implies bulk mode.  Only this process touches the database.
+                  incremental: If True, advance each home from the smoother state saved by the last
+                               incremental run, reading only the new days of production.  Homes without
+                               usable state are recomputed in bulk chunks and their state is saved.
+
+        Homes are committed chunk_size at a time along with a checkpoint (see
+        duckdb_tools.StageCheckpoint), so a crash only loses the chunk in flight.  The next run
+        first finishes the homes an interrupted run didn't get to, over the same dates, and then
+        brings the table up to date.
+        """
+        # Finish an interrupted pass before starting a new one
+        checkpoint = read_checkpoint(NOMINAL_PROD_TABLE_NAME)
+        if checkpoint is not None:
+            self._update_nominal_prod_pass(checkpoint, show_progress_bar, bulk, chunk_size, workers, incremental)
+
         # Get the start date and only proceed if it's valid
         start_date = get_start_date(LOCAL_CONN_NAME, NOMINAL_PROD_TABLE_NAME)
         if start_date is None:
             return
 
+        # The pass covers whatever production has been synced so far
+        conn = get_duckdb_connection()
+        try:
+            _, through_date = get_last_date(conn, 'prod_history')
+        finally:
+            conn.close()
+        if through_date is None or through_date < start_date:
+            return
+
+        checkpoint = StageCheckpoint(NOMINAL_PROD_TABLE_NAME, start_date, through_date)
+        self._update_nominal_prod_pass(checkpoint, show_progress_bar, bulk, chunk_size, workers, incremental)
+
+    def _update_nominal_prod_pass(self, checkpoint, show_progress_bar, bulk, chunk_size, workers, incremental):
+        """
+        Computes nominal production over the checkpoint's dates for every home it hasn't committed yet
+        """
+        start_date = checkpoint.start_date
+
         # When computing nominal prod, I'm going to need historical production
         # prior to the requested start date from smoothing and differencing.
         # This computes how many historical days I need
@@ -145,26 +405,368 @@ class NominalProd:
         prod_start_date = start_date - relativedelta(days=days_prior)
 
         # Get a list of unique homes that had production since the prod start date
-        unique_homes = list(get_unique_homes(prod_start_date))
+        unique_homes = checkpoint.remaining(get_unique_homes(prod_start_date))
+
+        if incremental:
+            self._update_nominal_prod_incremental(
+                checkpoint, unique_homes, prod_start_date, chunk_size, show_progress_bar)
+        elif bulk or workers > 1:
+            self._update_nominal_prod_bulk(
+                checkpoint, unique_homes, prod_start_date, chunk_size, show_progress_bar, workers)
+        else:
+            chunks = list(chunked(unique_homes, chunk_size))
+
+            # If you want to show progress bar, wrap in tqdm
+            if show_progress_bar:
+                chunks = ezr.tqdm_flex(chunks)
+
+            for chunk in measured_batches(chunks, 'update_nominal_prod'):
+                with checkpoint.batch(chunk) as writer:
+                    # Loop over the producing homes in the chunk
+                    for homeowner_id in chunk:
+                        # Get the production for that home since the start date
+                        df = self.get_nominal_production_for_home(homeowner_id, prod_start_date)
+                        df = self._records_to_insert(homeowner_id, df, start_date)
+
+                        # Push the frame to destination table
+                        writer.append(df)
+
+        checkpoint.complete()
+
+    def _update_nominal_prod_bulk(
+            self, checkpoint, unique_homes, prod_start_date, chunk_size, show_progress_bar, workers=1):
+        chunks = list(chunked(unique_homes, chunk_size))
+
+        # Reads happen lazily in this process as the pool asks for more work
+        raw_batches = (
+            self._raw_production_through(chunk, prod_start_date, checkpoint.through_date) for chunk in chunks)
+
+        # Smoothing is fanned out to the workers.  Results come back in chunk order.
+        results = ordered_pool_map(
+            functools.partial(self.nominal_production_for_batch, start_date=checkpoint.start_date),
+            raw_batches, workers)
 
         # If you want to show progress bar, wrap in tqdm
         if show_progress_bar:
-            unique_homes = ezr.tqdm_flex(unique_homes)
+            results = ezr.tqdm_flex(results)
 
-        # Loop over all producing homes
-        for homeowner_id in unique_homes:
-            # Get the production for that home since the start date
-            df = self.get_nominal_production_for_home(homeowner_id, prod_start_date)
+        # Each chunk is one read from prod_history and commits along with its checkpoint
+        for chunk, df in zip(chunks, measured_batches(results, 'update_nominal_prod')):
+            with checkpoint.batch(chunk) as writer:
+                writer.append(df)
 
-            # I only care about records that need to be inserted
-            df = df.loc[start_date:, :].reset_index()
+    def _raw_production_through(self, homeowner_ids, starting, through_date):
+        """
+        Production for a batch of homes from starting through through_date
+        """
+        raw = self.get_raw_production_for_homes(homeowner_ids, starting)
+        return raw[raw.date <= through_date]
 
-            # Only do something if there are records to insert
+    def _smoother_params(self):
+        """
+        The settings a saved smoother state is only valid for
+        """
+        return {
+            'smoothing_days': self.smoothing_days,
+            'lag_days': self.lag_days,
+            'smoother_n': self.SMOOTHER_N,
+            'smoother_ratio': self.SMOOTHER_RATIO,
+        }
+
+    def smoother_state_for_home(self, homeowner_id, df, known_from):
+        """
+        Builds the smoother state of a home from its raw production indexed by date.  The state
+        holds the trailing lag_days + 3 * smoothing_days days of production (NaN on days with no
+        record) and the nominal production of the last lag_days days.
+
+        Args:
+            homeowner_id: The home
+                      df: Raw production for the home indexed by date
+              known_from: Production before this date was not read, so the state can't vouch for it
+        """
+        state_days = self.lag_days + 3 * self.smoothing_days
+        dates = pd.date_range(end=df.index.max(), periods=state_days)
+        production = df.total_production.reindex(dates).to_numpy(dtype=float)
+        production[dates < known_from] = np.nan
+
+        # Nominal production only relies on the state where compute_nominal_production
+        # would see a full window of recorded history (see advance_smoother_state)
+        nominal = self._batched_rank_weighted_smoother(np.nan_to_num(production), self.smoothing_days)
+
+        return dict(
+            homeowner_id=homeowner_id,
+            first_date=max(dates[0], pd.Timestamp(known_from)),
+            last_date=dates[-1],
+            production=production,
+            nominal_prod=nominal[-self.lag_days:],
+            **self._smoother_params(),
+        )
+
+    def smoother_states_for_batch(self, raw, known_from):
+        """
+        Builds smoother states for every home in a frame of raw production
+        """
+        states = [
+            self.smoother_state_for_home(
+                homeowner_id, df[['date', 'total_production']].set_index('date').sort_index(), known_from)
+            for homeowner_id, df in raw.groupby('homeowner_id', sort=True)
+        ]
+        return pd.DataFrame(states)
+
+    def advance_smoother_state(self, state, new_raw, prod_start_date, start_date):
+        """
+        Advances the smoother state of a home over the days of production recorded since the
+        state was saved.  Returns a tuple of (records_to_insert, new_state), or None if the
+        state can't reproduce what compute_nominal_production would return, in which case
+        the home needs a full recompute.
+
+        Args:
+                      state: A row of the smoother state table
+                    new_raw: Production recorded after state.last_date indexed by date
+            prod_start_date: The first day of production a full recompute would read
+                 start_date: The first day of nominal production to insert
+        """
+        smoothing_days, lag_days = self.smoothing_days, self.lag_days
+        last_date = pd.Timestamp(state['last_date'])
+
+        # The state has to cover everything a full recompute would read, and there can't be
+        # days a full recompute would insert that the state has already moved past
+        if pd.Timestamp(state['first_date']) > prod_start_date or last_date >= start_date:
+            return None
+
+        if new_raw.empty:
+            return pd.DataFrame(), state
+
+        # Lay the new days (with NaN for days with no record) after the stored window
+        new_dates = pd.date_range(last_date + pd.Timedelta(days=1), new_raw.index.max())
+        num_new = len(new_dates)
+        production = np.concatenate([
+            np.asarray(state['production'], dtype=float),
+            new_raw.total_production.reindex(new_dates).to_numpy(dtype=float)
+        ])
+        dates = pd.date_range(end=new_dates[-1], periods=len(production))
+        filled = np.nan_to_num(production)
+
+        # Smooth only the windows ending on the new days.  The baselines are the nominal
+        # production lag_days earlier, which is either saved in the state or just computed.
+        new_nominal = self._batched_rank_weighted_smoother(
+            filled[-(num_new + smoothing_days - 1):], smoothing_days)[smoothing_days - 1:]
+        nominal = np.concatenate([np.asarray(state['nominal_prod'], dtype=float), new_nominal])
+
+        df = pd.DataFrame({
+            'date': new_dates,
+            'total_production': filled[-num_new:],
+            'nominal_prod': new_nominal,
+            'baseline_nominal_prod': nominal[:num_new],
+        })
+        df = df[df.date >= start_date]
+
+        # A full recompute sees the recorded days from prod_start_date on, gap-fills from the
+        # first of them, and returns nothing for homes with too little history.
+        is_recorded = ~np.isnan(production) & (dates >= prod_start_date)
+        if is_recorded.sum() <= 2 * smoothing_days:
+            df = df.iloc[:0]
+        elif not df.empty:
+            # Every window behind the records must start on or after the first recorded day
+            first_window_start = df.date.iloc[0] - pd.Timedelta(days=lag_days + smoothing_days - 1)
+            if dates[is_recorded][0] > first_window_start or df.isna().any().any():
+                return None
+
+        if not df.empty:
+            df.insert(0, 'homeowner_id', state['homeowner_id'])
+
+        new_state = dict(state)
+        new_state.update(
+            first_date=max(pd.Timestamp(state['first_date']), dates[-len(state['production'])]),
+            last_date=new_dates[-1],
+            production=production[-len(state['production']):],
+            nominal_prod=nominal[-lag_days:],
+        )
+        return df.reset_index(drop=True), new_state
+
+    def advance_smoother_states(self, states, new_raw, prod_start_date, start_date):
+        """
+        Advances a frame of smoother states over a frame of newly recorded production.
+        Returns a tuple of (records_to_insert, new_states, homeowner_ids_needing_full_recompute).
+        """
+        new_raw_by_home = {
+            homeowner_id: df[['date', 'total_production']].set_index('date').sort_index()
+            for homeowner_id, df in new_raw.groupby('homeowner_id', sort=True)
+        }
+        empty = pd.DataFrame(columns=['date', 'total_production']).set_index('date')
+
+        frames, new_states, fallback_ids = [], [], []
+        for state in states.to_dict('records'):
+            result = self.advance_smoother_state(
+                state, new_raw_by_home.get(state['homeowner_id'], empty), prod_start_date, start_date)
+            if result is None:
+                fallback_ids.append(state['homeowner_id'])
+                continue
+            df, new_state = result
             if not df.empty:
-                # Tag the frame with the homeowner_id and push it to destination table
-                df.insert(0, 'homeowner_id', homeowner_id)
-                with get_connections(LOCAL_CONN_NAME) as conn:
-                    conn.insert(NOMINAL_PROD_TABLE_NAME, df)
+                frames.append(df)
+            if new_state is not state:
+                new_states.append(new_state)
+
+        records = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        return records, pd.DataFrame(new_states), fallback_ids
+
+    def _read_smoother_states(self, conn):
+        """
+        Reads the saved smoother states that match this smoother's settings
+        """
+        if not table_exists(conn, NOMINAL_PROD_STATE_TABLE_NAME):
+            return pd.DataFrame()
+
+        params = self._smoother_params()
+        where = ' AND '.join(f'{name} = ?' for name in params)
+        # Missing days are stored as nulls inside the lists, so turn them back into NaN
+        states = conn.execute(
+            f"""
+            SELECT * REPLACE (
+                list_transform(production, x -> coalesce(x, 'NaN'::DOUBLE)) AS production,
+                list_transform(nominal_prod, x -> coalesce(x, 'NaN'::DOUBLE)) AS nominal_prod
+            )
+            FROM {NOMINAL_PROD_STATE_TABLE_NAME} WHERE {where}
+            """,
+            list(params.values())
+        ).df()
+        count_rows_read(states)
+
+        for col in ['production', 'nominal_prod']:
+            states[col] = [np.asarray(values, dtype=float) for values in states[col]]
+        return states
+
+    def _homes_with_late_data(self, conn):
+        """
+        Returns the ids of homes whose production inside their saved window no longer matches
+        prod_history.  Counting and summing is done in the database, so no history is read back.
+        """
+        params = self._smoother_params()
+        where = ' AND '.join(f'{name} = ?' for name in params)
+        stored = conn.execute(
+            f"""
+            WITH stored AS (
+                SELECT
+                    homeowner_id,
+                    first_date,
+                    last_date,
+                    list_count(list_filter(production, x -> NOT isnan(x))) AS num_days,
+                    list_sum(list_filter(production, x -> NOT isnan(x))) AS production
+                FROM {NOMINAL_PROD_STATE_TABLE_NAME}
+                WHERE {where}
+            )
+            SELECT
+                s.homeowner_id,
+                any_value(s.num_days) AS num_days,
+                any_value(s.production) AS production,
+                count(p.total_production) AS current_num_days,
+                sum(p.total_production) AS current_production
+            FROM stored s
+            LEFT JOIN prod_history p
+                ON p.homeowner_id = s.homeowner_id
+                AND p.date BETWEEN CAST(s.first_date AS TIMESTAMP) AND CAST(s.last_date AS TIMESTAMP)
+            GROUP BY s.homeowner_id
+            """,
+            list(params.values())
+        ).df()
+
+        is_same_sum = np.isclose(
+            stored.production.fillna(0), stored.current_production.fillna(0), rtol=1e-9, atol=1e-6)
+        is_changed = (stored.num_days != stored.current_num_days) | ~is_same_sum
+        return set(stored.homeowner_id[is_changed])
+
+    def _read_new_production(self, conn, through_date=None):
+        """
+        Reads the production recorded after the end of each home's saved window (through through_date)
+        """
+        params = self._smoother_params()
+        where = ' AND '.join(f's.{name} = ?' for name in params)
+        if through_date is not None:
+            where += ' AND p.date <= ?'
+            params['through_date'] = through_date
+        return count_rows_read(conn.execute(
+            f"""
+            SELECT p.homeowner_id, p.date, p.total_production
+            FROM prod_history p
+            JOIN {NOMINAL_PROD_STATE_TABLE_NAME} s ON p.homeowner_id = s.homeowner_id
+            WHERE p.date > CAST(s.last_date AS TIMESTAMP) AND {where}
+            """,
+            list(params.values())
+        ).df())
+
+    def _save_smoother_states(self, conn, states):
+        """
+        Upserts smoother states.  States saved with other settings are dropped.  Run this on
+        the connection writing nominal production so both commit together.
+        """
+        if states.empty:
+            return
+
+        conn.register('_smoother_states', pa.Table.from_pandas(states, preserve_index=False))
+        try:
+            if not table_exists(conn, NOMINAL_PROD_STATE_TABLE_NAME):
+                conn.execute(f'CREATE TABLE {NOMINAL_PROD_STATE_TABLE_NAME} AS SELECT * FROM _smoother_states')
+                return
+
+            params = self._smoother_params()
+            where = ' AND '.join(f'{name} = ?' for name in params)
+            conn.execute(
+                f"""
+                DELETE FROM {NOMINAL_PROD_STATE_TABLE_NAME}
+                WHERE homeowner_id IN (SELECT homeowner_id FROM _smoother_states) OR NOT ({where})
+                """,
+                list(params.values())
+            )
+            conn.execute(f'INSERT INTO {NOMINAL_PROD_STATE_TABLE_NAME} BY NAME SELECT * FROM _smoother_states')
+        finally:
+            conn.unregister('_smoother_states')
+
+    def _update_nominal_prod_incremental(
+            self, checkpoint, unique_homes, prod_start_date, chunk_size, show_progress_bar):
+        start_date, through_date = checkpoint.start_date, checkpoint.through_date
+        conn = get_duckdb_connection()
+        try:
+            states = self._read_smoother_states(conn)
+            if states.empty:
+                late_homes, new_raw = set(), pd.DataFrame(columns=['homeowner_id', 'date', 'total_production'])
+            else:
+                late_homes = self._homes_with_late_data(conn)
+                new_raw = self._read_new_production(conn, through_date)
+        finally:
+            conn.close()
+
+        # Homes whose saved window was changed by late data are recomputed from scratch
+        if not states.empty:
+            states = states[states.homeowner_id.isin(unique_homes) & ~states.homeowner_id.isin(late_homes)]
+            records, new_states, fallback_ids = self.advance_smoother_states(
+                states, new_raw, prod_start_date, start_date)
+            advanced = set(states.homeowner_id) - set(fallback_ids)
+        else:
+            records, new_states, advanced = pd.DataFrame(), pd.DataFrame(), set()
+
+        # Advanced homes are committed a chunk at a time, each along with its new states.  Homes
+        # an interrupted attempt at this pass already committed have moved past their old state.
+        for chunk in chunked(checkpoint.remaining(sorted(advanced)), chunk_size):
+            with checkpoint.batch(chunk) as writer:
+                if not records.empty:
+                    writer.append(records[records.homeowner_id.isin(chunk)])
+                if not new_states.empty:
+                    self._save_smoother_states(writer.conn, new_states[new_states.homeowner_id.isin(chunk)])
+
+        chunks = chunked([hid for hid in unique_homes if hid not in advanced], chunk_size)
+
+        # If you want to show progress bar, wrap in tqdm
+        if show_progress_bar:
+            chunks = ezr.tqdm_flex(list(chunks))
+
+        # The rest are recomputed.  Nominal production and the states it was computed from
+        # commit together.
+        for chunk in measured_batches(chunks, 'update_nominal_prod'):
+            raw = self._raw_production_through(chunk, prod_start_date, through_date)
+            with checkpoint.batch(chunk) as writer:
+                writer.append(self.nominal_production_for_batch(raw, start_date))
+                self._save_smoother_states(writer.conn, self.smoother_states_for_batch(raw, prod_start_date))
 
 
 class Detector(ezr.pickle_cache_mixin):
@@ -209,16 +811,11 @@ class Detector(ezr.pickle_cache_mixin):
         df = df[df.raw_detection > 0].reset_index()
         return df
 
-    def get_raw_detections_for_home(self, homeowner_id, start_date):
+    def raw_detections_from_nominal_prod(self, homeowner_id, df, start_date):
         """
-        Find all raw detections for a specific home given detector parameters
+        Find all raw detections on or after start_date in the nominal production
+        history of a single home
         """
-        with get_connections(LOCAL_CONN_NAME) as conn:
-            nominal_prod = conn.table(NOMINAL_PROD_TABLE_NAME)
-            nominal_prod = nominal_prod[nominal_prod.homeowner_id == homeowner_id]
-            nominal_prod[nominal_prod.date >= start_date]
-            df = nominal_prod.execute()
-
         # Extract the raw detections
         df = self.extract_detections_from_nonimal_prod(df, self.slope_ratio_threshold)
 
@@ -241,105 +838,289 @@ class Detector(ezr.pickle_cache_mixin):
         ]]
         return df
 
-    def compute_raw_detections(self, show_progress_bar=False):
+    def _detection_window_start(self, homeowner_id, start_date):
+        """
+        The first day of nominal production needed to extract a home's detections from
+        start_date.  That is normally the lookback, but a home with a gap across it needs its
+        last day before the gap to compare its first new day against.
+        """
+        lookback_start = start_date - relativedelta(days=RAW_DETECTION_LOOKBACK_DAYS)
+        conn = get_duckdb_connection()
+        try:
+            last_date = conn.execute(
+                f'SELECT max(date) FROM {NOMINAL_PROD_TABLE_NAME} WHERE homeowner_id = ? AND date < ?',
+                [homeowner_id, lookback_start]
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        return lookback_start if last_date is None else pd.Timestamp(last_date)
+
+    def get_raw_detections_for_home(self, homeowner_id, start_date):
+        """
+        Find all raw detections for a specific home given detector parameters
+        """
+        window_start = self._detection_window_start(homeowner_id, start_date)
+        store = get_parquet_store(NOMINAL_PROD_TABLE_NAME)
+        if store is not None:
+            conn = get_duckdb_connection()
+            try:
+                df = store.read(conn, NOMINAL_PROD_TABLE_NAME, homeowner_ids=[homeowner_id], starting=window_start)
+            finally:
+                conn.close()
+            df = df.sort_values('date', ignore_index=True)
+            return self.raw_detections_from_nominal_prod(homeowner_id, df, start_date)
+
+        conn = get_duckdb_connection()
+        try:
+            df = count_rows_read(conn.execute(
+                f'SELECT * FROM {NOMINAL_PROD_TABLE_NAME} WHERE homeowner_id = ? AND date >= ? ORDER BY date',
+                [homeowner_id, window_start]
+            ).df())
+        finally:
+            conn.close()
+
+        return self.raw_detections_from_nominal_prod(homeowner_id, df, start_date)
+
+    def raw_detections_query(self, start_date, through_date=None, homeowner_range=None):
+        """
+        The sql extracting raw detections for every home at once.  It computes the same thing
+        as raw_detections_from_nominal_prod, with the threshold crossing (the diff of
+        is_below_thresh) done as a window function over each home's days.  The date predicate
+        is applied before the window, so only the days being checked (plus the lookback)
+        are read in full.  The window is seeded with each home's last day before the lookback,
+        so a home with a gap across start_date still has its first new day compared against
+        its last reported one.  Returns a tuple of (sql, parameters).
+
+        Args:
+                 start_date: The first date to extract detections for
+               through_date: The last date to extract detections for (default no limit)
+            homeowner_range: A tuple of the first and last homeowner_id to extract (default all homes)
+        """
+        first_id, last_id = homeowner_range or (None, None)
+        params = {
+            'lookback_start': start_date - relativedelta(days=RAW_DETECTION_LOOKBACK_DAYS),
+            'start_date': start_date,
+            'through_date': through_date,
+            'first_id': first_id,
+            'last_id': last_id,
+            'lag_days': self.lag_days,
+            'detection_ratio': self.slope_ratio_threshold,
+        }
+        sql = f"""
+            WITH seeds AS (
+                SELECT
+                    homeowner_id,
+                    max(date) AS date,
+                    arg_max((nominal_prod < $detection_ratio * baseline_nominal_prod)::INTEGER, date)
+                        AS is_below_thresh
+                FROM {NOMINAL_PROD_TABLE_NAME}
+                WHERE date < $lookback_start
+                    AND ($first_id IS NULL OR homeowner_id BETWEEN $first_id AND $last_id)
+                GROUP BY homeowner_id
+            ),
+            checked AS (
+                SELECT
+                    homeowner_id,
+                    date,
+                    total_production,
+                    nominal_prod,
+                    baseline_nominal_prod,
+                    (nominal_prod < $detection_ratio * baseline_nominal_prod)::INTEGER
+                        AS is_below_thresh
+                FROM {NOMINAL_PROD_TABLE_NAME}
+                WHERE date >= $lookback_start
+                    AND ($through_date IS NULL OR date <= $through_date)
+                    AND ($first_id IS NULL OR homeowner_id BETWEEN $first_id AND $last_id)
+                UNION ALL
+                SELECT homeowner_id, date, NULL, NULL, NULL, is_below_thresh
+                FROM seeds
+            ),
+            crossings AS (
+                SELECT
+                    *,
+                    is_below_thresh - lag(is_below_thresh) OVER (PARTITION BY homeowner_id ORDER BY date)
+                        AS raw_detection
+                FROM checked
+            )
+            SELECT
+                homeowner_id,
+                date,
+                total_production,
+                nominal_prod,
+                baseline_nominal_prod,
+                $lag_days::BIGINT AS lag_days,
+                $detection_ratio::DOUBLE AS detection_ratio
+            FROM crossings
+            WHERE raw_detection > 0 AND date >= $start_date
+            ORDER BY homeowner_id, date
+        """
+        return sql, params
+
+    def compute_raw_detections(self, show_progress_bar=False, chunk_size=10_000):
+        """
+        Computes raw detections for all days not yet in the raw detections table.  Detections
+        are extracted by one query per chunk of homes and inserted without leaving the database.
+
+        Each chunk commits along with a checkpoint (see duckdb_tools.StageCheckpoint), so a crash
+        only loses the chunk in flight.  The next run first finishes the homes an interrupted run
+        didn't get to, over the same dates, and then brings the table up to date.
+
+        Args:
+            show_progress_bar: Set to True to show a progress bar over the chunks
+                   chunk_size: The number of homes extracted by each query
+        """
+        # Finish an interrupted pass before starting a new one
+        checkpoint = read_checkpoint(RAW_DETECTION_TABLE_NAME)
+        if checkpoint is not None:
+            self._compute_raw_detections_pass(checkpoint, show_progress_bar, chunk_size)
+
         start_date = get_start_date(LOCAL_CONN_NAME, RAW_DETECTION_TABLE_NAME)
         if start_date is None:
             return self
 
-        homeowner_ids = get_unique_homes(start_date)
-
-        # If you want to show progress bar, wrap in tqdm
-        if show_progress_bar:
-            homeowner_ids = ezr.tqdm_flex(homeowner_ids)
+        # The pass covers whatever nominal production has been computed so far
+        conn = get_duckdb_connection()
+        try:
+            _, through_date = get_last_date(conn, NOMINAL_PROD_TABLE_NAME)
+        finally:
+            conn.close()
+        if through_date is None or through_date < start_date:
+            return self
 
-        for homeowner_id in homeowner_ids:
-            df = self.get_raw_detections_for_home(homeowner_id, start_date)
-            if not df.empty:
-                with get_connections(LOCAL_CONN_NAME) as conn:
-                    conn.insert(RAW_DETECTION_TABLE_NAME, df)
+        checkpoint = StageCheckpoint(RAW_DETECTION_TABLE_NAME, start_date, through_date)
+        self._compute_raw_detections_pass(checkpoint, show_progress_bar, chunk_size)
         return self
 
-    def _get_neighbor_counts(self, neighbors, observed, max_distance_miles=50, count_field_name=None):
+    def _compute_raw_detections_pass(self, checkpoint, show_progress_bar, chunk_size):
         """
-        Ibis logic to get the number of observed neighbors from a table of observations
+        Extracts raw detections over the checkpoint's dates for every home it hasn't committed yet
         """
-        # Get only the relevant fields from the observed table
-        observed = observed['homeowner_id', 'date']
-
-        # Limit neighbors to specified distance
-        neighbors = neighbors[neighbors.distance_miles <= max_distance_miles].drop('distance_miles')
+        conn = get_duckdb_connection()
+        try:
+            homeowner_ids = [row[0] for row in conn.execute(
+                f"""
+                SELECT DISTINCT homeowner_id FROM {NOMINAL_PROD_TABLE_NAME}
+                WHERE date BETWEEN ? AND ?
+                ORDER BY homeowner_id
+                """,
+                [checkpoint.start_date, checkpoint.through_date]
+            ).fetchall()]
+        finally:
+            conn.close()
+
+        # Chunks of sorted ids are id ranges, which the query can filter on cheaply
+        chunks = list(chunked(checkpoint.remaining(homeowner_ids), chunk_size))
 
-        # Join up each observation with all its neighbors
-        observed_with_neighbors = observed.left_join(
-            neighbors, [('homeowner_id', 'homeowner_id1')]).drop('homeowner_id1')
+        # If you want to show progress bar, wrap in tqdm
+        if show_progress_bar:
+            chunks = ezr.tqdm_flex(chunks)
 
-        # Join neighbors up with observations
-        observed_with_observed_neighbors = observed_with_neighbors.left_join(
-            observed, [
-                (observed_with_neighbors.homeowner_id2, observed.homeowner_id),
-                (observed_with_neighbors.date, observed.date)
-            ]
-        )
+        for chunk in measured_batches(chunks, 'compute_raw_detections'):
+            with checkpoint.batch(chunk) as writer:
+                writer.insert_query(*self.raw_detections_query(
+                    checkpoint.start_date, checkpoint.through_date, (chunk[0], chunk[-1])))
 
-        # Record whether or not neighbors were observed
-        observed_with_observed_neighbors = observed_with_observed_neighbors.mutate(
-            observed=_.homeowner_id_y.notnull().cast('int8'))
+        checkpoint.complete()
 
-        # Clean up the join field names
-        observed_with_observed_neighbors = observed_with_observed_neighbors[
-            [c for c in observed_with_observed_neighbors.columns if '_y' not in c]
-        ]
+    def neighbor_counts_query(
+            self, max_distance_miles=50, start_date=None, observed_table=RAW_DETECTION_TABLE_NAME,
+            count_field_name='num_observed'):
+        """
+        The sql counting the observed neighbors of every observation in a table of observations
+        (rows with homeowner_id and date).  Returns a tuple of (sql, parameters).
 
-        observed_with_observed_neighbors = observed_with_observed_neighbors.relabel(
-            {c: c.replace('_x', '') for c in observed_with_observed_neighbors.columns}
-        )
+        Neighbors are only counted when they are observed on the same date, so limiting the
+        observations to dates on or after start_date limits both sides of the lookup.  The cost
+        is then proportional to the number of new observations rather than all of history.
 
-        # Count the number of observed neighbors for each home
-        observed_with_observed_neighbor_counts = observed_with_observed_neighbors.group_by(
-            ['homeowner_id', 'date']).aggregate(num_observed=_.observed.sum())
+        Args:
+            max_distance_miles: Only neighbors within this radius are counted
+                    start_date: Only count observations on or after this date (default all of them)
+                observed_table: The table of observations
+              count_field_name: The name of the count column
+        """
+        params = {'max_distance_miles': max_distance_miles, 'start_date': start_date}
+        sql = f"""
+            WITH observations AS (
+                SELECT homeowner_id, date
+                FROM {observed_table}
+                WHERE $start_date IS NULL OR date >= $start_date
+            ),
+            -- Pair each observation with all of its neighbors
+            pairs AS (
+                SELECT o.homeowner_id, o.date, n.homeowner_id2
+                FROM observations o
+                JOIN {NEIGHBOR_TABLE_NAME} n ON o.homeowner_id = n.homeowner_id1
+                WHERE n.distance_miles <= $max_distance_miles
+            ),
+            -- Count the pairs where the neighbor was observed on the same date
+            counts AS (
+                SELECT homeowner_id, date, count(*) AS num_observed
+                FROM pairs p
+                WHERE EXISTS (
+                    SELECT 1 FROM observations o WHERE o.homeowner_id = p.homeowner_id2 AND o.date = p.date)
+                GROUP BY homeowner_id, date
+            )
+            -- Observations without any observed neighbors get a count of zero
+            SELECT o.homeowner_id, o.date, coalesce(c.num_observed, 0) AS {count_field_name}
+            FROM observations o
+            LEFT JOIN counts c ON o.homeowner_id = c.homeowner_id AND o.date = c.date
+        """
+        return sql, params
 
-        # Rename the output field if desired
-        if count_field_name is not None:
-            observed_with_observed_neighbor_counts = observed_with_observed_neighbor_counts.relabel(
-                {'num_observed': count_field_name})
+    def detections_query(self, start_date):
+        """
+        The sql muting the raw detections on or after start_date that have too many detected
+        neighbors.  Returns a tuple of (sql, parameters).
+        """
+        counts_sql, params = self.neighbor_counts_query(
+            self.neighor_radius_miles, start_date, count_field_name='num_detected_neighbors')
+        params['neighbor_count_thresh'] = self.neighbor_count_thresh
+        sql = f"""
+            WITH neighbor_counts AS ({counts_sql})
+            SELECT r.*, c.num_detected_neighbors
+            FROM {RAW_DETECTION_TABLE_NAME} r
+            JOIN neighbor_counts c ON r.homeowner_id = c.homeowner_id AND r.date = c.date
+            WHERE r.date >= $start_date AND c.num_detected_neighbors < $neighbor_count_thresh
+            ORDER BY r.homeowner_id, r.date
+        """
+        return sql, params
 
-        return observed_with_observed_neighbor_counts
+    def compute_detections(self, engine='sql'):
+        """
+        Mutes raw detections that have too many detected neighbors and saves the rest as detections.
 
-    def compute_detections(self):
+        Args:
+            engine: 'sql' runs the muting as a query in the database (see detections_query).
+                    'sparse' loads neighbors and detections into memory and counts neighbors with
+                    a sparse matrix product (see neighbor_matrix.NeighborMatrix).  Both give the
+                    same detections.
+        """
         # We only need to compute detections that haven't already been computed
         start_date = get_start_date(LOCAL_CONN_NAME, DETECTION_TABLE_NAME)
         if start_date is None:
             return self
 
-        # Get a connection to the target db
-        with get_connections(LOCAL_CONN_NAME) as conn:
-            # Get a table of all raw connections
-            raw_detections = conn.table('raw_detections')
-
-            # Get the table of neighbors
-            neighbors = conn.table('neighbors')
-
-            # Get a count of detected neighbors
-            detection_neighbor_counts = self._get_neighbor_counts(
-                neighbors, raw_detections, count_field_name='num_detected_neighbors')
-
-            # Update raw detections with counts of detected neighbors
-            raw_detections = raw_detections.inner_join(
-                detection_neighbor_counts,
-                [
-                    (raw_detections.homeowner_id == detection_neighbor_counts.homeowner_id),
-                    (raw_detections.date == detection_neighbor_counts.date),
-                ]
-            )
-            detections = raw_detections[raw_detections.num_detected_neighbors < self.neighbor_count_thresh]
-            detections = detections[[c for c in detections.columns if not c.endswith('_y')]]
-            detections = detections.relabel({c: c.replace('_x', '') for c in detections.columns})
+        # Nothing is muted until compute_raw_detections has found something
+        conn = get_duckdb_connection()
+        try:
+            has_raw_detections = table_exists(conn, RAW_DETECTION_TABLE_NAME)
+        finally:
+            conn.close()
+        if not has_raw_detections:
+            return self
 
-            detections = detections[detections.date >= start_date]
+        if engine == 'sparse':
+            dfd = NeighborMatrix.from_local_db(start_date).detections(
+                self.neighbor_count_thresh, self.neighor_radius_miles, start_date)
+            with stage_writer(DETECTION_TABLE_NAME) as writer:
+                writer.append(dfd)
+            return self
+        elif engine != 'sql':
+            raise ValueError("engine must be one of ['sql', 'sparse']")
 
-            # Get a dataframe of detections
-            dfd = detections.execute()
-            if not dfd.empty:
-                # Now save the detections to the duck database
-                conn.insert('detections', dfd)
+        # Muting only looks at neighbors detected on the same date, so only the new dates are
+        # read, and the detections are written without leaving the database
+        with stage_writer(DETECTION_TABLE_NAME) as writer:
+            writer.insert_query(*self.detections_query(start_date))
         return self
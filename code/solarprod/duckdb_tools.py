@@ -0,0 +1,523 @@
+import contextlib
+import os
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+
+from .ibis_tools import (
+    CONNECTION_OPEN_COUNTS,
+    get_active_session,
+)
+
+from .metrics import (
+    CountedConnection,
+    count_rows_written,
+)
+
+from .parquet_store import get_parquet_store
+
+from .schemas import (
+    COMPACT_SCHEMAS,
+    compact_arrow,
+    compact_frame,
+    compact_select,
+)
+
+from .constants import (
+    CHECKPOINT_TABLE_NAME,
+    LOCAL_CONN_NAME,
+    LOCAL_DB_FILENAME,
+    PARQUET_TABLE_NAMES,
+    WATERMARK_TABLE_NAME,
+    WRITE_BUFFER_MAX_ROWS,
+    WRITE_BUFFER_MAX_BYTES,
+)
+
+
+def get_duckdb_connection():
+    """
+    Get a native duckdb connection to the local database.  The ibis connections are great for
+    building queries, but bulk writes and transactions are simpler on the raw connection.
+    If a connection session is active, a cursor on the session's database handle is returned.
+    Every statement run on the connection is counted as a round-trip (see metrics).
+    """
+    session = get_active_session()
+    if session is not None:
+        return CountedConnection(session.get_duckdb())
+
+    CONNECTION_OPEN_COUNTS[f'{LOCAL_CONN_NAME}_duckdb'] += 1
+    return CountedConnection(duckdb.connect(LOCAL_DB_FILENAME))
+
+
+def table_exists(conn, table_name):
+    """
+    Returns True if the named table exists in the database behind the native connection
+    """
+    rows = conn.execute(
+        'SELECT count(*) FROM information_schema.tables WHERE table_name = ?', [table_name]
+    ).fetchone()
+    return rows[0] > 0
+
+
+def _ensure_watermark_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE_NAME} (
+            table_name VARCHAR PRIMARY KEY,
+            max_date TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    """)
+
+
+def read_watermark(conn, key):
+    """
+    Reads the watermark stored under key.  Returns a tuple of (found, max_date).  A found
+    watermark with a max_date of None means the table is known to be empty.
+    """
+    if not table_exists(conn, WATERMARK_TABLE_NAME):
+        return False, None
+
+    row = conn.execute(f'SELECT max_date FROM {WATERMARK_TABLE_NAME} WHERE table_name = ?', [key]).fetchone()
+    if row is None:
+        return False, None
+    return True, _to_timestamp(row[0])
+
+
+def advance_watermark(conn, key, max_date):
+    """
+    Records max_date as the watermark under key unless a later date is already recorded.
+    Run this on the connection doing the writes so it commits in the same transaction.
+    """
+    _ensure_watermark_table(conn)
+    conn.execute(
+        f"""
+        INSERT INTO {WATERMARK_TABLE_NAME} VALUES (?, ?, current_timestamp)
+        ON CONFLICT (table_name) DO UPDATE SET
+            max_date = greatest({WATERMARK_TABLE_NAME}.max_date, excluded.max_date),
+            updated_at = excluded.updated_at
+        """,
+        [key, max_date]
+    )
+
+
+def delete_watermark(conn, key):
+    """
+    Forget the watermark stored under key
+    """
+    if table_exists(conn, WATERMARK_TABLE_NAME):
+        conn.execute(f'DELETE FROM {WATERMARK_TABLE_NAME} WHERE table_name = ?', [key])
+
+
+def get_last_date(conn, table_name):
+    """
+    Returns a tuple of (table_exists, last_date) for a local table with a date column.
+    The last date comes from the watermark table.  If there is no watermark yet, it is
+    rebuilt from the table itself and saved for next time.
+    """
+    if not table_exists(conn, table_name):
+        delete_watermark(conn, table_name)
+        return False, None
+
+    found, last_date = read_watermark(conn, table_name)
+    if not found:
+        # Rows committed by an unfinished checkpointed pass don't count
+        checkpoint = _read_checkpoint(conn, table_name)
+        if checkpoint is None:
+            last_date = conn.execute(f'SELECT max(date) FROM {table_name}').fetchone()[0]
+        else:
+            last_date = conn.execute(
+                f'SELECT max(date) FROM {table_name} WHERE date < ?', [checkpoint.start_date]).fetchone()[0]
+        last_date = _to_timestamp(last_date)
+        advance_watermark(conn, table_name, last_date)
+    return True, last_date
+
+
+def _to_timestamp(value):
+    return None if value is None else pd.Timestamp(value)
+
+
+def replace_table(conn, table_name, df):
+    """
+    Replaces the contents of a table with a frame.  Run this inside a transaction to make
+    the swap atomic.
+    """
+    conn.register('_replacement', pa.Table.from_pandas(df, preserve_index=False))
+    try:
+        conn.execute(f'CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM _replacement')
+    finally:
+        conn.unregister('_replacement')
+    count_rows_written(len(df))
+
+
+def compact_local_db(file_name=LOCAL_DB_FILENAME):
+    """
+    One-time migration of a local db written before the compact column types (see schemas).
+    Every table is copied into a fresh file, with the compact types for the tables that have
+    them, and the fresh file then replaces the old one.  Copying is what shrinks the file, since
+    DuckDB keeps the space of rewritten tables for reuse instead of giving it back.  The files of
+    the tables kept in the parquet store are rewritten with the compact types as well, and the
+    production saved in the smoother state is rounded the same way, so it still matches
+    prod_history and the next incremental run doesn't recompute every home.  Nothing else can
+    have the file (or the store) open while this runs.  Returns a tuple of the (old, new) file sizes.
+    """
+    # Fold any write-ahead log into the file, so nothing is left to replay onto the new one
+    with duckdb.connect(file_name) as conn:
+        conn.execute('CHECKPOINT')
+
+    tmp_name = f'{file_name}.compacting'
+    for name in [tmp_name, f'{tmp_name}.wal']:
+        if os.path.exists(name):
+            os.remove(name)
+
+    with duckdb.connect(tmp_name) as conn:
+        db_name = conn.execute('SELECT current_database()').fetchone()[0]
+        conn.execute("ATTACH '{}' AS _uncompacted (READ_ONLY)".format(file_name.replace("'", "''")))
+        conn.execute(f'COPY FROM DATABASE _uncompacted TO "{db_name}" (SCHEMA)')
+
+        tables = conn.execute(
+            """
+            SELECT table_name FROM information_schema.tables
+            WHERE table_catalog = '_uncompacted' AND table_type = 'BASE TABLE'
+            """
+        ).fetchall()
+        for (table_name,) in tables:
+            columns = [col[0] for col in conn.execute(f'SELECT * FROM _uncompacted.{table_name} LIMIT 0').description]
+            select = f'SELECT {compact_select(table_name, columns)} FROM _uncompacted.{table_name}'
+            if table_name in COMPACT_SCHEMAS:
+                conn.execute(f'DROP TABLE {table_name}')
+                conn.execute(f'CREATE TABLE {table_name} AS {select}')
+            else:
+                conn.execute(f'INSERT INTO {table_name} {select}')
+
+        # Views are bound to the types they were created with, so they're created again
+        views = conn.execute(
+            "SELECT view_name, sql FROM duckdb_views() WHERE database_name = '_uncompacted' AND NOT internal"
+        ).fetchall()
+        for view_name, sql in views:
+            conn.execute(f'DROP VIEW {view_name}')
+            conn.execute(sql)
+        conn.execute('DETACH _uncompacted')
+
+        # The new files only replace the old ones in the new file's manifest
+        stores = {table_name: get_parquet_store(table_name) for table_name in PARQUET_TABLE_NAMES}
+        replaced = {
+            table_name: store.compact_types(conn, table_name)
+            for table_name, store in stores.items() if store is not None
+        }
+
+    old_size, new_size = os.path.getsize(file_name), os.path.getsize(tmp_name)
+    os.replace(tmp_name, file_name)
+    for table_name, paths in replaced.items():
+        stores[table_name].remove_files(paths)
+    return old_size, new_size
+
+
+def cluster_table(conn, table_name, order_by=('homeowner_id', 'date')):
+    """
+    Rewrites a table sorted by the order_by columns.  DuckDB keeps the min and max of every
+    column in each row group, so once a table is sorted by homeowner_id a per-home lookup
+    skips every row group but the one or two holding the home.  Run this inside a
+    transaction to make the rewrite atomic.
+    """
+    conn.execute(
+        f'CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM {table_name} ORDER BY {", ".join(order_by)}')
+
+
+def insert_frame(conn, table_name, df):
+    """
+    Appends a frame to an existing table, matching columns by name
+    """
+    conn.register('_inserted', pa.Table.from_pandas(df, preserve_index=False))
+    try:
+        conn.execute(f'INSERT INTO {table_name} BY NAME SELECT * FROM _inserted')
+    finally:
+        conn.unregister('_inserted')
+    count_rows_written(len(df))
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """
+    Runs everything in the context inside a single transaction on the native connection.
+    The transaction is rolled back if anything raises.
+    """
+    conn.execute('BEGIN TRANSACTION')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+class BufferedTableWriter:
+    def __init__(self, conn, table_name, max_rows=WRITE_BUFFER_MAX_ROWS, max_bytes=WRITE_BUFFER_MAX_BYTES):
+        """
+        Accumulates frames destined for a table and appends them in large Arrow-backed batches.
+        The table is created from the first batch if it doesn't already exist.  Tables kept in
+        the parquet store are appended to there instead (see parquet_store.get_parquet_store).
+        Columns with a compact type (see schemas) are cast to it as frames are added.
+
+        Args:
+                 conn: A native duckdb connection
+           table_name: The table to append to
+             max_rows: Flush once this many rows are buffered
+            max_bytes: Flush once the buffered frames use this much memory
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.store = get_parquet_store(table_name)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+        self.frames = []
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+        self.rows_written = 0
+        self.num_flushes = 0
+        self.max_date = None
+
+    def append(self, df):
+        """
+        Add a frame to the buffer, flushing if the buffer is over budget
+        """
+        if df.empty:
+            return
+
+        df = compact_frame(self.table_name, df)
+        self.frames.append(df)
+        if 'date' in df.columns:
+            frame_max_date = pd.Timestamp(df['date'].max())
+            if self.max_date is None or frame_max_date > self.max_date:
+                self.max_date = frame_max_date
+
+        self.buffered_rows += len(df)
+        self.buffered_bytes += int(df.memory_usage(deep=True).sum())
+
+        if self.buffered_rows >= self.max_rows or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Append everything in the buffer to the table with a single statement
+        """
+        if not self.frames:
+            return
+
+        batch = pa.Table.from_pandas(pd.concat(self.frames, ignore_index=True), preserve_index=False)
+        batch = compact_arrow(self.table_name, batch)
+        if self.store is not None:
+            self.store.append(self.conn, self.table_name, batch)
+        else:
+            self._insert(batch)
+
+        self.rows_written += batch.num_rows
+        self.num_flushes += 1
+        count_rows_written(batch.num_rows)
+        self.frames = []
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+
+    def _insert(self, batch):
+        self.conn.register('_buffered_batch', batch)
+        try:
+            if table_exists(self.conn, self.table_name):
+                self.conn.execute(f'INSERT INTO {self.table_name} BY NAME SELECT * FROM _buffered_batch')
+            else:
+                self.conn.execute(f'CREATE TABLE {self.table_name} AS SELECT * FROM _buffered_batch')
+        finally:
+            self.conn.unregister('_buffered_batch')
+
+    def insert_query(self, query, params=None):
+        """
+        Appends the result of a query against the same database without pulling any rows
+        into python (unless the table is kept in the parquet store).  The result is staged in
+        a temp table so its max date can be tracked.
+        """
+        self.flush()
+        self.conn.execute(f'CREATE OR REPLACE TEMP TABLE _query_batch AS {query}', params)
+        try:
+            columns = [col[0] for col in self.conn.execute('SELECT * FROM _query_batch LIMIT 0').description]
+            max_date = 'max(date)' if 'date' in columns else 'NULL'
+            num_rows, frame_max_date = self.conn.execute(f'SELECT count(*), {max_date} FROM _query_batch').fetchone()
+            if num_rows == 0:
+                return
+
+            compacted = f'SELECT {compact_select(self.table_name, columns)} FROM _query_batch'
+            if self.store is not None:
+                self.store.append(self.conn, self.table_name, self.conn.execute(compacted).arrow())
+            elif table_exists(self.conn, self.table_name):
+                self.conn.execute(f'INSERT INTO {self.table_name} BY NAME {compacted}')
+            else:
+                self.conn.execute(f'CREATE TABLE {self.table_name} AS {compacted}')
+        finally:
+            self.conn.execute('DROP TABLE IF EXISTS _query_batch')
+
+        if frame_max_date is not None:
+            frame_max_date = pd.Timestamp(frame_max_date)
+            if self.max_date is None or frame_max_date > self.max_date:
+                self.max_date = frame_max_date
+        self.rows_written += num_rows
+        self.num_flushes += 1
+        count_rows_written(num_rows)
+
+
+@contextlib.contextmanager
+def stage_writer(table_name, **kwargs):
+    """
+    Yields a BufferedTableWriter whose writes all land in one transaction.  Nothing becomes
+    visible in the table unless the whole context completes, so a crash partway through a
+    stage leaves the table as it was before the stage started.  The table's watermark is
+    advanced in the same transaction.
+
+    Args:
+        table_name: The table to append to
+          **kwargs: Passed on to BufferedTableWriter
+    """
+    conn = get_duckdb_connection()
+    try:
+        with transaction(conn):
+            writer = BufferedTableWriter(conn, table_name, **kwargs)
+            yield writer
+            writer.flush()
+            if writer.max_date is not None:
+                advance_watermark(conn, table_name, writer.max_date)
+    finally:
+        conn.close()
+
+
+def _ensure_checkpoint_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE_NAME} (
+            table_name VARCHAR,
+            start_date TIMESTAMP,
+            through_date TIMESTAMP,
+            homeowner_id BIGINT,
+            created_at TIMESTAMP
+        )
+    """)
+
+
+class _ClippedTableWriter(BufferedTableWriter):
+    def __init__(self, conn, table_name, through_date, **kwargs):
+        """
+        A BufferedTableWriter that drops rows dated after through_date
+        """
+        super().__init__(conn, table_name, **kwargs)
+        self.through_date = through_date
+
+    def append(self, df):
+        if not df.empty and 'date' in df.columns:
+            df = df[df['date'] <= self.through_date]
+        super().append(df)
+
+
+class StageCheckpoint:
+    def __init__(self, table_name, start_date, through_date, done_ids=()):
+        """
+        A pass of a stage over the fleet that commits one batch of homes at a time.  Each batch
+        lands in its own transaction along with a checkpoint row for every home in it, so a crash
+        loses at most the batch in flight.  The table's watermark only advances once the whole
+        pass completes.  Until then, read_checkpoint() returns the pass so the next run can
+        finish the remaining homes over the same dates before doing anything else.
+
+        Args:
+              table_name: The table the stage appends to
+              start_date: The first date the pass writes
+            through_date: The last date the pass writes.  Later rows are dropped, so a resumed
+                          pass writes the same dates for every home no matter what arrived since.
+                done_ids: The homes already committed by an earlier attempt at this pass
+        """
+        self.table_name = table_name
+        self.start_date = pd.Timestamp(start_date)
+        self.through_date = pd.Timestamp(through_date)
+        self.done_ids = set(done_ids)
+
+    def remaining(self, homeowner_ids):
+        """
+        The homes in homeowner_ids that haven't been committed yet (in the order given)
+        """
+        return [homeowner_id for homeowner_id in homeowner_ids if homeowner_id not in self.done_ids]
+
+    @contextlib.contextmanager
+    def batch(self, homeowner_ids, **kwargs):
+        """
+        Yields a BufferedTableWriter for one batch of homes.  Everything written, plus the
+        checkpoint for the homes, commits together when the context exits.
+
+        Args:
+            homeowner_ids: The homes the batch computes (including homes with nothing to write)
+                 **kwargs: Passed on to BufferedTableWriter
+        """
+        homeowner_ids = [int(homeowner_id) for homeowner_id in homeowner_ids]
+        conn = get_duckdb_connection()
+        try:
+            with transaction(conn):
+                writer = _ClippedTableWriter(conn, self.table_name, self.through_date, **kwargs)
+                yield writer
+                writer.flush()
+
+                _ensure_checkpoint_table(conn)
+                conn.execute(
+                    f"""
+                    INSERT INTO {CHECKPOINT_TABLE_NAME}
+                    SELECT ?, ?, ?, unnest(?::BIGINT[]), current_timestamp
+                    """,
+                    [self.table_name, self.start_date, self.through_date, homeowner_ids]
+                )
+        finally:
+            conn.close()
+        self.done_ids.update(homeowner_ids)
+
+    def complete(self):
+        """
+        Advances the table's watermark over the pass and forgets its checkpoints, in one transaction
+        """
+        conn = get_duckdb_connection()
+        try:
+            with transaction(conn):
+                if table_exists(conn, self.table_name):
+                    max_date = conn.execute(
+                        f'SELECT max(date) FROM {self.table_name} WHERE date BETWEEN ? AND ?',
+                        [self.start_date, self.through_date]
+                    ).fetchone()[0]
+                    if max_date is not None:
+                        advance_watermark(conn, self.table_name, pd.Timestamp(max_date))
+
+                if table_exists(conn, CHECKPOINT_TABLE_NAME):
+                    conn.execute(f'DELETE FROM {CHECKPOINT_TABLE_NAME} WHERE table_name = ?', [self.table_name])
+        finally:
+            conn.close()
+
+
+def _read_checkpoint(conn, table_name):
+    if not table_exists(conn, CHECKPOINT_TABLE_NAME):
+        return None
+
+    row = conn.execute(
+        f"""
+        SELECT start_date, through_date, list(homeowner_id)
+        FROM {CHECKPOINT_TABLE_NAME}
+        WHERE table_name = ?
+        GROUP BY start_date, through_date
+        ORDER BY start_date
+        LIMIT 1
+        """,
+        [table_name]
+    ).fetchone()
+    if row is None:
+        return None
+    return StageCheckpoint(table_name, row[0], row[1], row[2])
+
+
+def read_checkpoint(table_name):
+    """
+    Returns the StageCheckpoint of an unfinished pass over a table, or None if there isn't one
+    """
+    conn = get_duckdb_connection()
+    try:
+        return _read_checkpoint(conn, table_name)
+    finally:
+        conn.close()
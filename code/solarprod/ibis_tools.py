@@ -1,10 +1,22 @@
+import collections
 import contextlib
 import os
+import threading
+import time
+
+import duckdb
+import easier as ezr
 import ibis
 from . import postgres_tools as pgtools
+from .production_standin import (
+    get_production_standin,
+    get_standin_ibis_connection,
+)
 
 ibis.options.sql.default_limit = None
 
+from .metrics import count_sqlalchemy_round_trips
+
 from .constants import (
     PRODUCTION_CONN_NAME,
     ANALYITICS_CONN_NAME,
@@ -26,6 +38,169 @@ def get_local_connection(reset=False):
     return conn
 
 
+# A count of every connection opened in this process, keyed by connection name.
+# Comparing these before and after a run shows how much pooling saves.
+CONNECTION_OPEN_COUNTS = collections.Counter()
+
+# A stack of active connection sessions.  get_connections() reuses connections
+# from the innermost session instead of opening new ones.
+_ACTIVE_SESSIONS = []
+
+
+def get_production_connection():
+    """
+    A connection to the production database, or to the local file standing in for it
+    when SOLARPROD_PRODUCTION_DB is set (see production_standin)
+    """
+    standin = get_production_standin()
+    if standin is not None:
+        return get_standin_ibis_connection(standin)
+    return pgtools.get_postgres_ibis_connection('production')
+
+
+def _open_connection(name):
+    """
+    Opens a brand new connection for the given name and records that it was opened
+    """
+    # Define the connection getters for each name
+    getter_dict = {
+        PRODUCTION_CONN_NAME: lambda: get_production_connection(),
+        ANALYITICS_CONN_NAME: lambda: pgtools.get_postgres_ibis_connection('analytics'),
+        LOCAL_CONN_NAME: lambda: get_local_connection()
+    }
+    connection = getter_dict[name]()
+    CONNECTION_OPEN_COUNTS[name] += 1
+
+    # Every query the connection runs counts as a round-trip for the stage running it
+    count_sqlalchemy_round_trips(getattr(connection, 'con', None))
+    return connection
+
+
+def _dispose(connection):
+    """
+    Make sure a connection is closed.  The sqlalchemy backends close their pooled connections
+    by disposing of the engine, every other backend closes with disconnect().
+    """
+    con = getattr(connection, 'con', None)
+    if hasattr(con, 'dispose'):
+        con.dispose()
+    else:
+        connection.disconnect()
+
+
+def get_connection_open_counts():
+    """
+    Returns a dict of how many times each named connection has been opened in this process
+    """
+    return dict(CONNECTION_OPEN_COUNTS)
+
+
+class ConnectionSession:
+    def __init__(self, max_age_seconds=None):
+        """
+        Holds long-lived connections that are shared by everything run inside the session.
+        Connections are opened lazily the first time they are asked for and are all disposed
+        when the session closes.  Each thread gets its own connection for a name, since
+        stages run concurrently (see scheduler) and a duckdb connection can't be used from
+        two threads at once.
+
+        Args:
+            max_age_seconds: If set, connections older than this are disposed and reopened
+                             the next time they are asked for.
+        """
+        self.max_age_seconds = max_age_seconds
+        self.connections = {}
+        self.opened_at = {}
+        self.duckdb_connection = None
+        self.lock = threading.RLock()
+
+    def get(self, name):
+        """
+        Get the session's connection for a name in the calling thread, opening it if needed
+        """
+        key = (name, threading.get_ident())
+        with self.lock:
+            if key in self.connections and self._is_expired(key):
+                self._close(key)
+
+            if key not in self.connections:
+                self.connections[key] = _open_connection(name)
+                self.opened_at[key] = time.monotonic()
+            return self.connections[key]
+
+    def get_duckdb(self):
+        """
+        Get a native duckdb connection to the local database.  Each call returns a new cursor
+        on one shared database handle, so callers can run their own transactions (and stages
+        their own threads) without reopening the file.
+        """
+        with self.lock:
+            if self.duckdb_connection is None:
+                self.duckdb_connection = duckdb.connect(LOCAL_DB_FILENAME)
+                CONNECTION_OPEN_COUNTS[f'{LOCAL_CONN_NAME}_duckdb'] += 1
+            return self.duckdb_connection.cursor()
+
+    def reconnect(self, name):
+        """
+        Throw away the calling thread's connection for a name.  The next get() opens a fresh one.
+        """
+        with self.lock:
+            self._close((name, threading.get_ident()))
+
+    def close(self):
+        """
+        Dispose of every connection held by the session.  A connection that fails to close is
+        only logged, so it can't hide an error raised by the code run inside the session.
+        """
+        with self.lock:
+            for key in list(self.connections):
+                try:
+                    self._close(key)
+                except Exception:
+                    ezr.get_logger('connection_session').exception(f'Could not close the {key[0]} connection')
+
+            if self.duckdb_connection is not None:
+                self.duckdb_connection.close()
+                self.duckdb_connection = None
+
+    def _is_expired(self, key):
+        if self.max_age_seconds is None:
+            return False
+        return time.monotonic() - self.opened_at[key] > self.max_age_seconds
+
+    def _close(self, key):
+        connection = self.connections.pop(key, None)
+        self.opened_at.pop(key, None)
+        if connection is not None:
+            _dispose(connection)
+
+
+def get_active_session():
+    """
+    Returns the innermost active connection session or None if there isn't one
+    """
+    return _ACTIVE_SESSIONS[-1] if _ACTIVE_SESSIONS else None
+
+
+@contextlib.contextmanager
+def connection_session(max_age_seconds=None):
+    """
+    A manager that keeps connections alive for everything run inside of it.  Any call to
+    get_connections() made within the context reuses the session's connections instead of
+    opening and disposing its own.  All connections are disposed when the context exits.
+
+    Args:
+        max_age_seconds: If set, connections older than this are reopened on next use
+    """
+    session = ConnectionSession(max_age_seconds=max_age_seconds)
+    _ACTIVE_SESSIONS.append(session)
+    try:
+        yield session
+    finally:
+        _ACTIVE_SESSIONS.remove(session)
+        session.close()
+
+
 @contextlib.contextmanager
 def get_connections(*names):
     """
@@ -34,7 +209,8 @@ def get_connections(*names):
     retrieve the associated connections.
 
     One of the main purposes of this manager is to make sure that sqlalchemy properly
-    closes ibis connections when we drop out of the context.
+    closes ibis connections when we drop out of the context.  If a connection_session()
+    is active, its long-lived connections are returned instead and are left open.
 
     Args:
        *names: connections corresponding to supplied names will be returned in the
@@ -52,15 +228,12 @@ def get_connections(*names):
     if bad_conns:
         raise ValueError(f'valid connection names are {allowed_connections}')
 
-    # Define the connection getters for each name
-    getter_dict = {
-        PRODUCTION_CONN_NAME: lambda: pgtools.get_postgres_ibis_connection('production'),
-        ANALYITICS_CONN_NAME: lambda: pgtools.get_postgres_ibis_connection('analytics'),
-        LOCAL_CONN_NAME: lambda: get_local_connection()
-    }
-
-    # Create all requested connections
-    connections = [getter_dict[name]() for name in names]
+    # Reuse session connections if there is a session.  Otherwise create all requested connections.
+    session = get_active_session()
+    if session is not None:
+        connections = [session.get(name) for name in names]
+    else:
+        connections = [_open_connection(name) for name in names]
 
     # Yield in a try block to ensure all connections are disposed after use
     try:
@@ -69,6 +242,7 @@ def get_connections(*names):
         else:
             yield connections
     finally:
-        # Make sure the sqlalchemy connections are closed
-        for connection in connections:
-            connection.con.dispose()
+        # Session connections are disposed when the session closes
+        if session is None:
+            for connection in connections:
+                _dispose(connection)
@@ -0,0 +1,350 @@
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import psutil
+
+from .constants import METRICS_FILENAME
+
+# How often the resident memory of this process (and its worker processes) is sampled
+RSS_SAMPLE_SECONDS = .1
+
+SUMMARY_COLUMNS = [
+    'stage', 'status', 'wall_seconds', 'cpu_seconds', 'rows_read', 'rows_written', 'round_trips', 'peak_rss_mb',
+]
+
+# The measurements that work done in the current context counts toward (innermost last).
+# Threads started by utils.ordered_pool_map inherit the context of the thread that started them.
+_ACTIVE_MEASUREMENTS = contextvars.ContextVar('solarprod_active_measurements', default=())
+
+# A stack of active metrics runs.  Every finished measurement is recorded by all of them.
+_ACTIVE_RUNS = []
+
+
+def _process_tree():
+    process = psutil.Process()
+    try:
+        return [process] + process.children(recursive=True)
+    except psutil.Error:  # pragma: no cover
+        return [process]
+
+
+def _rss_bytes():
+    """
+    The resident memory of this process plus any worker processes it has started
+    """
+    total = 0
+    for process in _process_tree():
+        try:
+            total += process.memory_info().rss
+        except psutil.Error:  # pragma: no cover
+            pass
+    return total
+
+
+def _cpu_seconds():
+    """
+    The cpu time used by this process plus its finished worker processes
+    """
+    times = psutil.Process().cpu_times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class Measurement:
+    def __init__(self, stage, batch=None):
+        """
+        The cost of one pipeline stage (or one batch of homes within a stage).  Rows and
+        round-trips are counted by the database helpers while the measurement is active
+        (see count_rows_read, count_rows_written and count_round_trips).
+
+        Args:
+            stage: The name of the stage
+            batch: The number of the batch within the stage, if measuring a batch
+        """
+        self.stage = stage
+        self.batch = batch
+        self.status = 'running'
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.rows_read = 0
+        self.rows_written = 0
+        self.round_trips = 0
+        self.start_rss_bytes = 0
+        self.peak_rss_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, rows_read=0, rows_written=0, round_trips=0):
+        with self.lock:
+            self.rows_read += rows_read
+            self.rows_written += rows_written
+            self.round_trips += round_trips
+
+    def sample_rss(self, rss_bytes=None):
+        rss_bytes = _rss_bytes() if rss_bytes is None else rss_bytes
+        with self.lock:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss_bytes)
+
+    def start(self):
+        self.started_at = datetime.datetime.now()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = _cpu_seconds()
+        self.start_rss_bytes = _rss_bytes()
+        self.sample_rss(self.start_rss_bytes)
+
+    def stop(self, status='ok'):
+        self.wall_seconds = time.perf_counter() - self._wall_start
+        self.cpu_seconds = _cpu_seconds() - self._cpu_start
+        self.status = status
+        self.sample_rss()
+
+    def to_record(self):
+        return {
+            'stage': self.stage,
+            'batch': self.batch,
+            'status': self.status,
+            'started_at': None if self.started_at is None else self.started_at.isoformat(),
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'rows_read': self.rows_read,
+            'rows_written': self.rows_written,
+            'round_trips': self.round_trips,
+            'peak_rss_mb': self.peak_rss_bytes / 2 ** 20,
+        }
+
+
+class _RssSampler:
+    def __init__(self, interval):
+        """
+        One background thread that samples memory for every running measurement.  It only
+        runs while there is something to measure.
+        """
+        self.interval = interval
+        self.measurements = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, measurement):
+        with self.lock:
+            self.measurements.add(measurement)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='solarprod-rss-sampler', daemon=True)
+                self.thread.start()
+
+    def remove(self, measurement):
+        with self.lock:
+            self.measurements.discard(measurement)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.measurements:
+                    self.thread = None
+                    return
+                measurements = list(self.measurements)
+
+            rss_bytes = _rss_bytes()
+            for measurement in measurements:
+                measurement.sample_rss(rss_bytes)
+            time.sleep(self.interval)
+
+
+_SAMPLER = _RssSampler(RSS_SAMPLE_SECONDS)
+
+
+@contextlib.contextmanager
+def measured(stage, batch=None):
+    """
+    A manager that measures the work done inside of it: wall time, cpu time, rows read and
+    written, database round-trips and peak memory.  The measurement is yielded and, when the
+    context exits, is recorded by every active metrics_run().  Measurements nest, so the rows
+    of a batch also count toward its stage.
+
+    Args:
+        stage: The name of the stage
+        batch: The number of the batch within the stage, if measuring a batch
+    """
+    measurement = Measurement(stage, batch)
+    token = _ACTIVE_MEASUREMENTS.set(_ACTIVE_MEASUREMENTS.get() + (measurement,))
+    _SAMPLER.add(measurement)
+    measurement.start()
+    status = 'failed'
+    try:
+        yield measurement
+        status = 'ok'
+    finally:
+        measurement.stop(status)
+        _SAMPLER.remove(measurement)
+        _ACTIVE_MEASUREMENTS.reset(token)
+        for run in list(_ACTIVE_RUNS):
+            run.add(measurement.to_record())
+
+
+def measured_batches(items, stage):
+    """
+    Yields the items, measuring each one as a batch of the stage.  A batch covers producing
+    the item (for lazy reads) and whatever the caller does with it before asking for the
+    next one.  Batches are only measured inside a metrics_run().
+    """
+    if not _ACTIVE_RUNS:
+        yield from items
+        return
+
+    for batch, item in enumerate(items):
+        with measured(stage, batch=batch):
+            yield item
+
+
+def count_rows_read(rows):
+    """
+    Counts rows read toward every active measurement.  Takes a row count or anything with a
+    length, and returns it so reads can be counted inline:  df = count_rows_read(expr.execute())
+    """
+    num_rows = rows if isinstance(rows, int) else len(rows)
+    for measurement in _ACTIVE_MEASUREMENTS.get():
+        measurement.add(rows_read=num_rows)
+    return rows
+
+
+def count_rows_written(num_rows):
+    """
+    Counts rows written toward every active measurement
+    """
+    for measurement in _ACTIVE_MEASUREMENTS.get():
+        measurement.add(rows_written=num_rows)
+
+
+def count_round_trips(num=1):
+    """
+    Counts database round-trips toward every active measurement
+    """
+    for measurement in _ACTIVE_MEASUREMENTS.get():
+        measurement.add(round_trips=num)
+
+
+class CountedConnection:
+    # The duckdb methods that send a statement to the database
+    STATEMENT_METHODS = {'execute', 'executemany', 'sql', 'query'}
+
+    def __init__(self, conn):
+        """
+        Wraps a native duckdb connection so every statement it runs counts as a round-trip.
+        Everything else is passed through to the connection.
+        """
+        self._conn = conn
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name in self.STATEMENT_METHODS:
+            def counted(*args, **kwargs):
+                count_round_trips()
+                return attr(*args, **kwargs)
+            return counted
+        return attr
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._conn.__exit__(*args)
+
+
+def _count_cursor_execute(*args, **kwargs):
+    count_round_trips()
+
+
+def count_sqlalchemy_round_trips(engine):
+    """
+    Counts every statement an ibis connection sends through its sqlalchemy engine.
+    Connections without an engine are left alone.
+    """
+    try:
+        import sqlalchemy
+    except ImportError:  # pragma: no cover
+        return
+
+    if not isinstance(engine, sqlalchemy.engine.Engine):
+        return
+    if not sqlalchemy.event.contains(engine, 'before_cursor_execute', _count_cursor_execute):
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', _count_cursor_execute)
+
+
+class MetricsRun:
+    def __init__(self, file_name=METRICS_FILENAME, run_id=None):
+        """
+        Collects the measurements of one pipeline run.  Each one is appended to file_name as a
+        json line when it finishes, so a crashed run still leaves everything it measured.
+
+        Args:
+            file_name: The json lines file to append to (None to keep records in memory only)
+               run_id: Tags every record of the run (defaults to the start time plus a random suffix)
+        """
+        self.file_name = file_name
+        self.run_id = run_id or f'{datetime.datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}'
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        record = {'run_id': self.run_id, **record}
+        with self.lock:
+            self.records.append(record)
+            if self.file_name is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.file_name)), exist_ok=True)
+                with open(self.file_name, 'a') as buff:
+                    buff.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        """
+        A frame with a row for every stage of the run (batches are left out)
+        """
+        df = pd.DataFrame(self.records, columns=['run_id', 'batch'] + SUMMARY_COLUMNS)
+        return df[df.batch.isnull()][SUMMARY_COLUMNS].reset_index(drop=True)
+
+
+@contextlib.contextmanager
+def metrics_run(file_name=METRICS_FILENAME, run_id=None):
+    """
+    A manager that records every measurement made inside of it (see measured) in a MetricsRun
+    """
+    run = MetricsRun(file_name, run_id)
+    _ACTIVE_RUNS.append(run)
+    try:
+        yield run
+    finally:
+        _ACTIVE_RUNS.remove(run)
+
+
+def read_metrics(file_name=METRICS_FILENAME):
+    """
+    Reads every record ever written to a metrics file into a frame
+    """
+    with open(file_name) as buff:
+        return pd.DataFrame([json.loads(line) for line in buff if line.strip()])
+
+
+def format_summary(df):
+    """
+    Formats a run summary (see MetricsRun.summary) as a table with a total row
+    """
+    df = df.copy()
+    total = {
+        'stage': 'total',
+        'status': 'ok' if (df.status == 'ok').all() else 'failed',
+        'wall_seconds': df.wall_seconds.sum(),
+        'cpu_seconds': df.cpu_seconds.sum(),
+        'rows_read': df.rows_read.sum(),
+        'rows_written': df.rows_written.sum(),
+        'round_trips': df.round_trips.sum(),
+        'peak_rss_mb': df.peak_rss_mb.max(),
+    }
+    df = pd.concat([df, pd.DataFrame([total])], ignore_index=True)
+    for col in ['wall_seconds', 'cpu_seconds', 'peak_rss_mb']:
+        df[col] = df[col].astype(float).round(1)
+    return df.to_string(index=False)
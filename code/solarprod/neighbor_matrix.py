@@ -0,0 +1,145 @@
+import copy
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .constants import (
+    NEIGHBOR_TABLE_NAME,
+    RAW_DETECTION_TABLE_NAME,
+)
+
+from .duckdb_tools import get_duckdb_connection
+from .metrics import count_rows_read
+
+
+class NeighborMatrix:
+    def __init__(self, neighbors, raw_detections):
+        """
+        An in-memory engine for muting detections.  Neighbors are held as a sparse home x home
+        matrix of distances and raw detections as a sparse home x day indicator matrix.  The
+        number of detected neighbors for every raw detection is then a single sparse matrix
+        product, so detections can be recomputed for any radius and count threshold without
+        going back to the database.  Results agree with Detector.compute_detections.
+
+        Args:
+                 neighbors: A frame with columns homeowner_id1, homeowner_id2, distance_miles
+            raw_detections: A frame of raw detections (must have homeowner_id and date columns)
+        """
+        self.raw_detections = raw_detections.reset_index(drop=True)
+
+        # Integer indexes for every home and every detection day
+        self.homes = pd.Index(np.unique(np.concatenate([
+            neighbors.homeowner_id1.to_numpy(),
+            neighbors.homeowner_id2.to_numpy(),
+            self.raw_detections.homeowner_id.to_numpy(),
+        ])))
+
+        # Home x home matrix of neighbor distances
+        num_homes = len(self.homes)
+        self.distances = sparse.csr_matrix(
+            (
+                neighbors.distance_miles.to_numpy(dtype=float),
+                (self.homes.get_indexer(neighbors.homeowner_id1), self.homes.get_indexer(neighbors.homeowner_id2)),
+            ),
+            shape=(num_homes, num_homes)
+        )
+
+        self._neighbor_matrices = {}
+        self._set_detections(self.raw_detections)
+
+    def _set_detections(self, raw_detections):
+        self.raw_detections = raw_detections.reset_index(drop=True)
+        self.days = pd.Index(np.unique(self.raw_detections.date.to_numpy()))
+
+        # Home x day indicator of raw detections.  Homes missing from the neighbor index
+        # have no neighbors, so they are left out.
+        self.detection_rows = self.homes.get_indexer(self.raw_detections.homeowner_id)
+        self.detection_cols = self.days.get_indexer(self.raw_detections.date)
+        self.is_indexed = self.detection_rows >= 0
+        detected = sparse.csr_matrix(
+            (
+                np.ones(self.is_indexed.sum()),
+                (self.detection_rows[self.is_indexed], self.detection_cols[self.is_indexed])
+            ),
+            shape=(len(self.homes), len(self.days))
+        )
+
+        # A neighbor counts once per day no matter how many times it was detected that day
+        detected.data[:] = 1
+        self.detected = detected
+
+        self._neighbor_counts = {}
+
+    def with_detections(self, raw_detections):
+        """
+        Returns a matrix for another set of raw detections that shares this one's neighbor
+        structures, including the per-radius neighbor matrices already built.
+        """
+        other = copy.copy(self)
+        other._set_detections(raw_detections)
+        return other
+
+    @classmethod
+    def from_local_db(cls, start_date=None):
+        """
+        Loads neighbors and raw detections from the local database.  Neighbors are only
+        counted on the day they are detected, so loading detections from start_date on is
+        enough to mute every detection from start_date on.
+        """
+        conn = get_duckdb_connection()
+        try:
+            neighbors = count_rows_read(conn.execute(
+                f'SELECT homeowner_id1, homeowner_id2, distance_miles FROM {NEIGHBOR_TABLE_NAME}').df())
+            if start_date is None:
+                raw_detections = conn.execute(f'SELECT * FROM {RAW_DETECTION_TABLE_NAME}').df()
+            else:
+                raw_detections = conn.execute(
+                    f'SELECT * FROM {RAW_DETECTION_TABLE_NAME} WHERE date >= ?', [start_date]).df()
+            count_rows_read(raw_detections)
+        finally:
+            conn.close()
+        return cls(neighbors, raw_detections)
+
+    def neighbor_matrix(self, max_distance_miles):
+        """
+        The home x home indicator of neighbors within max_distance_miles.  Cached by radius.
+        """
+        if max_distance_miles not in self._neighbor_matrices:
+            matrix = self.distances.copy()
+            matrix.data = (matrix.data <= max_distance_miles).astype(float)
+            matrix.eliminate_zeros()
+            self._neighbor_matrices[max_distance_miles] = matrix
+        return self._neighbor_matrices[max_distance_miles]
+
+    def neighbor_counts(self, max_distance_miles):
+        """
+        The number of detected neighbors within max_distance_miles for every raw detection.
+        Cached by radius.
+        """
+        if max_distance_miles not in self._neighbor_counts:
+            counts = np.zeros(len(self.raw_detections), dtype=np.int64)
+            if self.is_indexed.any():
+                products = self.neighbor_matrix(max_distance_miles) @ self.detected
+                rows, cols = self.detection_rows[self.is_indexed], self.detection_cols[self.is_indexed]
+                counts[self.is_indexed] = np.asarray(products[rows, cols]).ravel()
+            self._neighbor_counts[max_distance_miles] = counts
+        return self._neighbor_counts[max_distance_miles]
+
+    def detections(self, neighbor_count_thresh, max_distance_miles, start_date=None):
+        """
+        Returns the raw detections (with a num_detected_neighbors column) that are not muted,
+        meaning fewer than neighbor_count_thresh neighbors within max_distance_miles were
+        detected on the same day.
+
+        Args:
+            neighbor_count_thresh: Detections with at least this many detected neighbors are muted
+               max_distance_miles: Only neighbors within this radius count
+                       start_date: If supplied, only return detections on or after this date
+        """
+        df = self.raw_detections.copy()
+        df['num_detected_neighbors'] = self.neighbor_counts(max_distance_miles)
+        df = df[df.num_detected_neighbors < neighbor_count_thresh]
+        if start_date is not None:
+            df = df[df.date >= start_date]
+        return df.reset_index(drop=True)
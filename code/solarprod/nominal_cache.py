@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .constants import (
+    NOMINAL_PROD_CACHE_DIR,
+    NOMINAL_PROD_CACHE_MAX_BYTES,
+)
+
+# The file in each entry directory describing its key.  Its mtime is the entry's last use.
+KEY_FILENAME = 'key.json'
+
+CACHE_DTYPES = {
+    'homeowner_id': 'int64',
+    'date': 'datetime64[ns]',
+    'total_production': 'float64',
+    'nominal_prod': 'float64',
+}
+
+
+class NominalProdCache:
+    def __init__(self, cache_dir=NOMINAL_PROD_CACHE_DIR, max_bytes=NOMINAL_PROD_CACHE_MAX_BYTES):
+        """
+        An on-disk cache of smoothed production (see NominalProd.smoothed_production) keyed by
+        homeowner_id and the settings that determine it: smoothing_days, SMOOTHER_N,
+        SMOOTHER_RATIO, the first day of production read, and the prod_history watermark.
+
+        Every key gets a directory of parquet files holding any number of homes, so lookups
+        for a batch of homes are a single filtered dataset scan.  Once the cache grows past
+        max_bytes, the least recently used keys are deleted.  A new watermark is a new key,
+        so entries invalidate themselves when prod_history advances, and entries for older
+        watermarks are dropped as soon as the same settings are cached for a newer one.
+
+        Args:
+            cache_dir: The directory holding the cache
+            max_bytes: Evict the least recently used keys once the cache is bigger than this
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(smoothing_days, smoother_n, smoother_ratio, starting, watermark):
+        """
+        The key for a set of smoother settings and data watermark
+        """
+        return {
+            'smoothing_days': int(smoothing_days),
+            'smoother_n': float(smoother_n),
+            'smoother_ratio': float(smoother_ratio),
+            'starting': None if starting is None else str(pd.Timestamp(starting)),
+            'watermark': None if watermark is None else str(pd.Timestamp(watermark)),
+        }
+
+    def _entry_dir(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, digest)
+
+    def _entry_files(self, key):
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return []
+        return sorted(os.path.join(entry_dir, f) for f in os.listdir(entry_dir) if f.endswith('.parquet'))
+
+    def get(self, key, homeowner_ids):
+        """
+        Looks up a batch of homes.  Returns a tuple of (frame, missing_homeowner_ids), where the
+        frame holds the cached rows of every home found (None if nothing is cached for the key).
+        """
+        homeowner_ids = np.unique(np.asarray(list(homeowner_ids)))
+        files = self._entry_files(key)
+        if not files:
+            return None, homeowner_ids
+
+        dataset = ds.dataset(files, format='parquet')
+        df = dataset.to_table(filter=pc.field('homeowner_id').isin(pa.array(homeowner_ids))).to_pandas()
+        os.utime(os.path.join(self._entry_dir(key), KEY_FILENAME))
+
+        missing = np.setdiff1d(homeowner_ids, df.homeowner_id.unique())
+
+        # Homes without enough history are cached as a single row with no date
+        df = df[df.date.notna()].sort_values(['homeowner_id', 'date']).reset_index(drop=True)
+        return df, missing
+
+    def put(self, key, df, homeowner_ids):
+        """
+        Caches the smoothed production of a batch of homes.  Homes in homeowner_ids with no
+        rows in df are remembered as having no smoothed production.
+
+        Args:
+                      key: The key returned by make_key()
+                       df: Smoothed production with homeowner_id and date columns
+            homeowner_ids: Every home the frame was computed for
+        """
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        with open(os.path.join(entry_dir, KEY_FILENAME), 'w') as buff:
+            json.dump(key, buff, sort_keys=True)
+
+        empty_ids = np.setdiff1d(np.asarray(list(homeowner_ids)), df.homeowner_id.unique())
+        if len(empty_ids):
+            df = pd.concat([df, pd.DataFrame({'homeowner_id': empty_ids, 'date': pd.NaT})], ignore_index=True)
+
+        # Every file in an entry needs the same schema, even one with only empty homes
+        df = df.astype(CACHE_DTYPES)
+
+        # Write to a temp file first so readers never see a partial file
+        table = pa.Table.from_pandas(df.sort_values(['homeowner_id', 'date']), preserve_index=False)
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        os.close(fd)
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, os.path.join(entry_dir, f'{uuid.uuid4().hex}.parquet'))
+
+        self._drop_older_watermarks(key)
+        self.evict(keep=key)
+
+    def _entries(self):
+        """
+        Returns a frame describing every entry, least recently used first
+        """
+        rows = []
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                entry_dir = os.path.join(self.cache_dir, name)
+                key_file = os.path.join(entry_dir, KEY_FILENAME)
+                if not os.path.isfile(key_file):
+                    continue
+                with open(key_file) as buff:
+                    key = json.load(buff)
+                num_bytes = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                rows.append(dict(key=key, last_used=os.path.getmtime(key_file), num_bytes=num_bytes))
+
+        df = pd.DataFrame(rows, columns=['key', 'last_used', 'num_bytes'])
+        return df.sort_values('last_used').reset_index(drop=True)
+
+    def _drop_older_watermarks(self, key):
+        if key['watermark'] is None:
+            return
+
+        def settings(k):
+            return {name: value for name, value in k.items() if name != 'watermark'}
+
+        for other in self._entries().key:
+            is_older = other['watermark'] is not None and other['watermark'] < key['watermark']
+            if is_older and settings(other) == settings(key):
+                shutil.rmtree(self._entry_dir(other), ignore_errors=True)
+
+    @property
+    def num_bytes(self):
+        return int(self._entries().num_bytes.sum())
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes.
+        The entry for the keep key is never deleted.
+        """
+        entries = self._entries()
+        total = entries.num_bytes.sum()
+        for entry in entries.itertuples():
+            if total <= self.max_bytes:
+                break
+            if entry.key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(entry.key), ignore_errors=True)
+            total -= entry.num_bytes
+
+    def clear(self):
+        """
+        Deletes everything in the cache
+        """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
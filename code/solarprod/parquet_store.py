@@ -0,0 +1,362 @@
+import os
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .constants import (
+    PARQUET_FILE_TABLE_NAME,
+    PARQUET_HOMEOWNER_BUCKETS,
+    PARQUET_ROW_GROUP_ROWS,
+    PARQUET_STORE_DIR,
+    PARQUET_TABLE_NAMES,
+    STORAGE_BACKEND,
+)
+
+from .metrics import count_rows_read
+
+from .schemas import compact_arrow
+
+# Files left in the store but missing from the manifest are only vacuumed once they are this
+# old, so the files of a transaction that hasn't committed yet are never removed
+VACUUM_MIN_AGE_SECONDS = 3600
+
+MANIFEST_COLUMNS = [
+    'table_name', 'path', 'month', 'bucket', 'num_buckets', 'num_rows',
+    'min_date', 'max_date', 'min_homeowner_id', 'max_homeowner_id', 'created_at',
+]
+
+
+def get_parquet_store(table_name):
+    """
+    The ParquetStore holding a table, or None if the table lives in the local db
+    """
+    if STORAGE_BACKEND not in ('duckdb', 'parquet'):
+        raise ValueError("SOLARPROD_STORAGE must be one of ['duckdb', 'parquet']")
+    if STORAGE_BACKEND != 'parquet' or table_name not in PARQUET_TABLE_NAMES:
+        return None
+    return ParquetStore(PARQUET_STORE_DIR, PARQUET_HOMEOWNER_BUCKETS)
+
+
+def _ensure_manifest_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PARQUET_FILE_TABLE_NAME} (
+            table_name VARCHAR,
+            path VARCHAR,
+            month VARCHAR,
+            bucket INTEGER,
+            num_buckets INTEGER,
+            num_rows BIGINT,
+            min_date TIMESTAMP,
+            max_date TIMESTAMP,
+            min_homeowner_id BIGINT,
+            max_homeowner_id BIGINT,
+            created_at TIMESTAMP
+        )
+    """)
+
+
+def _relation_type(conn, name):
+    """
+    'BASE TABLE' or 'VIEW' for a relation in the local db, or None if there is no such relation
+    """
+    row = conn.execute('SELECT table_type FROM information_schema.tables WHERE table_name = ?', [name]).fetchone()
+    return None if row is None else row[0]
+
+
+class ParquetStore:
+    def __init__(
+            self, root=PARQUET_STORE_DIR, buckets=PARQUET_HOMEOWNER_BUCKETS, row_group_rows=PARQUET_ROW_GROUP_ROWS):
+        """
+        Keeps date-indexed tables as parquet files in hive-style partitions under root:
+        <table>/month=YYYY-MM[/bucket=N]/<file>.parquet.  Every file is sorted by homeowner_id
+        and date, so the row group statistics of each file narrow per-home reads further.
+
+        Files only become part of a table once they are listed in the manifest table in the
+        local db (PARQUET_FILE_TABLE_NAME).  The manifest is written on the caller's connection,
+        so appends commit in the same transaction as the watermarks and checkpoints of the stage
+        doing them, and a crashed stage leaves nothing but unlisted files for vacuum() to remove.
+        Each table is exposed to sql (and ibis) as a view over its listed files.
+
+        Rows are only ever appended after a table's watermark, so once a month is over its
+        partition never changes again.  compact() rewrites each closed month into a single file,
+        after which closed partitions are immutable and can be backed up by copying new files.
+
+        Args:
+                      root: The directory holding the store
+                   buckets: Split each month into this many homeowner_id buckets (0 for none)
+            row_group_rows: The most rows in each parquet row group
+        """
+        self.root = root
+        self.buckets = buckets
+        self.row_group_rows = row_group_rows
+
+    def _partition_dir(self, table_name, month, bucket):
+        parts = [table_name, f'month={month}']
+        if bucket is not None:
+            parts.append(f'bucket={bucket}')
+        return os.path.join(*parts)
+
+    def _partitions(self, batch):
+        """
+        Splits an arrow table into its partitions.  Yields tuples of (month, bucket, table).
+        """
+        months = batch['date'].to_numpy(zero_copy_only=False).astype('datetime64[M]')
+        keys = pd.DataFrame({'month': months})
+        if self.buckets:
+            keys['bucket'] = batch['homeowner_id'].to_numpy(zero_copy_only=False) % self.buckets
+        else:
+            keys['bucket'] = -1
+
+        for (month, bucket), indexes in keys.groupby(['month', 'bucket']).indices.items():
+            month = pd.Timestamp(month).strftime('%Y-%m')
+            yield month, (None if bucket < 0 else int(bucket)), batch.take(indexes)
+
+    def write_files(self, table_name, batch):
+        """
+        Writes an arrow table into new files in the store without listing them in the manifest.
+        Returns a manifest record for every file written.
+        """
+        records = []
+        for month, bucket, part in self._partitions(batch):
+            part = part.sort_by([('homeowner_id', 'ascending'), ('date', 'ascending')])
+            path = os.path.join(self._partition_dir(table_name, month, bucket), f'{uuid.uuid4().hex}.parquet')
+            full_path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+            # Written under a hidden name and renamed, so a file is either complete or absent
+            tmp_path = os.path.join(os.path.dirname(full_path), f'.{os.path.basename(full_path)}.tmp')
+            pq.write_table(
+                part, tmp_path, row_group_size=self.row_group_rows,
+                coerce_timestamps='us', allow_truncated_timestamps=True)
+            os.replace(tmp_path, full_path)
+
+            dates, homeowner_ids = part['date'].to_pandas(date_as_object=False), part['homeowner_id'].to_numpy()
+            records.append({
+                'table_name': table_name,
+                'path': path,
+                'month': month,
+                'bucket': bucket,
+                'num_buckets': self.buckets or None,
+                'num_rows': part.num_rows,
+                'min_date': dates.min(),
+                'max_date': dates.max(),
+                'min_homeowner_id': int(homeowner_ids.min()),
+                'max_homeowner_id': int(homeowner_ids.max()),
+                'created_at': pd.Timestamp.now(),
+            })
+        return records
+
+    def _list_files(self, conn, records):
+        _ensure_manifest_table(conn)
+        df = pd.DataFrame(records, columns=MANIFEST_COLUMNS)
+        conn.register('_parquet_records', pa.Table.from_pandas(df, preserve_index=False))
+        try:
+            conn.execute(f'INSERT INTO {PARQUET_FILE_TABLE_NAME} BY NAME SELECT * FROM _parquet_records')
+        finally:
+            conn.unregister('_parquet_records')
+
+    def append(self, conn, table_name, batch):
+        """
+        Appends an arrow table to a table in the store.  The new files are listed in the manifest
+        and the table's view is refreshed on conn, so they commit with the caller's transaction.
+        """
+        if batch.num_rows == 0:
+            return
+        if _relation_type(conn, table_name) == 'BASE TABLE':
+            raise ValueError(
+                f'{table_name} is a table in the local db.  '
+                'Move it to the store with maintain_parquet_store(migrate=True).')
+
+        self._list_files(conn, self.write_files(table_name, batch))
+        self.refresh_view(conn, table_name)
+
+    def manifest(self, conn, table_name):
+        """
+        A frame with a row for every file of a table
+        """
+        if _relation_type(conn, PARQUET_FILE_TABLE_NAME) is None:
+            return pd.DataFrame(columns=MANIFEST_COLUMNS)
+        return conn.execute(
+            f'SELECT * FROM {PARQUET_FILE_TABLE_NAME} WHERE table_name = ? ORDER BY path', [table_name]).df()
+
+    def refresh_view(self, conn, table_name):
+        """
+        Points the table's view at the files listed in the manifest (dropping it if there are none)
+        """
+        paths = [os.path.join(self.root, path) for path in self.manifest(conn, table_name).path]
+        if not paths:
+            conn.execute(f'DROP VIEW IF EXISTS {table_name}')
+            return
+
+        file_list = ', '.join("'{}'".format(path.replace("'", "''")) for path in paths)
+        # The month and bucket in the paths aren't columns of the table, so hive partitioning is off
+        conn.execute(f"""
+            CREATE OR REPLACE VIEW {table_name} AS
+            SELECT * FROM read_parquet([{file_list}], hive_partitioning = false, union_by_name = true)
+        """)
+
+    def files(self, conn, table_name, homeowner_ids=None, starting=None, ending=None):
+        """
+        The paths of the files that can hold rows for the homes and dates.  Files are pruned
+        with the partition and the date and homeowner_id ranges recorded in the manifest,
+        so nothing is opened here.
+        """
+        df = self.manifest(conn, table_name)
+        if starting is not None:
+            df = df[df.max_date >= pd.Timestamp(starting)]
+        if ending is not None:
+            df = df[df.min_date <= pd.Timestamp(ending)]
+
+        if homeowner_ids is not None:
+            homeowner_ids = np.unique(np.asarray(list(homeowner_ids), dtype='int64'))
+            if len(homeowner_ids) == 0:
+                return []
+            df = df[(df.min_homeowner_id <= homeowner_ids.max()) & (df.max_homeowner_id >= homeowner_ids.min())]
+
+            keep = df.num_buckets.isnull()
+            for num_buckets in df.num_buckets.dropna().unique():
+                buckets = np.unique(homeowner_ids % int(num_buckets))
+                keep |= (df.num_buckets == num_buckets) & df.bucket.isin(buckets)
+            df = df[keep]
+
+        return [os.path.join(self.root, path) for path in df.path]
+
+    def read(self, conn, table_name, columns=None, homeowner_ids=None, starting=None, ending=None):
+        """
+        Reads rows of a table for some homes and dates into a frame.  Only the files that can
+        hold the rows are opened (see files), and row groups are skipped with their statistics.
+
+        Args:
+                     conn: A native connection to the local db (to read the manifest)
+               table_name: The table to read
+                  columns: The columns to read (default all)
+            homeowner_ids: Only read these homes (default all)
+                 starting: Only read rows on or after this date
+                   ending: Only read rows on or before this date
+        """
+        paths = self.files(conn, table_name, homeowner_ids, starting, ending)
+        if not paths:
+            return pd.DataFrame(columns=columns or [])
+
+        filters = []
+        if homeowner_ids is not None:
+            filters.append(ds.field('homeowner_id').isin(pa.array(list(homeowner_ids), type=pa.int64())))
+        if starting is not None:
+            filters.append(ds.field('date') >= pd.Timestamp(starting).to_pydatetime())
+        if ending is not None:
+            filters.append(ds.field('date') <= pd.Timestamp(ending).to_pydatetime())
+
+        expression = None
+        for condition in filters:
+            expression = condition if expression is None else expression & condition
+
+        dataset = ds.dataset(paths, format='parquet')
+        table = dataset.to_table(columns=columns, filter=expression)
+        return count_rows_read(table.to_pandas(date_as_object=False, coerce_temporal_nanoseconds=True))
+
+    def compact(self, conn, table_name, before_month):
+        """
+        Rewrites every partition of a month before before_month ('YYYY-MM') that has more than
+        one file into a single file.  Run this inside a transaction on conn.  The old files stay
+        on disk so readers of the old view aren't broken.  Returns their paths, to be removed
+        with remove_files once the transaction commits.
+        """
+        df = self.manifest(conn, table_name)
+        df = df[df.month < before_month]
+
+        replaced = []
+        for _, files in df.groupby(['month', df.bucket.fillna(-1)]):
+            if len(files) < 2:
+                continue
+
+            paths = [os.path.join(self.root, path) for path in files.path]
+            batch = ds.dataset(paths, format='parquet').to_table()
+            records = self.write_files(table_name, batch)
+            self._list_files(conn, records)
+            conn.execute(
+                f'DELETE FROM {PARQUET_FILE_TABLE_NAME} WHERE table_name = ? AND path IN (SELECT unnest(?))',
+                [table_name, list(files.path)]
+            )
+            replaced.extend(paths)
+
+        if replaced:
+            self.refresh_view(conn, table_name)
+        return replaced
+
+    def compact_types(self, conn, table_name):
+        """
+        Rewrites every file of a table written before the compact column types (see schemas),
+        so old and new files don't get mixed into the wider types by the table's view.  Run
+        this inside a transaction on conn.  Like compact, returns the paths of the old files,
+        to be removed with remove_files once the transaction commits.
+        """
+        replaced = []
+        for path in self.manifest(conn, table_name).path:
+            full_path = os.path.join(self.root, path)
+            batch = ds.dataset(full_path, format='parquet').to_table()
+            compacted = compact_arrow(table_name, batch)
+            # compact_arrow hands back the same table when every column already has its type
+            if compacted is batch:
+                continue
+
+            self._list_files(conn, self.write_files(table_name, compacted))
+            conn.execute(
+                f'DELETE FROM {PARQUET_FILE_TABLE_NAME} WHERE table_name = ? AND path = ?', [table_name, path])
+            replaced.append(full_path)
+
+        if replaced:
+            self.refresh_view(conn, table_name)
+        return replaced
+
+    def remove_files(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def vacuum(self, conn, table_name, min_age_seconds=VACUUM_MIN_AGE_SECONDS):
+        """
+        Removes the files of a table that aren't listed in the manifest (from crashed stages,
+        rolled back transactions, or compactions) once they are at least min_age_seconds old.
+        Returns the paths removed.
+        """
+        listed = {os.path.join(self.root, path) for path in self.manifest(conn, table_name).path}
+        cutoff = time.time() - min_age_seconds
+
+        removed = []
+        for dir_name, _, file_names in os.walk(os.path.join(self.root, table_name)):
+            for file_name in file_names:
+                path = os.path.join(dir_name, file_name)
+                if path not in listed and os.path.getmtime(path) <= cutoff:
+                    removed.append(path)
+        self.remove_files(removed)
+        return removed
+
+    def migrate(self, conn, table_name, chunk_days=31):
+        """
+        Moves a table from the local db into the store a date range at a time, then replaces it
+        with a view.  Run this inside a transaction on conn so the move is all or nothing.  Does
+        nothing if the table isn't in the local db.  Returns the number of rows moved.
+        """
+        if _relation_type(conn, table_name) != 'BASE TABLE':
+            return 0
+
+        first, last = conn.execute(f'SELECT min(date), max(date) FROM {table_name}').fetchone()
+        records = []
+        if first is not None:
+            for starting in pd.date_range(pd.Timestamp(first).floor('D'), last, freq=f'{chunk_days}D'):
+                ending = starting + pd.Timedelta(days=chunk_days)
+                batch = conn.execute(
+                    f'SELECT * FROM {table_name} WHERE date >= ? AND date < ?', [starting, ending]).arrow()
+                records.extend(self.write_files(table_name, batch))
+
+        conn.execute(f'DROP TABLE {table_name}')
+        self._list_files(conn, records)
+        self.refresh_view(conn, table_name)
+        return sum(record['num_rows'] for record in records)
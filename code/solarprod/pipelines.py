@@ -1,8 +1,12 @@
+import contextlib
+import os
+
 import easier as ezr
 import ibis
 ibis.options.sql.default_limit = None
 
 from .data_plumbing import (
+    maintain_tables,
     sync_homeowners,
     sync_prod_history,
     update_neighbors,
@@ -14,35 +18,130 @@ from .detector_lib import (
     Detector,
 )
 
-from .utils import logged
+from .ibis_tools import (
+    connection_session,
+    get_connection_open_counts,
+)
+
+from .constants import PROFILE_DIR
+
+from .metrics import (
+    format_summary,
+    metrics_run,
+)
+
+from .profiling import profiling
+
+from .scheduler import (
+    Stage,
+    StageGraph,
+)
 
 ezr.mute_warnings()
 
+# The detector stages in dependency order.  The homeowner branch and the production branch
+# are independent until detections are muted by neighbors.  Maintenance runs once every table
+# has been written.
+PIPELINE_STAGE_NAMES = [
+    'sync_homeowners',
+    'sync_prod_history',
+    'update_neighbors',
+    'update_nominal_prod',
+    'compute_raw_detections',
+    'compute_detections',
+    'push_detections',
+    'maintain_tables',
+]
 
-def run_detector_pipeline(memory_friendly=True, show_progress_bar=False):
+
+def detector_stage_graph(
+        memory_friendly=True,
+        show_progress_bar=False,
+        workers=1,
+        streaming=False,
+        sync_connections=0,
+        incremental_smoothing=False):
+    """
+    The dependency graph of the detector stages (see run_detector_pipeline for the arguments)
+    """
+    detector = Detector()
+    return StageGraph([
+        Stage('sync_homeowners', sync_homeowners),
+        Stage(
+            'sync_prod_history',
+            lambda: sync_prod_history(
+                show_progress_bar, memory_friendly, streaming=streaming, max_connections=sync_connections),
+        ),
+        Stage('update_neighbors', update_neighbors, depends_on=['sync_homeowners']),
+        Stage(
+            'update_nominal_prod',
+            lambda: NominalProd().update_nominal_prod(
+                show_progress_bar, workers=workers, incremental=incremental_smoothing),
+            depends_on=['sync_prod_history'],
+        ),
+        Stage('compute_raw_detections', detector.compute_raw_detections, depends_on=['update_nominal_prod']),
+        Stage(
+            'compute_detections',
+            detector.compute_detections,
+            depends_on=['compute_raw_detections', 'update_neighbors'],
+        ),
+        Stage('push_detections', push_detections, depends_on=['compute_detections']),
+        Stage('maintain_tables', maintain_tables, depends_on=['push_detections']),
+    ])
+
+
+def run_detector_pipeline(
+        memory_friendly=True,
+        show_progress_bar=False,
+        workers=1,
+        streaming=False,
+        sync_connections=0,
+        incremental_smoothing=False,
+        profile=False,
+        trace_allocations=False,
+        only=None,
+        skip=None,
+        start=None,
+        stage_workers=2):
     """
     Syncs all data required to look for detections.
     Computes detections.
     Pushes detections to destination
-    """
-    # with logged('sync_homeowners'):
-    #     sync_homeowners()
 
-    # with logged('sync_production'):
-    #     sync_prod_history(show_progress_bar, memory_friendly)
+    Args:
+          memory_friendly: Passed on to sync_prod_history
+        show_progress_bar: Show progress bars for the long running stages
+                  workers: The number of processes to use for smoothing nominal production
+                streaming: Stream production history over in date-range chunks (see sync_prod_history)
+         sync_connections: If greater than zero, sync production history in concurrent date partitions
+                           over this many production connections
+    incremental_smoothing: Advance nominal production from the smoother state saved by the last run
+                  profile: Write a cProfile and a sampled flamegraph profile of every stage to
+                           a directory named for the run under PROFILE_DIR (see profiling)
+        trace_allocations: Also trace memory allocations in every stage with tracemalloc (implies profile)
+                     only: Run only these stages (see PIPELINE_STAGE_NAMES)
+                     skip: Run every stage but these
+                    start: Run this stage and every stage downstream of it
+            stage_workers: The most independent stages to run at once.  With the default of 2, the
+                           homeowner sync and neighbor rebuild overlap the production history sync.
+
+    Every stage is measured and appended to the metrics file as a json line (see metrics).
+    """
+    graph = detector_stage_graph(
+        memory_friendly, show_progress_bar, workers, streaming, sync_connections, incremental_smoothing)
+    names = graph.select(only=only, skip=skip, start=start)
 
-    # with logged('update_neighbors'):
-    #     update_neighbors()
+    logger = ezr.get_logger('run_detector_pipeline')
+    logger.info(f'running stages: {names}')
 
-    # with logged('update_nominal_prod'):
-    #     NominalProd().update_nominal_prod(show_progress_bar)
+    # Every stage shares one set of long-lived connections and is measured as part of one run
+    with contextlib.ExitStack() as stack:
+        run = stack.enter_context(metrics_run())
+        if profile or trace_allocations:
+            stack.enter_context(profiling(os.path.join(PROFILE_DIR, run.run_id), trace_allocations))
+        stack.enter_context(connection_session())
 
-    # with logged('update_detections'):
-    #     (
-    #         Detector()
-    #         .compute_raw_detections(show_progress_bar)
-    #         .compute_detections()
-    #     )
+        graph.run(names, workers=stage_workers)
 
-    with logged('push_detections'):
-        push_detections()
+    logger.info(f'connections opened: {get_connection_open_counts()}')
+    logger.info(f'run {run.run_id} summary:\n{format_summary(run.summary())}')
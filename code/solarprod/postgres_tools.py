@@ -1,6 +1,8 @@
+import contextlib
 import os
 import easier as ezr
 import ibis
+import pandas as pd
 
 
 def get_postgres_creds(name):
@@ -43,6 +45,39 @@ def get_postgres_ibis_connection(name):
     return conn
 
 
+@contextlib.contextmanager
+def get_postgres_connection_pool(name, max_connections):
+    """
+    A manager that yields a thread-safe pool of at most max_connections raw psycopg2
+    connections.  All pooled connections are closed when the context exits.
+    """
+    from psycopg2.pool import ThreadedConnectionPool
+    pool = ThreadedConnectionPool(1, max_connections, **get_postgres_creds(name))
+    try:
+        yield pool
+    finally:
+        pool.closeall()
+
+
+def get_raw_history(pool, starting, ending, production_threshold):
+    """
+    Runs the bodi_get_raw_history() function installed by create_postgres_functions()
+    on a connection borrowed from the pool and returns the results as a dataframe.
+    """
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT homeowner_id, date, total_production FROM bodi_get_raw_history(%s, %s, %s)',
+                (starting, ending, production_threshold)
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+    return pd.DataFrame(rows, columns=['homeowner_id', 'date', 'total_production'])
+
+
 def create_postgres_functions():
     # Get a connection to the bodhi production db
     pg = get_postgres_query_obj('production')
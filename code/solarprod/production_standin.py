@@ -0,0 +1,141 @@
+import os
+import sqlite3
+
+import duckdb
+import ibis
+import pandas as pd
+
+# Point SOLARPROD_PRODUCTION_DB at a duckdb or sqlite file to use it in place of the production
+# postgres database.  It is read every time a production connection is opened.
+PRODUCTION_DB_ENV_VAR = 'SOLARPROD_PRODUCTION_DB'
+
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+# The parts of the production schema the detector touches
+PRODUCTION_SCHEMA = {
+    'homeowners': [
+        ('id', 'INTEGER'),
+        ('lat', 'DOUBLE'),
+        ('lng', 'DOUBLE'),
+        ('"isDisable"', 'BOOLEAN'),
+    ],
+    'history_report': [
+        ('"homeownerId"', 'INTEGER'),
+        ('date', 'DATE'),
+        ('"totalProduction"', 'DOUBLE'),
+    ],
+    'low_production_detection_events': [
+        ('homeowner_id', 'BIGINT'),
+        ('date', 'TIMESTAMP'),
+        ('total_production', 'DOUBLE'),
+        ('nominal_prod', 'DOUBLE'),
+        ('baseline_nominal_prod', 'DOUBLE'),
+        ('lag_days', 'BIGINT'),
+        ('detection_ratio', 'DOUBLE'),
+        ('num_detected_neighbors', 'BIGINT'),
+    ],
+}
+
+
+def get_production_standin():
+    """
+    Returns the file standing in for the production database, or None to use postgres
+    """
+    return os.environ.get(PRODUCTION_DB_ENV_VAR) or None
+
+
+def _is_sqlite(file_name):
+    return file_name.endswith(SQLITE_SUFFIXES)
+
+
+def get_standin_ibis_connection(file_name):
+    """
+    An ibis connection to a stand-in production file
+    """
+    if _is_sqlite(file_name):
+        return ibis.sqlite.connect(file_name)
+    return ibis.duckdb.connect(file_name)
+
+
+def _connect(file_name):
+    if _is_sqlite(file_name):
+        return sqlite3.connect(file_name)
+    return duckdb.connect(file_name)
+
+
+def create_production_standin(file_name, homeowners, history):
+    """
+    Creates a stand-in production database with the production schema and loads it.
+    An existing file is replaced.
+
+    Args:
+         file_name: A duckdb file (or sqlite for names ending in .sqlite, .sqlite3 or .db)
+        homeowners: A frame with columns homeowner_id, lat, lng
+           history: A frame with columns homeowner_id, date, total_production
+    """
+    if os.path.isfile(file_name):
+        os.unlink(file_name)
+
+    homeowners = pd.DataFrame({
+        'id': homeowners.homeowner_id.astype(int),
+        'lat': homeowners.lat,
+        'lng': homeowners.lng,
+        'isDisable': False,
+    })
+    history = pd.DataFrame({
+        'homeownerId': history.homeowner_id.astype(int),
+        'date': pd.to_datetime(history.date).dt.date,
+        'totalProduction': history.total_production,
+    })
+
+    conn = _connect(file_name)
+    try:
+        for table_name, columns in PRODUCTION_SCHEMA.items():
+            conn.execute(f'CREATE TABLE {table_name} ({", ".join(" ".join(col) for col in columns)})')
+
+        if _is_sqlite(file_name):
+            # sqlite has no date type, so dates are stored as iso strings
+            history['date'] = history.date.astype(str)
+            homeowners.to_sql('homeowners', conn, if_exists='append', index=False)
+            history.to_sql('history_report', conn, if_exists='append', index=False)
+            conn.commit()
+        else:
+            conn.register('_homeowners', homeowners)
+            conn.register('_history', history)
+            conn.execute('INSERT INTO homeowners BY NAME SELECT * FROM _homeowners')
+            conn.execute('INSERT INTO history_report BY NAME SELECT * FROM _history')
+    finally:
+        conn.close()
+
+
+def get_raw_history(file_name, starting, ending, production_threshold):
+    """
+    Does what the bodi_get_raw_history() postgres function does (see
+    postgres_tools.create_postgres_functions), but against a stand-in file.
+    """
+    query = """
+        SELECT
+            "homeownerId" AS homeowner_id,
+            date,
+            "totalProduction" AS total_production
+        FROM history_report
+        WHERE date >= ? AND date < ? AND "totalProduction" > ?
+        ORDER BY "homeownerId", date
+    """
+    params = [
+        pd.Timestamp(starting).date().isoformat(),
+        pd.Timestamp(ending).date().isoformat(),
+        production_threshold,
+    ]
+
+    conn = _connect(file_name)
+    try:
+        if _is_sqlite(file_name):
+            df = pd.read_sql_query(query, conn, params=params)
+        else:
+            df = conn.execute(query, params).df()
+    finally:
+        conn.close()
+
+    df['date'] = pd.to_datetime(df.date)
+    return df
@@ -0,0 +1,188 @@
+import collections
+import contextlib
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from .constants import PROFILE_DIR
+
+# How often the stacks of running threads are sampled for the collapsed-stack files
+STACK_SAMPLE_SECONDS = .005
+
+# Allocations are traced with this many frames of traceback, and the biggest this many
+# tracebacks of each stage are written out
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 50
+
+# Threads started by the instrumentation itself are never sampled
+_INSTRUMENTATION_THREAD_PREFIX = 'solarprod-'
+
+# A stack of active profilers.  Stages are profiled by the innermost one.
+_ACTIVE_PROFILERS = []
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}'
+
+
+class StackSampler:
+    def __init__(self, interval=STACK_SAMPLE_SECONDS):
+        """
+        One background thread that samples the stacks of the threads being profiled and counts
+        them in the collapsed-stack format read by flamegraph tools (one line per distinct
+        stack: frames from the root down separated by semicolons, then the sample count).
+        Each stack starts with the name of its thread.  Every profiled stage gets its own
+        counts of its own thread only, so stages running at once don't show up in each other's
+        profiles.  The thread only runs while there is something to sample.
+        """
+        self.interval = interval
+        self.samples = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, thread):
+        """
+        Starts sampling a thread.  Returns the counts to pass to remove().
+        """
+        counts = collections.Counter()
+        with self.lock:
+            self.samples.append((thread.ident, thread.name, counts))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name=f'{_INSTRUMENTATION_THREAD_PREFIX}stack-sampler', daemon=True)
+                self.thread.start()
+        return counts
+
+    def remove(self, counts):
+        """
+        Stops sampling for the counts returned by add().  No samples are added to them after this.
+        """
+        with self.lock:
+            self.samples = [sample for sample in self.samples if sample[2] is not counts]
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.samples:
+                    self.thread = None
+                    return
+
+                frames = sys._current_frames()
+                for ident, name, counts in self.samples:
+                    frame = frames.get(ident)
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    if labels:
+                        counts[';'.join([name] + labels[::-1])] += 1
+            time.sleep(self.interval)
+
+
+def _write_collapsed(counts, file_name):
+    with open(file_name, 'w') as buff:
+        for stack, count in counts.most_common():
+            buff.write(f'{stack} {count}\n')
+
+
+class Profiler:
+    def __init__(self, profile_dir, trace_allocations=False):
+        """
+        Profiles pipeline stages into a directory.  Every stage gets a cProfile .pstats file
+        and a .collapsed file of sampled stacks for flamegraphs.  Both only cover the thread
+        the stage runs on: threads and worker processes the stage starts aren't profiled.
+        With trace_allocations, it also gets an .allocations.txt file listing the tracebacks
+        that allocated the most memory during the stage (tracemalloc slows everything down,
+        so this is off by default).
+
+        Args:
+                   profile_dir: The directory to write the profiles to
+             trace_allocations: Trace memory allocations with tracemalloc
+        """
+        self.profile_dir = profile_dir
+        self.trace_allocations = trace_allocations
+        self.file_counts = collections.Counter()
+        self.sampler = StackSampler()
+        self.lock = threading.Lock()
+
+    def _path(self, stage, suffix):
+        """
+        A file name for the stage's profile.  A stage profiled again gets numbered files.
+        """
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', stage)
+        with self.lock:
+            self.file_counts[(name, suffix)] += 1
+            num = self.file_counts[(name, suffix)]
+        if num > 1:
+            name = f'{name}.{num}'
+        return os.path.join(self.profile_dir, f'{name}{suffix}')
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        A manager that profiles everything the current thread runs inside of it
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        snapshot = tracemalloc.take_snapshot() if self.trace_allocations else None
+        profile = cProfile.Profile()
+
+        counts = self.sampler.add(threading.current_thread())
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.sampler.remove(counts)
+            profile.dump_stats(self._path(stage, '.pstats'))
+            _write_collapsed(counts, self._path(stage, '.collapsed'))
+            if snapshot is not None:
+                self._write_allocations(stage, snapshot)
+
+    def _write_allocations(self, stage, before):
+        after = tracemalloc.take_snapshot()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        stats = after.compare_to(before, 'traceback')
+        with open(self._path(stage, '.allocations.txt'), 'w') as buff:
+            buff.write(f'# {stage}: peak traced memory {peak_bytes / 2 ** 20:.1f} MB\n')
+            for stat in stats[:TRACEMALLOC_TOP]:
+                buff.write(f'\n{stat.size_diff / 2 ** 20:.2f} MB in {stat.count_diff} new blocks\n')
+                for line in stat.traceback.format():
+                    buff.write(f'{line}\n')
+
+
+@contextlib.contextmanager
+def profiling(profile_dir=PROFILE_DIR, trace_allocations=False):
+    """
+    A manager that profiles every stage run inside of it (see profiled) into profile_dir.
+    Yields the Profiler.
+    """
+    started_tracing = trace_allocations and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    profiler = Profiler(profile_dir, trace_allocations)
+    _ACTIVE_PROFILERS.append(profiler)
+    try:
+        yield profiler
+    finally:
+        _ACTIVE_PROFILERS.remove(profiler)
+        if started_tracing:
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def profiled(stage):
+    """
+    A manager that profiles a stage if profiling() is active, and does nothing otherwise
+    """
+    if not _ACTIVE_PROFILERS:
+        yield
+        return
+
+    with _ACTIVE_PROFILERS[-1].stage(stage):
+        yield
@@ -0,0 +1,261 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+
+from .benchmark import (
+    make_homeowners,
+    make_production,
+)
+
+from .constants import (
+    HOMEOWNER_TABLE_NAME,
+    NEIGHBOR_TABLE_NAME,
+    NOMINAL_PROD_TABLE_NAME,
+    RAW_DETECTION_TABLE_NAME,
+    DETECTION_TABLE_NAME,
+    PRODUCTION_CONN_NAME,
+)
+
+from .metrics import measured
+
+from .duckdb_tools import (
+    get_duckdb_connection,
+    table_exists,
+)
+
+from .production_standin import (
+    PRODUCTION_DB_ENV_VAR,
+    create_production_standin,
+)
+
+# The table each nightly stage writes to.  push_detections writes to the production stand-in.
+# maintain_tables only reorders tables in place, so it is counted against production history.
+REPLAY_OUTPUT_TABLES = {
+    'sync_homeowners': HOMEOWNER_TABLE_NAME,
+    'sync_prod_history': 'prod_history',
+    'update_neighbors': NEIGHBOR_TABLE_NAME,
+    'update_nominal_prod': NOMINAL_PROD_TABLE_NAME,
+    'compute_raw_detections': RAW_DETECTION_TABLE_NAME,
+    'compute_detections': DETECTION_TABLE_NAME,
+    'push_detections': 'low_production_detection_events',
+    'maintain_tables': 'prod_history',
+}
+
+
+def replay_dates(first_night, num_nights, history_days):
+    """
+    The days of production a replay needs.  The first night sees history_days days of
+    history and every later night sees one more.
+    """
+    first_night = pd.Timestamp(first_night).floor('D')
+    return pd.date_range(
+        first_night - pd.Timedelta(days=history_days),
+        first_night + pd.Timedelta(days=num_nights - 2),
+    )
+
+
+def make_replay_production(file_name, num_homes, first_night, num_nights, history_days, seed=0, chunk_size=5000):
+    """
+    Writes a stand-in production database holding a synthetic fleet (see benchmark) with
+    production for every night of the replay.  Each night only syncs the days before it,
+    since sync_prod_history never reads past yesterday.
+    """
+    dates = replay_dates(first_night, num_nights, history_days)
+    homeowners = make_homeowners(num_homes, seed)
+
+    # Production is made a chunk of homes at a time to bound memory
+    history = pd.concat([
+        make_production(homeowners.iloc[start: start + chunk_size], dates, seed=seed + num + 1)[0]
+        for num, start in enumerate(range(0, num_homes, chunk_size))
+    ], ignore_index=True)
+
+    create_production_standin(file_name, homeowners, history)
+    return {'num_homes': num_homes, 'num_days': len(dates), 'num_rows': len(history)}
+
+
+def _count_rows(stage):
+    """
+    The rows in the table a stage writes to (zero if it doesn't exist yet)
+    """
+    from .ibis_tools import get_connections
+
+    table_name = REPLAY_OUTPUT_TABLES[stage]
+    if stage == 'push_detections':
+        with get_connections(PRODUCTION_CONN_NAME) as conn:
+            return int(conn.table(table_name).count().execute())
+
+    conn = get_duckdb_connection()
+    try:
+        if not table_exists(conn, table_name):
+            return 0
+        return conn.execute(f'SELECT count(*) FROM {table_name}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def replay_nights(
+        first_night,
+        num_nights,
+        workers=1,
+        streaming=True,
+        sync_connections=0,
+        incremental_smoothing=False,
+        engine='sql'):
+    """
+    Runs the nightly detector stages once for each of num_nights consecutive days, with the
+    clock set to each day in turn (see data_plumbing.pretend_today).  The stages are the ones
+    run_detector_pipeline runs, called one by one so each can be timed.  Production must be a
+    stand-in (see production_standin) so nothing here touches the real production database.
+    Returns a frame with one row per (night, stage).
+
+    Args:
+                  first_night: The "today" of the first run
+                   num_nights: The number of consecutive nightly runs
+                      workers: Passed on to NominalProd.update_nominal_prod
+                    streaming: Passed on to sync_prod_history
+             sync_connections: Passed on to sync_prod_history as max_connections
+        incremental_smoothing: Passed on to NominalProd.update_nominal_prod as incremental
+                       engine: Passed on to Detector.compute_detections
+    """
+    # Imported here so the data generators can be used without the detector's dependencies
+    from .data_plumbing import (
+        maintain_tables,
+        pretend_today,
+        push_detections,
+        sync_homeowners,
+        sync_prod_history,
+        update_neighbors,
+    )
+    from .detector_lib import Detector, NominalProd
+    from .ibis_tools import connection_session
+    from .production_standin import get_production_standin
+
+    if get_production_standin() is None:
+        raise ValueError(f'Set {PRODUCTION_DB_ENV_VAR} to a stand-in production database before replaying')
+
+    detector = Detector()
+    stages = [
+        ('sync_homeowners', sync_homeowners),
+        (
+            'sync_prod_history',
+            lambda: sync_prod_history(streaming=streaming, max_connections=sync_connections),
+        ),
+        ('update_neighbors', update_neighbors),
+        (
+            'update_nominal_prod',
+            lambda: NominalProd().update_nominal_prod(workers=workers, incremental=incremental_smoothing),
+        ),
+        ('compute_raw_detections', detector.compute_raw_detections),
+        ('compute_detections', lambda: detector.compute_detections(engine=engine)),
+        ('push_detections', push_detections),
+        ('maintain_tables', maintain_tables),
+    ]
+
+    rows = []
+    for night in pd.date_range(pd.Timestamp(first_night).floor('D'), periods=num_nights):
+        with pretend_today(night), connection_session():
+            for stage, func in stages:
+                rows_before = _count_rows(stage)
+                with measured(stage) as measurement:
+                    func()
+                rows_after = _count_rows(stage)
+                rows.append({
+                    'night': night,
+                    'stage': stage,
+                    'seconds': measurement.wall_seconds,
+                    'cpu_seconds': measurement.cpu_seconds,
+                    'rows_read': measurement.rows_read,
+                    'rows_written': measurement.rows_written,
+                    'round_trips': measurement.round_trips,
+                    'num_rows': rows_after,
+                    'rows_added': rows_after - rows_before,
+                    'peak_rss_mb': measurement.peak_rss_bytes / 2 ** 20,
+                })
+    return pd.DataFrame(rows)
+
+
+def run_replay(
+        num_homes,
+        num_nights,
+        history_days=180,
+        first_night=None,
+        backend='duckdb',
+        seed=0,
+        workers=1,
+        sync_connections=0,
+        incremental_smoothing=False,
+        engine='sql',
+        db_dir=None):
+    """
+    Replays consecutive nightly runs of the whole detector pipeline against a synthetic fleet,
+    without touching the real production database.  A stand-in production database is
+    written to a scratch directory and a fresh local database is built up one night at a
+    time, so the first night is a full backfill and every later night takes the incremental
+    path.  The replay runs in its own process pointed at the scratch databases (through
+    SOLARPROD_LOCAL_DB and SOLARPROD_PRODUCTION_DB).  Returns a frame with one row per
+    (night, stage).
+
+    Args:
+                    num_homes: The number of homes in the synthetic fleet
+                   num_nights: The number of consecutive nightly runs
+                 history_days: The days of production history before the first night
+                  first_night: The "today" of the first run (defaults to num_nights days ago)
+                      backend: The stand-in production database.  One of 'duckdb' or 'sqlite'.
+                         seed: Seed for the synthetic fleet
+                      workers: See replay_nights
+             sync_connections: See replay_nights
+        incremental_smoothing: See replay_nights
+                       engine: See replay_nights
+                       db_dir: Where to put the scratch databases (a temp dir that is removed afterwards by default)
+    """
+    if backend not in ('duckdb', 'sqlite'):
+        raise ValueError("backend must be one of ['duckdb', 'sqlite']")
+
+    if first_night is None:
+        first_night = pd.Timestamp.now().floor('D') - pd.Timedelta(days=num_nights)
+    first_night = pd.Timestamp(first_night).floor('D')
+
+    with tempfile.TemporaryDirectory(dir=db_dir) as tmp_dir:
+        production_file = os.path.join(tmp_dir, 'production.ddb' if backend == 'duckdb' else 'production.sqlite')
+        make_replay_production(production_file, num_homes, first_night, num_nights, history_days, seed)
+
+        env = dict(
+            os.environ,
+            SOLARPROD_LOCAL_DB=os.path.join(tmp_dir, 'replay.ddb'),
+            **{PRODUCTION_DB_ENV_VAR: production_file},
+        )
+        command = [
+            sys.executable, '-m', 'solarprod.replay',
+            str(first_night.date()), str(num_nights), str(workers), str(sync_connections),
+            str(int(incremental_smoothing)), engine,
+        ]
+        # Only the results are captured.  Logs and any traceback go straight to stderr.
+        output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+    df = pd.DataFrame(json.loads(output.strip().splitlines()[-1]))
+    df['night'] = pd.to_datetime(df.night, unit='ms')
+    return df
+
+
+def format_report(df):
+    """
+    Formats replay results as a table with a row per night and a column per stage
+    """
+    table = df.pivot(index='night', columns='stage', values='seconds')
+    table = table[[stage for stage in REPLAY_OUTPUT_TABLES if stage in table.columns]]
+    table['total'] = table.sum(axis=1)
+    table.index = table.index.date
+    return table.round(2).to_string()
+
+
+if __name__ == '__main__':
+    # Replays the nights against the databases in the environment and prints the results as json
+    first_night, num_nights, workers, sync_connections, incremental_smoothing, engine = sys.argv[1:]
+    results = replay_nights(
+        first_night, int(num_nights), workers=int(workers), sync_connections=int(sync_connections),
+        incremental_smoothing=bool(int(incremental_smoothing)), engine=engine)
+    print(results.to_json(orient='records'))
@@ -0,0 +1,148 @@
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import easier as ezr
+
+from .utils import logged
+
+
+class Stage:
+    def __init__(self, name, func, depends_on=()):
+        """
+        A pipeline stage
+
+        Args:
+                  name: The name of the stage
+                  func: A callable run with no arguments
+            depends_on: The names of the stages that must finish before this one starts
+        """
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, depends_on={self.depends_on!r})'
+
+
+class StageGraph:
+    def __init__(self, stages):
+        """
+        A dependency graph of stages that runs independent branches concurrently
+
+        Args:
+            stages: A list of Stage objects
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError('stage names must be unique')
+
+        for stage in stages:
+            unknown = set(stage.depends_on) - set(self.stages)
+            if unknown:
+                raise ValueError(f'{stage.name} depends on unknown stages {sorted(unknown)}')
+
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        """
+        Stage names ordered so every stage comes after its dependencies.  Ties keep the order
+        the stages were given in.
+        """
+        order, remaining = [], dict(self.stages)
+        while remaining:
+            ready = [name for name, stage in remaining.items() if set(stage.depends_on) <= set(order)]
+            if not ready:
+                raise ValueError(f'stages have a dependency cycle among {sorted(remaining)}')
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+        return order
+
+    def descendants(self, name):
+        """
+        The names of every stage that depends on the named stage, directly or not
+        """
+        found = set()
+        for other in self.order:
+            if name in self.stages[other].depends_on or found & set(self.stages[other].depends_on):
+                found.add(other)
+        return found
+
+    def select(self, only=None, skip=None, start=None):
+        """
+        Returns the names of the stages to run in dependency order.  Stages that aren't selected
+        are assumed to be done already.
+
+        Args:
+             only: Run only these stages
+             skip: Run everything but these stages
+            start: Run this stage and everything downstream of it
+        """
+        for names in [only or [], skip or [], [start] if start else []]:
+            unknown = set(names) - set(self.stages)
+            if unknown:
+                raise ValueError(f'unknown stages {sorted(unknown)}.  Must be in {self.order}')
+
+        selected = set(self.order)
+        if start:
+            selected &= {start} | self.descendants(start)
+        if only:
+            selected &= set(only)
+        if skip:
+            selected -= set(skip)
+        return [name for name in self.order if name in selected]
+
+    def run(self, names=None, workers=1):
+        """
+        Runs stages as soon as the stages they depend on finish, with up to workers stages at
+        once.  Each stage runs inside logged() in a copy of the caller's context, so it is measured
+        (and profiled) on its own.  If a stage fails, no new stages are started, the running ones
+        are allowed to finish, and the first error is raised.  Returns the names of the stages
+        run, in the order they finished.
+
+        Args:
+              names: The stages to run (see select).  Defaults to all of them.
+            workers: The most stages to run at once
+        """
+        names = self.order if names is None else names
+        waiting_on = {name: set(self.stages[name].depends_on) & set(names) for name in names}
+        finished, errors = [], {}
+        logger = ezr.get_logger('stage_graph')
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            running = {}
+            while waiting_on or running:
+                if not errors:
+                    for name in [name for name in names if name in waiting_on and not waiting_on[name]]:
+                        del waiting_on[name]
+                        future = executor.submit(contextvars.copy_context().run, self._run_stage, name)
+                        running[future] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        errors[name] = future.exception()
+                        continue
+                    finished.append(name)
+                    for dependencies in waiting_on.values():
+                        dependencies.discard(name)
+
+        if errors:
+            logger.error(f'failed stages: {sorted(errors)}, not run: {sorted(waiting_on)}')
+            raise next(iter(errors.values()))
+        return finished
+
+    def _run_stage(self, name):
+        # Name the thread after the stage so sampled stacks show which stage they came from
+        thread = threading.current_thread()
+        thread_name, thread.name = thread.name, f'stage-{name}'
+        try:
+            with logged(name):
+                self.stages[name].func()
+        finally:
+            thread.name = thread_name
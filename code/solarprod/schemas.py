@@ -0,0 +1,95 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .constants import (
+    NOMINAL_PROD_STATE_TABLE_NAME,
+    NOMINAL_PROD_TABLE_NAME,
+    RAW_DETECTION_TABLE_NAME,
+)
+
+# Compact column types for the big date-indexed tables.  Homeowner ids fit in 32 bits, every
+# row is a whole day, and daily production (tens of kWh) keeps about 7 significant digits in a
+# 32 bit float.  Columns not listed keep whatever type they are written with.
+COMPACT_SCHEMAS = {
+    'prod_history': {
+        'homeowner_id': 'INTEGER',
+        'date': 'DATE',
+        'total_production': 'FLOAT',
+    },
+    NOMINAL_PROD_TABLE_NAME: {
+        'homeowner_id': 'INTEGER',
+        'date': 'DATE',
+        'total_production': 'FLOAT',
+        'nominal_prod': 'FLOAT',
+        'baseline_nominal_prod': 'FLOAT',
+    },
+    RAW_DETECTION_TABLE_NAME: {
+        'homeowner_id': 'INTEGER',
+        'date': 'DATE',
+        'total_production': 'FLOAT',
+        'nominal_prod': 'FLOAT',
+        'baseline_nominal_prod': 'FLOAT',
+    },
+}
+
+# List columns holding values read from a compact column.  Their elements are rounded to the
+# same type when a local db is migrated (see duckdb_tools.compact_local_db), so they still match
+# the column they were read from, but the lists keep their type.
+COMPACT_LIST_SCHEMAS = {
+    NOMINAL_PROD_STATE_TABLE_NAME: {
+        'production': 'FLOAT',
+    },
+}
+
+_ARROW_TYPES = {
+    'INTEGER': pa.int32(),
+    'DATE': pa.date32(),
+    'FLOAT': pa.float32(),
+}
+
+# Pandas has no day type, so dates stay datetime64 in frames
+_PANDAS_DTYPES = {
+    'INTEGER': 'int32',
+    'FLOAT': 'float32',
+}
+
+
+def compact_frame(table_name, df):
+    """
+    Casts the columns of a frame bound for a table to their compact types.  Returns a new frame.
+    """
+    schema = COMPACT_SCHEMAS.get(table_name, {})
+    dtypes = {col: _PANDAS_DTYPES[schema[col]] for col in df.columns if schema.get(col) in _PANDAS_DTYPES}
+    for col, dtype in dtypes.items():
+        if dtype == 'int32' and len(df) and np.abs(df[col]).max() > np.iinfo('int32').max:
+            raise ValueError(f'{table_name}.{col} has values too big for a 32 bit integer')
+    return df.astype(dtypes) if dtypes else df
+
+
+def compact_arrow(table_name, batch):
+    """
+    Casts the columns of an arrow table bound for a table to their compact types
+    """
+    for col, sql_type in COMPACT_SCHEMAS.get(table_name, {}).items():
+        if col in batch.column_names and batch.schema.field(col).type != _ARROW_TYPES[sql_type]:
+            batch = batch.set_column(
+                batch.schema.get_field_index(col), col, pc.cast(batch[col], _ARROW_TYPES[sql_type]))
+    return batch
+
+
+def compact_select(table_name, columns):
+    """
+    A sql select list for columns bound for a table, with the compact columns cast and the
+    elements of the compact list columns rounded
+    """
+    schema = COMPACT_SCHEMAS.get(table_name, {})
+    list_schema = COMPACT_LIST_SCHEMAS.get(table_name, {})
+
+    def select(col):
+        if col in schema:
+            return f'CAST({col} AS {schema[col]}) AS {col}'
+        if col in list_schema:
+            return f'list_transform({col}, x -> CAST(x AS {list_schema[col]})) AS {col}'
+        return col
+    return ', '.join(select(col) for col in columns)
@@ -1,13 +1,133 @@
 import os
 import click
-from .pipelines import run_detector_pipeline
-from .constants import VALID_CONNECTION_NAMES
+from .pipelines import PIPELINE_STAGE_NAMES, run_detector_pipeline
+from .constants import CLUSTER_MAX_UNCLUSTERED_FRACTION, VALID_CONNECTION_NAMES
 
 @click.command()
 @click.option('--ram-friendly/--ram-hostile', default=True, help='ram-hostile will load entire history table into ram (default friendly')
 @click.option('--progress-bar/--no-progress-bar', default=False, help='Show progress bar (default no bar)')
-def find_detections(ram_friendly, progress_bar):
-    run_detector_pipeline(ram_friendly, show_progress_bar=progress_bar)
+@click.option(
+    '--workers', default=1, type=click.IntRange(min=1),
+    help='Processes to use for smoothing in update_nominal_prod (default 1)')
+@click.option(
+    '--streaming', is_flag=True, default=False,
+    help='Stream production history in date-range chunks (default off)')
+@click.option(
+    '--sync-connections', default=0, type=click.IntRange(min=0),
+    help='Sync production history in parallel date partitions over this many connections (default 0, off)')
+@click.option(
+    '--incremental-smoothing', is_flag=True, default=False,
+    help='Advance nominal production from saved smoother state (default off)')
+@click.option(
+    '--profile', is_flag=True, default=False,
+    help=(
+        'Write .pstats and collapsed-stack profiles of every stage to /detector_data/profiles.  Only the '
+        "thread running each stage is profiled, so with --workers > 1 update_nominal_prod's smoothing, "
+        'which runs in worker processes, is left out (default off)'))
+@click.option(
+    '--trace-allocations', is_flag=True, default=False,
+    help='Also trace memory allocations of every stage with tracemalloc, implies --profile (default off)')
+@click.option(
+    '--only', multiple=True, type=click.Choice(PIPELINE_STAGE_NAMES),
+    help='Run only this stage (repeat for several)')
+@click.option(
+    '--skip', multiple=True, type=click.Choice(PIPELINE_STAGE_NAMES),
+    help='Skip this stage (repeat for several)')
+@click.option(
+    '--from', 'start', default=None, type=click.Choice(PIPELINE_STAGE_NAMES),
+    help='Run this stage and every stage downstream of it')
+@click.option(
+    '--stage-workers', default=2, type=click.IntRange(min=1),
+    help='Independent stages to run at once (default 2)')
+def find_detections(
+        ram_friendly, progress_bar, workers, streaming, sync_connections, incremental_smoothing, profile,
+        trace_allocations, only, skip, start, stage_workers):
+    run_detector_pipeline(
+        ram_friendly,
+        show_progress_bar=progress_bar,
+        workers=workers,
+        streaming=streaming,
+        sync_connections=sync_connections,
+        incremental_smoothing=incremental_smoothing,
+        profile=profile,
+        trace_allocations=trace_allocations,
+        only=only,
+        skip=skip,
+        start=start,
+        stage_workers=stage_workers,
+    )
+
+
+@click.command()
+@click.option(
+    '--homes', 'sizes', multiple=True, type=int, default=[1_000, 10_000, 100_000],
+    help='Fleet size to benchmark (repeat for several, default 1k, 10k and 100k)')
+@click.option('--days', default=180, type=click.IntRange(min=60), help='Days of production history (default 180)')
+@click.option(
+    '--workers', default=1, type=click.IntRange(min=1),
+    help='Processes to use for update_nominal_prod (default 1)')
+@click.option('--engine', default='sql', type=click.Choice(['sql', 'sparse']), help='Muting engine (default sql)')
+@click.option('--db-dir', default=None, help='Directory for the scratch databases (default a temp dir)')
+@click.option(
+    '--lookups', is_flag=True, default=False,
+    help='Benchmark per-home lookups before and after ordering the tables by home instead of the stages')
+def benchmark(sizes, days, workers, engine, db_dir, lookups):
+    from .benchmark import format_lookup_report, format_report, run_benchmarks, run_lookup_benchmarks
+    if lookups:
+        print(format_lookup_report(run_lookup_benchmarks(sizes, num_days=days, db_dir=db_dir)))
+        return
+    results = run_benchmarks(sizes, num_days=days, workers=workers, engine=engine, db_dir=db_dir)
+    print(format_report(results))
+
+
+@click.command()
+@click.option('--homes', default=1_000, type=click.IntRange(min=1), help='Homes in the synthetic fleet (default 1000)')
+@click.option('--nights', default=7, type=click.IntRange(min=1), help='Consecutive nightly runs to replay (default 7)')
+@click.option(
+    '--history-days', default=180, type=click.IntRange(min=60),
+    help='Days of history before the first night (default 180)')
+@click.option(
+    '--backend', default='duckdb', type=click.Choice(['duckdb', 'sqlite']),
+    help='Stand-in production database (default duckdb)')
+@click.option(
+    '--workers', default=1, type=click.IntRange(min=1),
+    help='Processes to use for update_nominal_prod (default 1)')
+@click.option(
+    '--sync-connections', default=0, type=click.IntRange(min=0),
+    help='Sync production history in parallel date partitions over this many connections (default 0, off)')
+@click.option(
+    '--incremental-smoothing', is_flag=True, default=False,
+    help='Advance nominal production from saved smoother state (default off)')
+@click.option('--engine', default='sql', type=click.Choice(['sql', 'sparse']), help='Muting engine (default sql)')
+@click.option('--db-dir', default=None, help='Directory for the scratch databases (default a temp dir)')
+def replay(homes, nights, history_days, backend, workers, sync_connections, incremental_smoothing, engine, db_dir):
+    from .replay import format_report, run_replay
+    results = run_replay(
+        homes, nights, history_days=history_days, backend=backend, workers=workers,
+        sync_connections=sync_connections, incremental_smoothing=incremental_smoothing, engine=engine,
+        db_dir=db_dir)
+    print(format_report(results))
+
+
+@click.command()
+@click.option('--migrate', is_flag=True, default=False, help='Move tables still in the local db into the parquet store')
+@click.option('--vacuum', is_flag=True, default=False, help='Remove parquet files no committed run refers to')
+@click.option(
+    '--recluster', is_flag=True, default=False,
+    help='Reorder the per-home lookup tables even if only a few rows are out of order')
+@click.option(
+    '--compact-types', is_flag=True, default=False,
+    help=(
+        'One-time rewrite of a local db and its parquet store from before the compact column types '
+        '(nothing else may have them open)'))
+def maintain(migrate, vacuum, recluster, compact_types):
+    from .data_plumbing import cluster_tables, maintain_parquet_store
+    if compact_types:
+        from .duckdb_tools import compact_local_db
+        old_size, new_size = compact_local_db()
+        print(f'local db went from {old_size / 2 ** 20:.1f} MB to {new_size / 2 ** 20:.1f} MB')
+    cluster_tables(max_unclustered_fraction=0 if recluster else CLUSTER_MAX_UNCLUSTERED_FRACTION)
+    maintain_parquet_store(migrate=migrate, vacuum=vacuum)
 
 
 # if __name__ == '__main__':
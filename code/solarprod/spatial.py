@@ -0,0 +1,211 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from .constants import (
+    MIN_NEIGHBOR_MILES,
+    MAX_NEIGHBOR_MILES,
+    MAX_NEIGHBORS,
+    R_EARTH_MILES,
+)
+
+NEIGHBOR_COLUMNS = ['homeowner_id1', 'homeowner_id2', 'distance_miles']
+
+
+def _to_radians(homeowners):
+    # Same arithmetic as the sql neighbor builder so distances agree to the last bit
+    lat = homeowners.lat.to_numpy(dtype=float) * np.pi / 180
+    lng = homeowners.lng.to_numpy(dtype=float) * np.pi / 180
+    return lat, lng
+
+
+def _nearest_in_band(ids1, lat1, lng1, ids2, lat2, lng2, min_miles, max_miles, max_neighbors):
+    """
+    Given parallel arrays describing candidate (home1, home2) pairs, compute distances, keep
+    pairs in the distance band and return the max_neighbors closest home2s for each home1.
+    """
+    distance = _exact_distances(lat1, lng1, lat2, lng2)
+
+    # A home can't be its own neighbor, and only homes in the distance band are eligible
+    keep = (ids1 != ids2) & (distance >= min_miles) & (distance <= max_miles)
+    ids1, ids2, distance = ids1[keep], ids2[keep], distance[keep]
+
+    # Order by home, then distance (ties broken by neighbor id so results are deterministic)
+    order = np.lexsort((ids2, distance, ids1))
+    ids1, ids2, distance = ids1[order], ids2[order], distance[order]
+
+    # The rank of each neighbor within its home's group
+    is_group_start = np.r_[True, ids1[1:] != ids1[:-1]] if len(ids1) else np.zeros(0, dtype=bool)
+    group_start = np.maximum.accumulate(np.where(is_group_start, np.arange(len(ids1)), 0))
+    rank = np.arange(len(ids1)) - group_start
+
+    keep = rank < max_neighbors
+    return pd.DataFrame({
+        'homeowner_id1': ids1[keep],
+        'homeowner_id2': ids2[keep],
+        'distance_miles': distance[keep],
+    })
+
+
+def _exact_distances(lat1, lng1, lat2, lng2):
+    # Approximate dx, dy distances in miles (the same formula used by the sql builder)
+    dy = R_EARTH_MILES * (lat2 - lat1)
+    dx = R_EARTH_MILES * np.cos(lat1) * (lng2 - lng1)
+    return np.sqrt(dx ** 2 + dy ** 2)
+
+
+def _neighbors_for_chunk(chunk, band, ids, lat, lng, min_miles, max_miles, max_neighbors):
+    """
+    Finds neighbors for a chunk of homes with similar latitudes among the homes in its band
+    (every home close enough in latitude to be within max_miles of one in the chunk).
+
+    Exact distances scale the lng difference by cos(lat1), which differs for every home, so
+    the tree is built on coordinates scaled by c0 = cos(the chunk's mean latitude).  For a home
+    at lat1 the tree distance d0 and the exact distance d then satisfy
+        d0 <= d * max(1, c0 / cos(lat1))     and     d <= d0 * max(1, cos(lat1) / c0)
+    Each home asks the tree for its k nearest homes and keeps doubling k until no home the
+    tree has not returned could possibly beat its max_neighbors-th closest eligible neighbor.
+    """
+    num_homes = len(band)
+    cos_lat = np.cos(lat)
+    c0 = np.cos(lat[chunk].mean())
+    tree = cKDTree(np.column_stack([R_EARTH_MILES * lat[band], R_EARTH_MILES * c0 * lng[band]]))
+
+    # Bounds relating tree distances to exact distances for each home in the chunk
+    a = np.maximum(1, c0 / cos_lat[chunk])
+    b = np.maximum(1, cos_lat[chunk] / c0)
+
+    # No home beyond this tree distance can be within max_miles of any home in the chunk
+    upper_bound = (1 + 1e-9) * max_miles * a.max()
+
+    frames = []
+    pending = np.arange(len(chunk))
+    k = min(max_neighbors + 16, num_homes)
+    while len(pending):
+        pos1 = chunk[pending]
+        points = np.column_stack([R_EARTH_MILES * lat[pos1], R_EARTH_MILES * c0 * lng[pos1]])
+        d0, found_at = tree.query(points, k=k, distance_upper_bound=upper_bound)
+        d0, found_at = d0.reshape(len(pos1), k), found_at.reshape(len(pos1), k)
+
+        # Exact distances of the eligible homes returned by the tree (inf for everything else)
+        found = found_at < num_homes
+        pos2 = band[np.where(found, found_at, 0)]
+        pos1_wide = np.broadcast_to(pos1[:, None], pos2.shape)
+        distance = _exact_distances(lat[pos1_wide], lng[pos1_wide], lat[pos2], lng[pos2])
+        eligible = found & (ids[pos2] != ids[pos1_wide]) & (distance >= min_miles) & (distance <= max_miles)
+        distance = np.where(eligible, distance, np.inf)
+
+        # The max_neighbors-th smallest eligible distance for each home
+        if max_neighbors <= k:
+            kth_distance = np.partition(distance, max_neighbors - 1, axis=1)[:, max_neighbors - 1]
+        else:
+            kth_distance = np.full(len(pos1), np.inf)
+
+        # A home is done if the tree ran out of homes within the upper bound, or if every home
+        # the tree didn't return is further away than its max_neighbors-th closest neighbor
+        is_done = ~found[:, -1] | (k >= num_homes) | (kth_distance < d0[:, -1] / b[pending])
+
+        rows, cols = np.nonzero(eligible & is_done[:, None])
+        frames.append(_nearest_in_band(
+            ids[pos1[rows]], lat[pos1[rows]], lng[pos1[rows]],
+            ids[pos2[rows, cols]], lat[pos2[rows, cols]], lng[pos2[rows, cols]],
+            min_miles, max_miles, max_neighbors
+        ))
+
+        pending = pending[~is_done]
+        k = min(2 * k, num_homes)
+
+    return frames
+
+
+def compute_neighbors(
+        homeowners,
+        homeowner_ids=None,
+        min_miles=MIN_NEIGHBOR_MILES,
+        max_miles=MAX_NEIGHBOR_MILES,
+        max_neighbors=MAX_NEIGHBORS,
+        chunk_size=2000):
+    """
+    Computes the neighbors table from a frame of homeowners using k-nearest neighbor searches
+    on a kd-tree instead of a cross join.  Results match the sql neighbor builder in
+    data_plumbing.update_neighbors (with ties in distance broken by homeowner_id2).
+
+    Args:
+           homeowners: A frame with columns homeowner_id, lat, lng (in degrees)
+        homeowner_ids: If supplied, only compute neighbors for these homes (all homes are
+                       still eligible to be neighbors)
+            min_miles: Neighbors closer than this are ignored (these are usually duplicate homes)
+            max_miles: Neighbors further than this are ignored
+        max_neighbors: Keep at most this many of the closest neighbors for each home
+           chunk_size: The number of homes looked up at once.  This bounds memory.
+    """
+    ids = homeowners.homeowner_id.to_numpy()
+    lat, lng = _to_radians(homeowners)
+
+    # Positions of the homes we want neighbors for
+    if homeowner_ids is None:
+        positions = np.arange(len(ids))
+    else:
+        positions = np.flatnonzero(np.isin(ids, np.asarray(list(homeowner_ids))))
+
+    # Chunks of homes with similar latitudes keep the tree metric close to the exact one
+    positions = positions[np.argsort(lat[positions], kind='stable')]
+
+    # Neighbors are at most max_miles / R radians apart in latitude (dy alone is that far), so
+    # each chunk's tree only needs the homes in that band around the chunk's latitudes
+    by_lat = np.argsort(lat, kind='stable')
+    sorted_lat = lat[by_lat]
+    band_radians = (1 + 1e-9) * max_miles / R_EARTH_MILES
+
+    frames = []
+    if len(ids) > 1:
+        for start in range(0, len(positions), chunk_size):
+            chunk = positions[start: start + chunk_size]
+            first = np.searchsorted(sorted_lat, lat[chunk[0]] - band_radians, side='left')
+            last = np.searchsorted(sorted_lat, lat[chunk[-1]] + band_radians, side='right')
+            band = by_lat[first:last]
+            frames.extend(_neighbors_for_chunk(chunk, band, ids, lat, lng, min_miles, max_miles, max_neighbors))
+
+    if not frames:
+        return pd.DataFrame(columns=NEIGHBOR_COLUMNS)
+
+    # Order like the sql builder would: by home, then distance
+    neighbors = pd.concat(frames, ignore_index=True)
+    neighbors = neighbors.sort_values(['homeowner_id1', 'distance_miles', 'homeowner_id2'], kind='stable')
+    return neighbors.reset_index(drop=True)
+
+
+def homes_near(homeowners, positions, max_miles=MAX_NEIGHBOR_MILES):
+    """
+    Returns the ids of every home in homeowners that has any of the given positions within
+    max_miles of it, using the same distance formula as the neighbor builder.  These are the
+    homes whose neighbor lists can change when a home appears at or disappears from a position.
+
+    Args:
+        homeowners: A frame with columns homeowner_id, lat, lng (in degrees)
+         positions: A frame with columns lat, lng (in degrees)
+         max_miles: The neighbor search radius
+    """
+    if homeowners.empty or positions.empty:
+        return np.array([], dtype=homeowners.homeowner_id.dtype)
+
+    ids = homeowners.homeowner_id.to_numpy()
+    lat, lng = _to_radians(homeowners)
+    lat2, lng2 = _to_radians(positions)
+    tree = cKDTree(np.column_stack([R_EARTH_MILES * lat, R_EARTH_MILES * lng]))
+
+    # A home within max_miles of a position is within max_miles / R radians of it in latitude,
+    # so the smallest cos(lat) it can have bounds how wide the search box must be in longitude
+    max_abs_lat = np.minimum(np.abs(lat2) + max_miles / R_EARTH_MILES, np.pi / 2)
+    radii = (1 + 1e-9) * max_miles / np.maximum(np.cos(max_abs_lat), 1e-9)
+    candidates = tree.query_ball_point(np.column_stack([R_EARTH_MILES * lat2, R_EARTH_MILES * lng2]), r=radii, p=np.inf)
+
+    counts = np.array([len(c) for c in candidates])
+    if counts.sum() == 0:
+        return np.array([], dtype=ids.dtype)
+    pos1 = np.concatenate([np.asarray(c, dtype=int) for c in candidates])
+    pos2 = np.repeat(np.arange(len(positions)), counts)
+
+    # Exact distances are measured from the home's point of view
+    distance = _exact_distances(lat[pos1], lng[pos1], lat2[pos2], lng2[pos2])
+    return np.unique(ids[pos1[distance <= max_miles]])
@@ -0,0 +1,228 @@
+import functools
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from .constants import (
+    SMOOTHING_DAYS,
+    LAG_DAYS,
+    SLOPE_THRESHOLD_RATIO,
+    NEIGHBOR_RADIUS_MILES,
+    NEIGHBOR_COUNT_THRESH,
+    NEIGHBOR_TABLE_NAME,
+)
+
+from .detector_lib import NominalProd
+from .duckdb_tools import (
+    get_duckdb_connection,
+    get_last_date,
+)
+from .neighbor_matrix import NeighborMatrix
+from .utils import ordered_pool_map
+
+# The tunable detector parameters (named like the Detector constructor arguments)
+SWEEP_PARAMETERS = [
+    'smoothing_days',
+    'lag_days',
+    'slope_ratio_threshold',
+    'neighor_radius_miles',
+    'neighbor_count_thresh',
+]
+
+SWEEP_DEFAULTS = {
+    'smoothing_days': SMOOTHING_DAYS,
+    'lag_days': LAG_DAYS,
+    'slope_ratio_threshold': SLOPE_THRESHOLD_RATIO,
+    'neighor_radius_miles': NEIGHBOR_RADIUS_MILES,
+    'neighbor_count_thresh': NEIGHBOR_COUNT_THRESH,
+}
+
+
+def parameter_grid(**values):
+    """
+    Returns a frame with one row for every combination of parameter values.  Parameters
+    that aren't supplied are held at their defaults.
+
+    Example:
+        parameter_grid(lag_days=[7, 14], slope_ratio_threshold=[.5, .6, .7])
+    """
+    unknown = set(values) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown sweep parameters {sorted(unknown)}.  Must be in {SWEEP_PARAMETERS}')
+
+    values = {name: list(np.atleast_1d(values.get(name, SWEEP_DEFAULTS[name]))) for name in SWEEP_PARAMETERS}
+    return pd.DataFrame(list(itertools.product(*values.values())), columns=SWEEP_PARAMETERS)
+
+
+def smoothed_production_for_fleet(raw, smoothing_days):
+    """
+    Gap-filled production and nominal production for every home in a frame of raw
+    production.  This only depends on smoothing_days, so it is shared by every lag_days.
+    """
+    return NominalProd(smoothing_days=smoothing_days).smoothed_production_for_batch(raw)
+
+
+def with_baselines(smoothed, lag_days):
+    """
+    Adds the lagged baseline to fleet-wide smoothed production and drops the days without
+    one, giving the same rows NominalProd.compute_nominal_production would for every home.
+    """
+    df = smoothed.copy()
+    df['baseline_nominal_prod'] = df.groupby('homeowner_id', sort=False).nominal_prod.shift(lag_days)
+    return df.dropna().reset_index(drop=True)
+
+
+def raw_detections_for_fleet(nominal_prod, slope_ratio_threshold, start_date=None):
+    """
+    The raw detections of every home at once.  Matches Detector.raw_detections_from_nominal_prod
+    run home by home (homes are processed in date order with no gaps).
+    """
+    is_below_thresh = (nominal_prod.nominal_prod < slope_ratio_threshold * nominal_prod.baseline_nominal_prod)
+    is_below_thresh = is_below_thresh.astype(int)
+    crossing = is_below_thresh - is_below_thresh.groupby(nominal_prod.homeowner_id, sort=False).shift(1)
+
+    df = nominal_prod[crossing > 0]
+    if start_date is not None:
+        df = df[df.date >= start_date]
+    return df.reset_index(drop=True)
+
+
+def _sweep_smoothing_group(grid, smoothed, neighbor_matrix, start_date):
+    """
+    Evaluates every combination in the grid, which all share one smoothing_days
+    """
+    rows = []
+    for lag_days, lag_grid in grid.groupby('lag_days', sort=False):
+        nominal_prod = with_baselines(smoothed, lag_days)
+
+        for slope_ratio_threshold, ratio_grid in lag_grid.groupby('slope_ratio_threshold', sort=False):
+            raw_detections = raw_detections_for_fleet(nominal_prod, slope_ratio_threshold, start_date)
+            matrix = neighbor_matrix.with_detections(raw_detections)
+
+            for params in ratio_grid.to_dict('records'):
+                counts = matrix.neighbor_counts(params['neighor_radius_miles'])
+                is_kept = counts < params['neighbor_count_thresh']
+                rows.append({
+                    **params,
+                    'num_raw_detections': len(raw_detections),
+                    'num_detections': int(is_kept.sum()),
+                    'num_muted': int((~is_kept).sum()),
+                    'num_homes_detected': raw_detections.homeowner_id[is_kept].nunique(),
+                    'num_days_detected': raw_detections.date[is_kept].nunique(),
+                })
+    return rows
+
+
+def _smoothed_production(raw, smoothing_values, workers, cache=None, watermark=None):
+    """
+    Yields the fleet's smoothed production for each smoothing_days.  With a cache, only the
+    homes missing from it are smoothed.
+    """
+    if cache is None or watermark is None:
+        yield from ordered_pool_map(functools.partial(smoothed_production_for_fleet, raw), smoothing_values, workers)
+        return
+
+    homeowner_ids = raw.homeowner_id.unique()
+    keys, cached_frames, missing_raws = [], [], []
+    for smoothing_days in smoothing_values:
+        key = NominalProd(smoothing_days=smoothing_days, cache=cache).cache_key(raw.date.min(), watermark)
+        cached, missing = cache.get(key, homeowner_ids)
+        keys.append((key, missing))
+        cached_frames.append(cached)
+        missing_raws.append((raw[raw.homeowner_id.isin(missing)], smoothing_days))
+
+    computed = ordered_pool_map(_smooth_missing, missing_raws, workers)
+    for (key, missing), cached, df in zip(keys, cached_frames, computed):
+        if len(missing):
+            cache.put(key, df, missing)
+        frames = [f for f in [cached, df] if f is not None and not f.empty]
+        if frames:
+            yield pd.concat(frames, ignore_index=True).sort_values(['homeowner_id', 'date'], ignore_index=True)
+        else:
+            yield df
+
+
+def _smooth_missing(args):
+    raw, smoothing_days = args
+    return smoothed_production_for_fleet(raw, smoothing_days)
+
+
+def run_sweep(raw, neighbors, grid, start_date=None, workers=1, cache=None, watermark=None):
+    """
+    Evaluates a grid of detector parameters in one pass over a production history.
+
+    Intermediate results are shared between combinations.  Nominal production is computed
+    once per smoothing_days, baselines once per (smoothing_days, lag_days), raw detections
+    once per (smoothing_days, lag_days, slope_ratio_threshold), and the neighbor matrix for
+    each radius once for the whole sweep.
+
+    Args:
+               raw: Raw production with columns homeowner_id, date, total_production
+         neighbors: Neighbors with columns homeowner_id1, homeowner_id2, distance_miles
+              grid: A frame of parameter combinations (see parameter_grid)
+        start_date: Only count detections on or after this date.  Production before it is
+                    still used to warm up the smoother.
+           workers: Nominal production for different smoothing_days is computed in this many
+                    processes, and the combinations sharing a smoothing_days are evaluated in
+                    this many threads.
+             cache: An optional NominalProdCache for the smoothed production of each smoothing_days
+         watermark: The prod_history watermark raw was read at.  The cache is only used if this is set.
+
+    Returns:
+        A frame with one row per combination and columns for the detection counts
+    """
+    grid = grid[SWEEP_PARAMETERS].drop_duplicates().reset_index(drop=True)
+    smoothing_values = list(grid.smoothing_days.unique())
+
+    # The neighbor matrices for every radius are built up front so threads only read them
+    neighbor_matrix = NeighborMatrix(neighbors, raw.iloc[:0][['homeowner_id', 'date']])
+    for radius in grid.neighor_radius_miles.unique():
+        neighbor_matrix.neighbor_matrix(radius)
+
+    # Smoothing is the expensive part, so each smoothing_days gets its own process
+    smoothed_frames = _smoothed_production(raw, smoothing_values, workers, cache, watermark)
+
+    # Detection and muting for each smoothing_days share the in-memory neighbor matrices
+    groups = (
+        (grid[grid.smoothing_days == smoothing_days], smoothed)
+        for smoothing_days, smoothed in zip(smoothing_values, smoothed_frames)
+    )
+    results = ordered_pool_map(
+        lambda group: _sweep_smoothing_group(group[0], group[1], neighbor_matrix, start_date),
+        groups, workers, threads=True)
+
+    summary = pd.DataFrame([row for rows in results for row in rows])
+    return summary.sort_values(SWEEP_PARAMETERS).reset_index(drop=True)
+
+
+def run_sweep_from_local_db(grid, start_date, history_days=None, workers=1, cache=None):
+    """
+    Runs a parameter sweep over the production history and neighbors in the local database.
+
+    Args:
+                grid: A frame of parameter combinations (see parameter_grid)
+          start_date: Only count detections on or after this date
+        history_days: The number of days of production before start_date used to warm up
+                      the smoother.  Defaults to enough for the largest smoothing_days and lag_days.
+             workers: See run_sweep
+               cache: An optional NominalProdCache (see run_sweep)
+    """
+    start_date = pd.Timestamp(start_date)
+    if history_days is None:
+        history_days = int(grid.lag_days.max() + 3 * grid.smoothing_days.max())
+    prod_start_date = start_date - pd.Timedelta(days=history_days)
+
+    conn = get_duckdb_connection()
+    try:
+        raw = conn.execute(
+            'SELECT homeowner_id, date, total_production FROM prod_history WHERE date >= ?',
+            [prod_start_date]
+        ).df()
+        neighbors = conn.execute(
+            f'SELECT homeowner_id1, homeowner_id2, distance_miles FROM {NEIGHBOR_TABLE_NAME}').df()
+        _, watermark = get_last_date(conn, 'prod_history')
+    finally:
+        conn.close()
+
+    return run_sweep(raw, neighbors, grid, start_date, workers, cache, watermark)
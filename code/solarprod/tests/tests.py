@@ -1,6 +1,1170 @@
+import contextlib
+import functools
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+import duckdb
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from solarprod.detector_lib import Detector, NominalProd
+from solarprod import duckdb_tools
+from solarprod.duckdb_tools import BufferedTableWriter, transaction
+from solarprod import (
+    benchmark, data_plumbing, detector_lib, ibis_tools, neighbor_matrix, parquet_store, production_standin, replay,
+)
+from solarprod.spatial import compute_neighbors
+from solarprod.neighbor_matrix import NeighborMatrix
+from solarprod.metrics import CountedConnection, count_rows_read, measured_batches, metrics_run, read_metrics
+from solarprod.nominal_cache import NominalProdCache
+from solarprod.profiling import profiling
+from solarprod.scheduler import Stage, StageGraph
+from solarprod.sweep import parameter_grid, run_sweep
+from solarprod.utils import chunked, logged, ordered_pool_map
 
 
 class SampleTest(TestCase):
     def test_1_equals_1(self):
         self.assertEquals(1, 1)
+
+
+class NominalProdSmootherTest(TestCase):
+    def test_batched_smoother_matches_rolling_apply(self):
+        rng = np.random.default_rng(0)
+        values = rng.gamma(2, 10, 500)
+        values[rng.random(500) < .1] = 0
+        values[100:110] = 5.
+        ser = pd.Series(values, index=pd.date_range('1/1/2022', periods=len(values)))
+
+        batched = NominalProd(vectorized=True)._smooth(ser)
+        rolling = NominalProd(vectorized=False)._smooth(ser)
+        self.assertTrue(np.array_equal(batched.values, rolling.values, equal_nan=True))
+
+
+def make_production(homeowner_ids, num_days=200, seed=0):
+    """
+    Makes a prod_history-like frame with random gaps
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('1/1/2022', periods=num_days)
+    frames = []
+    for homeowner_id in homeowner_ids:
+        df = pd.DataFrame({'date': dates, 'total_production': rng.gamma(2, 10, num_days)})
+        df = df[rng.random(num_days) > .05]
+        df.insert(0, 'homeowner_id', homeowner_id)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+class NominalProdBulkTest(TestCase):
+    def test_bulk_matches_per_home(self):
+        raw = make_production([1, 2, 3])
+        start_date = pd.Timestamp('3/1/2022')
+        nominal = NominalProd()
+
+        def get_for_home(homeowner_id, starting=None):
+            df = raw[(raw.homeowner_id == homeowner_id) & (raw.date >= starting)]
+            return df[['date', 'total_production']].set_index('date')
+
+        def get_for_homes(homeowner_ids, starting=None):
+            return raw[raw.homeowner_id.isin(homeowner_ids) & (raw.date >= starting)]
+
+        prod_start_date = start_date - pd.Timedelta(days=56)
+        with patch.object(nominal, 'get_raw_production_for_home', get_for_home):
+            expected = pd.concat([
+                nominal._records_to_insert(
+                    hid, nominal.get_nominal_production_for_home(hid, prod_start_date), start_date)
+                for hid in [1, 2, 3]
+            ], ignore_index=True)
+
+        with patch.object(nominal, 'get_raw_production_for_homes', get_for_homes):
+            bulk = nominal.get_nominal_production_for_homes([1, 2, 3], prod_start_date, start_date)
+
+        pd.testing.assert_frame_equal(bulk, expected)
+
+
+class OrderedPoolMapTest(TestCase):
+    def test_pool_matches_serial(self):
+        raw = make_production(range(1, 9))
+        nominal = NominalProd()
+        batches = [raw[raw.homeowner_id.isin(chunk)] for chunk in chunked(range(1, 9), 3)]
+
+        def run(workers):
+            func = functools.partial(nominal.nominal_production_for_batch, start_date=pd.Timestamp('3/1/2022'))
+            return pd.concat(list(ordered_pool_map(func, batches, workers)), ignore_index=True)
+
+        pd.testing.assert_frame_equal(run(workers=2), run(workers=1))
+
+
+class DuckDBTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.conn = duckdb.connect(os.path.join(self.tmp_dir.name, 'test.ddb'))
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp_dir.cleanup()
+
+
+class BufferedTableWriterTest(DuckDBTestCase):
+    def test_flushes_on_row_budget(self):
+        df = make_production([1, 2, 3], num_days=10)
+        writer = BufferedTableWriter(self.conn, 'prod_history', max_rows=15)
+        for _, batch in df.groupby('homeowner_id'):
+            writer.append(batch)
+        writer.flush()
+
+        self.assertEqual(writer.num_flushes, 2)
+        self.assertEqual(writer.rows_written, len(df))
+        self.assertEqual(self.conn.execute('select count(*) from prod_history').fetchone()[0], len(df))
+
+    def test_transaction_rolls_back(self):
+        df = make_production([1], num_days=10)
+        self.conn.execute('create table prod_history as select * from df')
+
+        with self.assertRaises(RuntimeError):
+            with transaction(self.conn):
+                writer = BufferedTableWriter(self.conn, 'prod_history', max_rows=1)
+                writer.append(df)
+                raise RuntimeError('boom')
+
+        self.assertEqual(self.conn.execute('select count(*) from prod_history').fetchone()[0], len(df))
+
+
+class ConnectionSessionTest(TestCase):
+    def test_session_reuses_and_disposes_connections(self):
+        opened = []
+
+        def open_connection(name):
+            opened.append(MagicMock())
+            return opened[-1]
+
+        with patch.object(ibis_tools, '_open_connection', open_connection):
+            with ibis_tools.connection_session() as session:
+                for _ in range(3):
+                    with ibis_tools.get_connections('local') as conn:
+                        self.assertIs(conn, opened[0])
+                self.assertEqual(len(opened), 1)
+                opened[0].con.dispose.assert_not_called()
+
+                session.reconnect('local')
+                opened[0].con.dispose.assert_called_once()
+                with ibis_tools.get_connections('local') as conn:
+                    self.assertIs(conn, opened[1])
+
+            opened[1].con.dispose.assert_called_once()
+
+            # Outside of a session every call opens and disposes its own connection
+            with ibis_tools.get_connections('local') as conn:
+                pass
+            self.assertEqual(len(opened), 3)
+            opened[2].con.dispose.assert_called_once()
+
+            # Concurrent stages each get their own connection
+            with ibis_tools.connection_session():
+                with ibis_tools.get_connections('local') as conn:
+                    self.assertIs(conn, opened[3])
+                thread = threading.Thread(target=lambda: ibis_tools.get_connections('local').__enter__())
+                thread.start()
+                thread.join()
+                self.assertEqual(len(opened), 5)
+            opened[4].con.dispose.assert_called_once()
+
+            # A connection that fails to close doesn't hide the error raised inside the session
+            with self.assertRaisesRegex(RuntimeError, 'stage failed'):
+                with ibis_tools.connection_session():
+                    with ibis_tools.get_connections('local'):
+                        opened[-1].con.dispose.side_effect = OSError('already closed')
+                    raise RuntimeError('stage failed')
+
+    def test_session_closes_local_connection(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(ibis_tools, 'LOCAL_DB_FILENAME', os.path.join(tmp_dir, 'test.ddb')):
+            with ibis_tools.connection_session():
+                with ibis_tools.get_connections('local') as conn:
+                    pass
+            with self.assertRaises(duckdb.ConnectionException):
+                conn.con.execute('SELECT 1')
+
+
+class WatermarkTest(DuckDBTestCase):
+    def test_watermark_rebuilt_and_advanced(self):
+        df = make_production([1, 2], num_days=10)
+        self.assertEqual(duckdb_tools.get_last_date(self.conn, 'prod_history'), (False, None))
+
+        self.conn.execute('create table prod_history as select * from df')
+        self.assertEqual(duckdb_tools.get_last_date(self.conn, 'prod_history'), (True, df.date.max()))
+
+        # Once saved, the watermark is read instead of scanning the table
+        self.conn.execute('delete from prod_history')
+        self.assertEqual(duckdb_tools.get_last_date(self.conn, 'prod_history'), (True, df.date.max()))
+
+        # Watermarks never move backwards
+        duckdb_tools.advance_watermark(self.conn, 'prod_history', pd.Timestamp('1/1/2000'))
+        self.assertEqual(duckdb_tools.read_watermark(self.conn, 'prod_history'), (True, df.date.max()))
+
+    def test_stage_writer_advances_watermark(self):
+        df = make_production([1, 2], num_days=10)
+        with patch.object(duckdb_tools, 'get_duckdb_connection', self.conn.cursor):
+            with duckdb_tools.stage_writer('prod_history') as writer:
+                writer.append(df)
+        self.assertEqual(duckdb_tools.read_watermark(self.conn, 'prod_history'), (True, df.date.max()))
+
+
+class IncrementalNominalProdTest(DuckDBTestCase):
+    def setUp(self):
+        super().setUp()
+        raw = make_production([1, 2, 3, 4, 5], seed=1)
+
+        # Home 4 goes dark for a while and home 5 only starts producing late
+        dark = (raw.homeowner_id == 4) & raw.date.between('4/10/2022', '6/20/2022')
+        late = (raw.homeowner_id == 5) & (raw.date < '6/10/2022')
+        self.raw = raw[~dark & ~late].reset_index(drop=True)
+        self.nominal = NominalProd()
+        self.days_prior = self.nominal.lag_days + 3 * self.nominal.smoothing_days
+
+    def full_recompute(self, available, start_date):
+        prod_start_date = start_date - pd.Timedelta(days=self.days_prior)
+        return self.nominal.nominal_production_for_batch(available[available.date >= prod_start_date], start_date)
+
+    def test_incremental_matches_full_recompute(self):
+        nominal = self.nominal
+        last_days = pd.date_range('4/1/2022', '7/15/2022', freq='3D')
+
+        expected, incremental, states = [], [], None
+        start_date = last_days[0]
+        for last_day in last_days:
+            available = self.raw[self.raw.date <= last_day]
+            prod_start_date = start_date - pd.Timedelta(days=self.days_prior)
+            expected.append(self.full_recompute(available, start_date))
+
+            if states is None:
+                recent = available[available.date >= prod_start_date]
+                incremental.append(nominal.nominal_production_for_batch(recent, start_date))
+                states = nominal.smoother_states_for_batch(recent, prod_start_date)
+            else:
+                last_dates = available.homeowner_id.map(states.set_index('homeowner_id').last_date)
+                new_raw = available[available.date > last_dates]
+                records, new_states, fallback_ids = nominal.advance_smoother_states(
+                    states, new_raw, prod_start_date, start_date)
+
+                # New homes and homes that can't be advanced are recomputed from scratch
+                recompute = (
+                    ~available.homeowner_id.isin(states.homeowner_id) | available.homeowner_id.isin(fallback_ids))
+                recent = available[(available.date >= prod_start_date) & recompute]
+                incremental.extend([records, nominal.nominal_production_for_batch(recent, start_date)])
+                fresh = nominal.smoother_states_for_batch(recent, prod_start_date)
+
+                updated = pd.concat([new_states, fresh], ignore_index=True)
+                states = pd.concat(
+                    [states[~states.homeowner_id.isin(updated.homeowner_id)], updated], ignore_index=True)
+
+            start_date = last_day + pd.Timedelta(days=1)
+
+        def combine(frames):
+            df = pd.concat([f for f in frames if not f.empty], ignore_index=True)
+            return df.sort_values(['homeowner_id', 'date']).reset_index(drop=True)
+
+        pd.testing.assert_frame_equal(combine(incremental), combine(expected))
+
+    def test_late_data_and_new_production(self):
+        nominal = self.nominal
+        start_date = pd.Timestamp('5/1/2022')
+        prod_start_date = start_date - pd.Timedelta(days=self.days_prior)
+        available = self.raw[self.raw.date < start_date]
+        self.conn.register('_raw', self.raw)
+        self.conn.execute('CREATE TABLE prod_history AS SELECT * FROM _raw')
+
+        states = nominal.smoother_states_for_batch(available[available.date >= prod_start_date], prod_start_date)
+        nominal._save_smoother_states(self.conn, states)
+        self.assertEqual(nominal._homes_with_late_data(self.conn), set())
+
+        # Rows after each saved window are the new production
+        new_raw = nominal._read_new_production(self.conn)
+        has_state = self.raw.homeowner_id.isin(states.homeowner_id)
+        self.assertEqual(len(new_raw), ((self.raw.date >= start_date) & has_state).sum())
+
+        # Changing a day inside a saved window is late data
+        self.conn.execute(
+            "UPDATE prod_history SET total_production = total_production + 1 "
+            "WHERE homeowner_id = 2 AND date = '2022-04-20'")
+        self.assertEqual(nominal._homes_with_late_data(self.conn), {2})
+
+        # Saved states round trip
+        loaded = nominal._read_smoother_states(self.conn).sort_values('homeowner_id').reset_index(drop=True)
+        for stored, original in zip(loaded.production, states.production):
+            np.testing.assert_array_equal(stored, original)
+
+
+class RawDetectionQueryTest(DuckDBTestCase):
+    def test_matches_per_home_extraction(self):
+        nominal, detector = NominalProd(), Detector(slope_ratio_threshold=.8)
+        start_date = pd.Timestamp('5/1/2022')
+
+        # Nominal production with big enough swings to cross the threshold now and then
+        raw = make_production(range(1, 21), seed=2)
+        nominal_prod = nominal.nominal_production_for_batch(raw, raw.date.min())
+        self.conn.register('_nominal_prod', nominal_prod)
+        self.conn.execute('CREATE TABLE nominal_prod AS SELECT * FROM _nominal_prod')
+
+        expected = pd.concat([
+            detector.raw_detections_from_nominal_prod(homeowner_id, df.reset_index(drop=True), start_date)
+            for homeowner_id, df in nominal_prod.groupby('homeowner_id')
+        ], ignore_index=True)
+        self.assertGreater(len(expected), 0)
+
+        writer = BufferedTableWriter(self.conn, 'raw_detections')
+        writer.insert_query(*detector.raw_detections_query(start_date))
+        result = self.conn.execute('SELECT * FROM raw_detections').df()
+
+        self.assertEqual(writer.rows_written, len(expected))
+        self.assertEqual(writer.max_date, expected.date.max())
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    def test_gap_across_start_date(self):
+        detector = Detector(slope_ratio_threshold=.8)
+        start_date = pd.Timestamp('5/10/2022')
+
+        # Home 1 is above threshold, goes dark across start_date and comes back below it.
+        # Home 2 was already below threshold before its gap, so that isn't a new crossing.
+        dates = pd.date_range('5/1/2022', '5/20/2022')
+        dates = dates[(dates < '5/5/2022') | (dates >= '5/12/2022')]
+        nominal_prod = pd.concat([
+            pd.DataFrame({
+                'homeowner_id': homeowner_id,
+                'date': dates,
+                'total_production': 10.,
+                'nominal_prod': np.where((dates >= '5/12/2022') | (homeowner_id == 2), 5., 10.),
+                'baseline_nominal_prod': 10.,
+            })
+            for homeowner_id in [1, 2]
+        ], ignore_index=True)
+        self.conn.register('_nominal_prod', nominal_prod)
+        self.conn.execute('CREATE TABLE nominal_prod AS SELECT * FROM _nominal_prod')
+
+        result = self.conn.execute(*detector.raw_detections_query(start_date)).df()
+        self.assertEqual(result.homeowner_id.tolist(), [1])
+        self.assertEqual(result.date.tolist(), [pd.Timestamp('5/12/2022')])
+
+        # The per-home extraction seeds its window the same way
+        with patch.object(detector_lib, 'get_duckdb_connection', self.conn.cursor):
+            self.assertEqual(detector._detection_window_start(1, start_date), pd.Timestamp('5/4/2022'))
+            self.assertEqual(detector._detection_window_start(3, start_date), pd.Timestamp('5/9/2022'))
+            per_home = pd.concat(
+                [detector.get_raw_detections_for_home(homeowner_id, start_date) for homeowner_id in [1, 2]],
+                ignore_index=True)
+        pd.testing.assert_frame_equal(per_home, result, check_dtype=False)
+
+
+class CheckpointedRawDetectionTest(DuckDBTestCase):
+    def test_resumes_after_crash(self):
+        nominal, detector = NominalProd(), Detector(slope_ratio_threshold=.8)
+        raw = make_production(range(1, 21), seed=2)
+        nominal_prod = nominal.nominal_production_for_batch(raw, raw.date.min())
+        self.conn.register('_nominal_prod', nominal_prod)
+        self.conn.execute('CREATE TABLE nominal_prod AS SELECT * FROM _nominal_prod')
+        expected = self.conn.execute(*detector.raw_detections_query(nominal_prod.date.min())).df()
+
+        # The third chunk of homes dies partway through its query
+        query = detector.raw_detections_query
+        calls = []
+
+        def crashing_query(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise RuntimeError('crash')
+            return query(*args)
+
+        connections = [
+            patch.object(module, 'get_duckdb_connection', self.conn.cursor)
+            for module in [duckdb_tools, data_plumbing, detector_lib]
+        ]
+        with connections[0], connections[1], connections[2]:
+            with patch.object(detector, 'raw_detections_query', crashing_query):
+                with self.assertRaises(RuntimeError):
+                    detector.compute_raw_detections(chunk_size=5)
+
+            # The first two chunks are committed, but the watermark hasn't moved
+            checkpoint = duckdb_tools.read_checkpoint('raw_detections')
+            self.assertEqual(checkpoint.done_ids, set(range(1, 11)))
+            self.assertEqual(
+                self.conn.execute('SELECT count(DISTINCT homeowner_id) FROM raw_detections').fetchone()[0],
+                expected[expected.homeowner_id <= 10].homeowner_id.nunique())
+            self.assertEqual(duckdb_tools.read_watermark(self.conn, 'raw_detections'), (False, None))
+
+            # The next run finishes the rest with no duplicates or gaps
+            detector.compute_raw_detections(chunk_size=5)
+            self.assertIsNone(duckdb_tools.read_checkpoint('raw_detections'))
+
+        result = self.conn.execute('SELECT * FROM raw_detections ORDER BY homeowner_id, date').df()
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+        self.assertEqual(duckdb_tools.read_watermark(self.conn, 'raw_detections'), (True, expected.date.max()))
+
+
+class CheckpointedNominalProdTest(DuckDBTestCase):
+    def setUp(self):
+        super().setUp()
+        # Homes 21-25 only start producing late, so incremental passes recompute them from scratch
+        raw = make_production(range(1, 26), seed=4)
+        self.raw = raw[(raw.homeowner_id <= 20) | (raw.date >= '5/1/2022')].reset_index(drop=True)
+        self.reference = duckdb.connect(os.path.join(self.tmp_dir.name, 'reference.ddb'))
+
+    def tearDown(self):
+        self.reference.close()
+        super().tearDown()
+
+    def sync(self, conn, through_date):
+        conn.register('_raw', self.raw[self.raw.date <= through_date])
+        conn.execute('CREATE OR REPLACE TABLE prod_history AS SELECT * FROM _raw')
+        duckdb_tools.delete_watermark(conn, 'prod_history')
+
+    def update(self, conn, crash_when=None, **kwargs):
+        """
+        Runs update_nominal_prod against conn.  crash_when is a (method, homeowner_id) pair.  The
+        named NominalProd method raises when it is handed that home.  Everything else, readers
+        included, runs as it does in the pipeline.
+        """
+        db_file = conn.execute(
+            'SELECT path FROM duckdb_databases() WHERE database_name = current_database()').fetchone()[0]
+        patches = [
+            patch.object(module, 'get_duckdb_connection', conn.cursor)
+            for module in [duckdb_tools, data_plumbing, detector_lib]
+        ] + [
+            patch.object(ibis_tools, 'LOCAL_DB_FILENAME', db_file),
+        ]
+        if crash_when is not None:
+            method, crash_id = crash_when
+            original = getattr(NominalProd, method)
+
+            def homes_in(arg):
+                if isinstance(arg, pd.DataFrame):
+                    return set(arg.homeowner_id) if 'homeowner_id' in arg else set()
+                return set(arg) if isinstance(arg, (list, tuple)) else {arg}
+
+            def crashing(nominal, *args, **kwargs):
+                if any(crash_id in homes_in(arg) for arg in args[:2]):
+                    raise RuntimeError('crash')
+                return original(nominal, *args, **kwargs)
+
+            # Bound methods are pickled by name for the pool's processes
+            crashing.__name__ = method
+            patches.append(patch.object(NominalProd, method, crashing))
+
+        with contextlib.ExitStack() as stack:
+            for p in patches:
+                stack.enter_context(p)
+            NominalProd().update_nominal_prod(chunk_size=5, **kwargs)
+
+    def check_resume(self, crash_when, **kwargs):
+        """
+        Crashes a pass partway through, resumes it and compares everything with an uninterrupted pass
+        """
+        self.update(self.reference, **kwargs)
+        with self.assertRaises(RuntimeError):
+            self.update(self.conn, crash_when, **kwargs)
+
+        # Whole chunks before the crash are committed, but the watermark hasn't moved
+        done_ids = duckdb_tools._read_checkpoint(self.conn, 'nominal_prod').done_ids
+        self.assertEqual(done_ids, set(range(1, 11)))
+        self.update(self.conn, **kwargs)
+        self.assertIsNone(duckdb_tools._read_checkpoint(self.conn, 'nominal_prod'))
+
+        query = 'SELECT * FROM nominal_prod ORDER BY homeowner_id, date'
+        result, expected = self.conn.execute(query).df(), self.reference.execute(query).df()
+        self.assertFalse(result.duplicated(['homeowner_id', 'date']).any())
+        pd.testing.assert_frame_equal(result, expected)
+        self.assertEqual(
+            duckdb_tools.read_watermark(self.conn, 'nominal_prod'),
+            duckdb_tools.read_watermark(self.reference, 'nominal_prod'))
+        self.assertEqual(duckdb_tools.read_watermark(self.conn, 'nominal_prod')[1], expected.date.max())
+
+        if kwargs.get('incremental'):
+            # Every home's smoother state matches the nominal production committed with it
+            query = """
+                SELECT * REPLACE (production::VARCHAR AS production, nominal_prod::VARCHAR AS nominal_prod)
+                FROM nominal_prod_state ORDER BY homeowner_id
+            """
+            pd.testing.assert_frame_equal(self.conn.execute(query).df(), self.reference.execute(query).df())
+
+    def test_per_home(self):
+        for conn in [self.conn, self.reference]:
+            self.sync(conn, pd.Timestamp('6/30/2022'))
+        self.check_resume(('get_nominal_production_for_home', 13))
+
+    def test_bulk_workers(self):
+        for conn in [self.conn, self.reference]:
+            self.sync(conn, pd.Timestamp('6/30/2022'))
+        # Smoothing runs in the pool's processes, and the crash there surfaces here
+        self.check_resume(('nominal_production_for_batch', 13), workers=2)
+
+    def test_incremental(self):
+        # The first pass saves smoother states, and the second advances them over the new days
+        for conn in [self.conn, self.reference]:
+            self.sync(conn, pd.Timestamp('6/1/2022'))
+            self.update(conn, incremental=True)
+            self.sync(conn, pd.Timestamp('6/30/2022'))
+        self.check_resume(('_save_smoother_states', 13), incremental=True)
+
+
+class ParquetStoreTest(DuckDBTestCase):
+    def test_appends_commit_with_stage_and_compact(self):
+        store_dir = os.path.join(self.tmp_dir.name, 'parquet')
+        raw = make_production(range(1, 9), num_days=90)
+        nights = [
+            raw[raw.date < '2/15/2022'],
+            raw[(raw.date >= '2/15/2022') & (raw.date < '3/15/2022')],
+            raw[raw.date >= '3/15/2022'],
+        ]
+
+        with patch.object(parquet_store, 'STORAGE_BACKEND', 'parquet'), \
+                patch.object(parquet_store, 'PARQUET_STORE_DIR', store_dir), \
+                patch.object(parquet_store, 'PARQUET_HOMEOWNER_BUCKETS', 4), \
+                patch.object(duckdb_tools, 'get_duckdb_connection', self.conn.cursor), \
+                patch.object(data_plumbing, 'get_duckdb_connection', self.conn.cursor), \
+                patch.object(detector_lib, 'get_duckdb_connection', self.conn.cursor):
+            for night in nights:
+                with duckdb_tools.stage_writer('prod_history', max_rows=200) as writer:
+                    writer.append(night)
+
+            # A crashed stage leaves files behind, but none of its rows are visible
+            with self.assertRaises(RuntimeError):
+                with duckdb_tools.stage_writer('prod_history') as writer:
+                    writer.append(nights[2])
+                    writer.flush()
+                    raise RuntimeError('crash')
+
+            def read_all():
+                return self.conn.execute('SELECT * FROM prod_history ORDER BY homeowner_id, date').df()
+
+            pd.testing.assert_frame_equal(read_all(), raw, check_dtype=False)
+            self.assertEqual(duckdb_tools.read_watermark(self.conn, 'prod_history'), (True, raw.date.max()))
+
+            # Per-home reads only open the files of the home's bucket
+            store = parquet_store.get_parquet_store('prod_history')
+            self.assertTrue(all('/bucket=1/' in path for path in store.files(self.conn, 'prod_history', [5])))
+            df = NominalProd().get_raw_production_for_homes([5], starting='3/1/2022')
+            expected = raw[(raw.homeowner_id == 5) & (raw.date >= '3/1/2022')]
+            pd.testing.assert_frame_equal(
+                df.sort_values('date', ignore_index=True), expected.reset_index(drop=True), check_dtype=False)
+
+            # January and February are closed, so each of their partitions becomes one file
+            data_plumbing.maintain_parquet_store()
+            manifest = store.manifest(self.conn, 'prod_history')
+            closed = manifest[manifest.month < '2022-03']
+            self.assertEqual(len(closed), closed.groupby(['month', 'bucket']).ngroups)
+            self.assertEqual(len(manifest[manifest.month == '2022-03']), 8)
+            pd.testing.assert_frame_equal(read_all(), raw, check_dtype=False)
+
+            # Only the files of the crashed stage are left for vacuum
+            removed = store.vacuum(self.conn, 'prod_history', min_age_seconds=0)
+            self.assertGreater(len(removed), 0)
+            pd.testing.assert_frame_equal(read_all(), raw, check_dtype=False)
+
+
+class ClusterTablesTest(DuckDBTestCase):
+    def test_reorders_once_tail_is_large(self):
+        raw = make_production(range(1, 11), num_days=100).sort_values(['date', 'homeowner_id'], ignore_index=True)
+
+        def append(df):
+            self.conn.register('_rows', df)
+            self.conn.execute('INSERT INTO prod_history SELECT * FROM _rows')
+            self.conn.unregister('_rows')
+
+        def is_clustered():
+            df = self.conn.execute('SELECT homeowner_id, date FROM prod_history').df()
+            return df.equals(df.sort_values(['homeowner_id', 'date'], ignore_index=True))
+
+        self.conn.execute("CREATE TABLE prod_history AS SELECT * FROM raw WHERE date < '2022-03-01'")
+        with patch.object(data_plumbing, 'get_duckdb_connection', self.conn.cursor):
+            self.assertEqual(data_plumbing.cluster_tables(), ['prod_history'])
+            self.assertTrue(is_clustered())
+
+            # A few nights arriving after the table was ordered aren't worth a rewrite
+            append(raw[(raw.date >= '3/1/2022') & (raw.date < '3/5/2022')])
+            self.assertEqual(data_plumbing.cluster_tables(), [])
+            self.assertFalse(is_clustered())
+
+            append(raw[raw.date >= '3/5/2022'])
+            self.assertEqual(data_plumbing.cluster_tables(), ['prod_history'])
+            self.assertTrue(is_clustered())
+
+        self.assertEqual(self.conn.execute('SELECT count(*) FROM prod_history').fetchone()[0], len(raw))
+
+
+class CompactSchemaTest(DuckDBTestCase):
+    def test_writes_and_migrates_compact_types(self):
+        raw = make_production([1, 2, 3], num_days=30)
+
+        def column_types(conn, table_name):
+            return dict(conn.execute(
+                'SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ?', [table_name]
+            ).fetchall())
+
+        writer = BufferedTableWriter(self.conn, 'prod_history')
+        writer.append(raw)
+        writer.flush()
+        compact = {'homeowner_id': 'INTEGER', 'date': 'DATE', 'total_production': 'FLOAT'}
+        self.assertEqual(column_types(self.conn, 'prod_history'), compact)
+
+        # A file from before the compact types is rewritten in place
+        legacy_file = os.path.join(self.tmp_dir.name, 'legacy.ddb')
+        with duckdb.connect(legacy_file) as conn:
+            conn.execute('CREATE TABLE prod_history AS SELECT * FROM raw')
+            duckdb_tools.advance_watermark(conn, 'prod_history', raw.date.max())
+        duckdb_tools.compact_local_db(legacy_file)
+
+        with duckdb.connect(legacy_file) as conn:
+            self.assertEqual(column_types(conn, 'prod_history'), compact)
+            df = conn.execute('SELECT * FROM prod_history').df()
+            np.testing.assert_allclose(df.total_production, raw.total_production, rtol=1e-6)
+
+            # The watermark table keeps its primary key
+            duckdb_tools.advance_watermark(conn, 'prod_history', raw.date.max() + pd.Timedelta(days=1))
+            self.assertEqual(
+                duckdb_tools.read_watermark(conn, 'prod_history'), (True, raw.date.max() + pd.Timedelta(days=1)))
+
+    def test_migrated_state_matches_history(self):
+        raw = make_production([1, 2, 3], num_days=90)
+        nominal = NominalProd()
+        states = nominal.smoother_states_for_batch(raw, raw.date.min())
+        store_dir = os.path.join(self.tmp_dir.name, 'parquet')
+
+        for backend in ['duckdb', 'parquet']:
+            with self.subTest(backend=backend), \
+                    patch.object(parquet_store, 'STORAGE_BACKEND', backend), \
+                    patch.object(parquet_store, 'PARQUET_STORE_DIR', store_dir):
+                legacy_file = os.path.join(self.tmp_dir.name, f'legacy_{backend}.ddb')
+                with duckdb.connect(legacy_file) as conn:
+                    store = parquet_store.get_parquet_store('prod_history')
+                    if store is None:
+                        conn.execute('CREATE TABLE prod_history AS SELECT * FROM raw')
+                    else:
+                        store.append(conn, 'prod_history', pa.Table.from_pandas(raw, preserve_index=False))
+                    nominal._save_smoother_states(conn, states)
+                    self.assertEqual(nominal._homes_with_late_data(conn), set())
+                duckdb_tools.compact_local_db(legacy_file)
+
+                # Neither the saved state nor any legacy parquet file is left at the old precision
+                with duckdb.connect(legacy_file) as conn:
+                    history_type = conn.execute(
+                        'SELECT typeof(total_production) FROM prod_history LIMIT 1').fetchone()[0]
+                    self.assertEqual(history_type, 'FLOAT')
+                    self.assertEqual(nominal._homes_with_late_data(conn), set())
+                    if store is not None:
+                        self.assertEqual(store.vacuum(conn, 'prod_history', min_age_seconds=0), [])
+
+
+def make_homeowners(num_homes=600, seed=0):
+    """
+    Makes a homeowners frame with homes clustered around a few cities
+    """
+    rng = np.random.default_rng(seed)
+    cities = np.array([[39.7, -105.0], [40.0, -105.3], [33.4, -112.0], [47.6, -122.3]])
+    city = rng.integers(0, len(cities), num_homes)
+    return pd.DataFrame({
+        'homeowner_id': np.arange(1, num_homes + 1),
+        'lat': cities[city, 0] + rng.normal(0, .3, num_homes),
+        'lng': cities[city, 1] + rng.normal(0, .3, num_homes),
+    })
+
+
+class ComputeNeighborsTest(DuckDBTestCase):
+    def test_matches_cross_join(self):
+        homeowners = make_homeowners()
+        self.conn.register('_homeowners', homeowners)
+        self.conn.execute('CREATE TABLE homeowners AS SELECT * FROM _homeowners')
+        with patch.object(data_plumbing, 'get_duckdb_connection', self.conn.cursor), \
+                patch.object(data_plumbing, 'MAX_NEIGHBORS', 20):
+            data_plumbing.update_neighbors(spatial_index=False)
+        expected = self.conn.execute(
+            'SELECT * FROM neighbors ORDER BY homeowner_id1, distance_miles, homeowner_id2').df()
+        self.assertEqual(expected.groupby('homeowner_id1').size().max(), 20)
+
+        # Small chunks keep the latitude bands narrow
+        for chunk_size in [100, 2000]:
+            result = compute_neighbors(homeowners, max_neighbors=20, chunk_size=chunk_size)
+            pd.testing.assert_frame_equal(
+                result[['homeowner_id1', 'homeowner_id2']], expected[['homeowner_id1', 'homeowner_id2']],
+                check_dtype=False)
+            np.testing.assert_allclose(result.distance_miles, expected.distance_miles, rtol=1e-12)
+
+
+class IncrementalNeighborsTest(DuckDBTestCase):
+    def sync_and_update(self, production_homeowners):
+        with patch.object(data_plumbing, 'get_duckdb_connection', self.conn.cursor), \
+                patch.object(data_plumbing, 'get_production_homeowners', lambda: production_homeowners):
+            data_plumbing.sync_homeowners()
+            data_plumbing.update_neighbors()
+
+        sort_cols = ['homeowner_id1', 'homeowner_id2']
+        return self.conn.execute('select * from neighbors').df().sort_values(sort_cols).reset_index(drop=True)
+
+    def test_incremental_matches_full_rebuild(self):
+        homeowners = make_homeowners(800)
+        self.sync_and_update(homeowners)
+
+        # Remove a few homes, move a few and add a few
+        rng = np.random.default_rng(1)
+        changed = homeowners[~homeowners.homeowner_id.isin([3, 50, 700])].copy()
+        changed.loc[changed.homeowner_id.isin([10, 400]), 'lat'] += .5
+        changed = pd.concat([changed, make_homeowners(5, seed=2).assign(homeowner_id=np.arange(900, 905))])
+        changed['lng'] += np.where(changed.homeowner_id == 20, rng.normal(), 0)
+
+        result = self.sync_and_update(changed)
+        expected = compute_neighbors(changed).sort_values(['homeowner_id1', 'homeowner_id2']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+        self.assertEqual(self.conn.execute('select count(*) from _homeowner_changes').fetchone()[0], 0)
+
+
+class NeighborCountsTest(DuckDBTestCase):
+    def test_matches_double_left_join(self):
+        rng = np.random.default_rng(3)
+        homeowners = make_homeowners(200)
+        neighbors = compute_neighbors(homeowners, max_neighbors=20)
+        observed = pd.DataFrame({
+            'homeowner_id': rng.choice(homeowners.homeowner_id, 1500),
+            'date': pd.Timestamp('1/1/2022') + pd.to_timedelta(rng.integers(0, 15, 1500), unit='D'),
+        }).drop_duplicates().reset_index(drop=True)
+        self.conn.register('_neighbors', neighbors)
+        self.conn.register('_observed', observed)
+        self.conn.execute('CREATE TABLE neighbors AS SELECT * FROM _neighbors')
+        self.conn.execute('CREATE TABLE observed AS SELECT * FROM _observed')
+
+        # The double left join the counts were originally built with
+        expected = self.conn.execute("""
+            SELECT o.homeowner_id, o.date, sum((o2.homeowner_id IS NOT NULL)::INTEGER) AS num_observed
+            FROM observed o
+            LEFT JOIN (SELECT * FROM neighbors WHERE distance_miles <= 10) n ON o.homeowner_id = n.homeowner_id1
+            LEFT JOIN observed o2 ON n.homeowner_id2 = o2.homeowner_id AND o.date = o2.date
+            GROUP BY o.homeowner_id, o.date
+            ORDER BY o.homeowner_id, o.date
+        """).df()
+        self.assertGreater(expected.num_observed.max(), 1)
+
+        sql, params = Detector().neighbor_counts_query(10, observed_table='observed')
+        result = self.conn.execute(f'SELECT * FROM ({sql}) ORDER BY homeowner_id, date', params).df()
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+        # Limiting to new dates gives the same counts for those dates
+        start_date = pd.Timestamp('1/10/2022')
+        sql, params = Detector().neighbor_counts_query(10, start_date, observed_table='observed')
+        result = self.conn.execute(f'SELECT * FROM ({sql}) ORDER BY homeowner_id, date', params).df()
+        expected = expected[expected.date >= start_date].reset_index(drop=True)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+class NeighborMatrixTest(DuckDBTestCase):
+    def run_engine(self, detector, engine):
+        with contextlib.ExitStack() as stack:
+            for module in [duckdb_tools, data_plumbing, detector_lib, neighbor_matrix]:
+                stack.enter_context(patch.object(module, 'get_duckdb_connection', self.conn.cursor))
+            detector.compute_detections(engine=engine)
+
+    def engine_detections(self, detector, engine, through_date=pd.Timestamp('1/1/2000')):
+        """
+        Runs one engine of compute_detections on top of the detections through through_date
+        and returns (then removes) the detections it added
+        """
+        self.run_engine(detector, engine)
+        df = self.conn.execute(
+            'SELECT * FROM detections WHERE date > ? ORDER BY homeowner_id, date', [through_date]).df()
+        self.conn.execute('DELETE FROM detections WHERE date > ?', [through_date])
+        duckdb_tools.delete_watermark(self.conn, 'detections')
+        return df
+
+    def test_engines_match(self):
+        rng = np.random.default_rng(0)
+        homeowners = make_homeowners(300)
+        neighbors = compute_neighbors(homeowners, max_neighbors=30)
+        raw_detections = pd.DataFrame({
+            'homeowner_id': rng.choice(homeowners.homeowner_id, 2000),
+            'date': pd.Timestamp('1/1/2022') + pd.to_timedelta(rng.integers(0, 20, 2000), unit='D'),
+        }).drop_duplicates().sort_values(['homeowner_id', 'date']).reset_index(drop=True)
+        raw_detections = raw_detections.assign(
+            total_production=rng.random(len(raw_detections)), nominal_prod=rng.random(len(raw_detections)),
+            baseline_nominal_prod=1., lag_days=14, detection_ratio=.6)
+        self.conn.register('_neighbors', neighbors)
+        self.conn.register('_raw_detections', raw_detections)
+        self.conn.execute('CREATE TABLE neighbors AS SELECT * FROM _neighbors')
+
+        # Until there are raw detections there is nothing to mute
+        for engine in ['sql', 'sparse']:
+            self.run_engine(Detector(), engine)
+            self.assertFalse(duckdb_tools.table_exists(self.conn, 'detections'))
+
+        self.conn.execute('CREATE TABLE raw_detections AS SELECT * FROM _raw_detections')
+
+        through_date = pd.Timestamp('1/10/2022')
+        for thresh, radius in [(4, 50), (2, 10), (10, 25)]:
+            detector = Detector(neighor_radius_miles=radius, neighbor_count_thresh=thresh)
+            expected = self.engine_detections(detector, 'sql')
+            self.assertTrue(0 < len(expected) < len(raw_detections))
+            pd.testing.assert_frame_equal(self.engine_detections(detector, 'sparse'), expected, check_dtype=False)
+
+            # Picking up after earlier detections only mutes the new dates, the same way in both engines
+            self.conn.register('_done', expected[expected.date <= through_date])
+            self.conn.execute('INSERT INTO detections SELECT * FROM _done')
+            expected = self.engine_detections(detector, 'sql', through_date)
+            self.assertGreater(expected.date.min(), through_date)
+            result = self.engine_detections(detector, 'sparse', through_date)
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+            self.conn.execute('DELETE FROM detections')
+
+
+class SweepTest(TestCase):
+    def test_matches_one_detector_per_combination(self):
+        homeowners = make_homeowners(60)
+        neighbors = compute_neighbors(homeowners, max_neighbors=30)
+        raw = make_production(homeowners.homeowner_id, seed=3)
+        start_date = pd.Timestamp('4/1/2022')
+        grid = parameter_grid(
+            smoothing_days=[7, 14], lag_days=[7, 14], slope_ratio_threshold=[.7, .8],
+            neighor_radius_miles=[10, 50], neighbor_count_thresh=[1, 4])
+
+        summary = run_sweep(raw, neighbors, grid, start_date, workers=2)
+        self.assertEqual(len(summary), len(grid))
+        self.assertGreater(summary.num_muted.sum(), 0)
+
+        for row in summary.sample(6, random_state=0).to_dict('records'):
+            nominal = NominalProd(smoothing_days=row['smoothing_days'], lag_days=row['lag_days'])
+            detector = Detector(slope_ratio_threshold=row['slope_ratio_threshold'])
+            nominal_prod = nominal.nominal_production_for_batch(raw, raw.date.min())
+            raw_detections = pd.concat([
+                detector.raw_detections_from_nominal_prod(homeowner_id, df.reset_index(drop=True), start_date)
+                for homeowner_id, df in nominal_prod.groupby('homeowner_id')
+            ], ignore_index=True)
+            detections = NeighborMatrix(neighbors, raw_detections).detections(
+                row['neighbor_count_thresh'], row['neighor_radius_miles'])
+
+            self.assertEqual(row['num_raw_detections'], len(raw_detections))
+            self.assertEqual(row['num_detections'], len(detections))
+            self.assertEqual(row['num_homes_detected'], detections.homeowner_id.nunique())
+
+
+class NominalProdCacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = NominalProdCache(self.tmp_dir.name)
+        self.raw = make_production([1, 2, 3], seed=4)
+        self.raw = self.raw[(self.raw.homeowner_id != 3) | (self.raw.date < '1/10/2022')]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached_nominal_production_matches_uncached(self):
+        num_reads = []
+
+        def get_for_homes(homeowner_ids, starting=None):
+            num_reads.append(len(homeowner_ids))
+            return self.raw[self.raw.homeowner_id.isin(homeowner_ids) & (self.raw.date >= starting)]
+
+        starting = pd.Timestamp('1/15/2022')
+        nominal, cached_nominal = NominalProd(), NominalProd(cache=self.cache)
+        with patch.object(cached_nominal, 'get_raw_production_for_homes', get_for_homes), \
+                patch.object(cached_nominal, 'get_prod_history_watermark', return_value=pd.Timestamp('7/1/2022')):
+            for _ in range(2):
+                for homeowner_id in [1, 2, 3]:
+                    expected = nominal.compute_nominal_production(
+                        get_for_homes([homeowner_id], starting)[['date', 'total_production']].set_index('date'))
+                    result = cached_nominal.get_nominal_production_for_home(homeowner_id, starting)
+                    pd.testing.assert_frame_equal(result, expected, check_freq=False, check_index_type=False)
+
+        # Every home (even the one without enough history) was only smoothed once
+        self.assertEqual(len(num_reads), 3 + 6)
+
+    def test_watermarks_and_eviction(self):
+        nominal = NominalProd(cache=self.cache)
+        smoothed = nominal.smoothed_production_for_batch(self.raw)
+
+        old_key = nominal.cache_key(None, '6/1/2022')
+        self.cache.put(old_key, smoothed, [1, 2, 3])
+        cached, missing = self.cache.get(old_key, [1, 2, 3, 4])
+        pd.testing.assert_frame_equal(cached, smoothed, check_dtype=False)
+        self.assertEqual(list(missing), [4])
+
+        # Caching the same settings at a newer watermark drops the old entry
+        new_key = nominal.cache_key(None, '6/2/2022')
+        self.cache.put(new_key, smoothed, [1, 2, 3])
+        self.assertIsNone(self.cache.get(old_key, [1])[0])
+
+        # Entries for other settings are evicted least recently used first
+        other_key = NominalProd(smoothing_days=7, cache=self.cache).cache_key(None, '6/2/2022')
+        self.cache.max_bytes = int(1.5 * self.cache.num_bytes)
+        self.cache.put(other_key, smoothed, [1, 2, 3])
+        self.assertIsNone(self.cache.get(new_key, [1])[0])
+        self.assertIsNotNone(self.cache.get(other_key, [1])[0])
+
+
+class BenchmarkFleetTest(DuckDBTestCase):
+    def test_populate_synthetic_fleet(self):
+        db_file = os.path.join(self.tmp_dir.name, 'benchmark.ddb')
+        info = benchmark.populate_local_db(db_file, num_homes=2000, num_days=120, chunk_size=700)
+
+        with duckdb.connect(db_file) as conn:
+            prod_history = conn.execute('SELECT * FROM prod_history').df()
+            drops = conn.execute(f'SELECT * FROM {benchmark.BENCHMARK_DROPS_TABLE_NAME}').df()
+            num_homes = conn.execute('SELECT count(*) FROM homeowners').fetchone()[0]
+
+        self.assertEqual(num_homes, 2000)
+        self.assertEqual(len(prod_history), info['num_rows'])
+        self.assertEqual(prod_history.date.max(), pd.Timestamp.now().floor('D') - pd.Timedelta(days=1))
+        self.assertGreater(prod_history.total_production.min(), benchmark.MIN_DAILY_PRODUCTION)
+
+        # Some days are missing, and about 2% of homes have an injected drop
+        self.assertLess(len(prod_history), 2000 * 120 * .99)
+        self.assertTrue(10 < len(drops) < 80)
+
+        # Production of dropped homes is lower after the drop
+        df = prod_history.merge(drops, on='homeowner_id', suffixes=('', '_drop'))
+        before = df[df.date < df.date_drop].groupby('homeowner_id').total_production.mean()
+        after = df[df.date >= df.date_drop].groupby('homeowner_id').total_production.mean()
+        before, after = before.align(after, join='inner')
+        self.assertTrue((after < before).all())
+
+    def test_refuses_local_db(self):
+        with self.assertRaises(ValueError):
+            benchmark.populate_local_db(benchmark.DEFAULT_LOCAL_DB_FILENAME, num_homes=10, num_days=60)
+
+        # The stages run against whatever the process is pointed at, which must be the scratch file
+        db_file = os.path.join(self.tmp_dir.name, 'benchmark.ddb')
+        with self.assertRaises(ValueError):
+            benchmark.run_stages(db_file, num_homes=10, num_days=60)
+        self.assertFalse(os.path.exists(db_file))
+
+    def test_runs_every_stage(self):
+        # Nothing is patched: each size runs the real stages in a process pointed at its scratch db
+        df = benchmark.run_benchmarks([40], num_days=60, db_dir=self.tmp_dir.name).set_index('stage')
+        self.assertEqual(
+            list(df.index),
+            ['populate', 'update_neighbors', 'update_nominal_prod', 'compute_raw_detections', 'compute_detections'])
+        self.assertTrue((df.loc['populate':'update_nominal_prod', 'rows_out'] > 0).all())
+        self.assertEqual(df.loc['update_nominal_prod', 'rows_in'], df.loc['populate', 'rows_out'])
+
+
+class ProductionStandinTest(DuckDBTestCase):
+    def test_raw_history_from_standin(self):
+        homeowners = benchmark.make_homeowners(50)
+        dates = pd.date_range('1/1/2024', periods=30)
+        history, _ = benchmark.make_production(homeowners, dates)
+
+        starting, ending = pd.Timestamp('1/10/2024'), pd.Timestamp('1/20/2024')
+        expected = history[(history.date >= starting) & (history.date < ending) & (history.total_production > 20)]
+        expected = expected.sort_values(['homeowner_id', 'date']).reset_index(drop=True)
+
+        for file_name in ['production.ddb', 'production.sqlite']:
+            file_name = os.path.join(self.tmp_dir.name, file_name)
+            production_standin.create_production_standin(file_name, homeowners, history)
+
+            df = production_standin.get_raw_history(file_name, starting, ending, 20)
+            self.assertEqual(list(df.homeowner_id), list(expected.homeowner_id))
+            self.assertEqual(list(df.date), list(expected.date))
+            self.assertTrue(np.allclose(df.total_production, expected.total_production))
+
+        with patch.dict(os.environ, {production_standin.PRODUCTION_DB_ENV_VAR: file_name.replace('.sqlite', '.ddb')}):
+            conn = ibis_tools.get_production_connection()
+            self.assertTrue(set(production_standin.PRODUCTION_SCHEMA) <= set(conn.list_tables()))
+
+    def test_pretend_today(self):
+        with data_plumbing.pretend_today('3/15/2024'):
+            self.assertEqual(pd.Timestamp(data_plumbing.get_yesterday()), pd.Timestamp('3/14/2024'))
+        self.assertEqual(
+            pd.Timestamp(data_plumbing.get_yesterday()), pd.Timestamp.now().floor('D') - pd.Timedelta(days=1))
+
+
+class ReplayTest(TestCase):
+    def test_replays_every_stage(self):
+        # Nothing is patched: the nights run the real stages against scratch databases in their own process
+        with tempfile.TemporaryDirectory() as db_dir:
+            for kwargs in [{}, {'backend': 'sqlite', 'sync_connections': 2}]:
+                with self.subTest(**kwargs):
+                    df = replay.run_replay(60, 2, history_days=60, db_dir=db_dir, **kwargs)
+                    self.assertEqual(len(df), 2 * len(replay.REPLAY_OUTPUT_TABLES))
+                    rows_added = df.pivot(index='night', columns='stage', values='rows_added')
+
+                    # The first night backfills and the second only adds its new day
+                    first, second = rows_added.iloc[0], rows_added.iloc[1]
+                    self.assertEqual(first.sync_homeowners, 60)
+                    self.assertTrue(0 < second.sync_prod_history <= 60)
+                    self.assertGreater(first.update_nominal_prod, 0)
+                    self.assertEqual(second.update_nominal_prod, second.sync_prod_history)
+
+
+class MetricsTest(DuckDBTestCase):
+    def test_stage_and_batch_metrics(self):
+        metrics_file = os.path.join(self.tmp_dir.name, 'metrics.jsonl')
+        conn = CountedConnection(self.conn)
+        df = make_production([1, 2, 3], num_days=10)
+
+        with metrics_run(metrics_file) as run:
+            with logged('write_stage'):
+                writer = BufferedTableWriter(conn, 'prod_history')
+                for batch in measured_batches([df.iloc[:12], df.iloc[12:]], 'write_stage'):
+                    writer.append(count_rows_read(batch))
+                    writer.flush()
+
+            with logged('read_stage'):
+                # Work done in pool threads counts toward the stage that started them
+                def read(_):
+                    return CountedConnection(self.conn.cursor()).execute('SELECT 1').fetchall()
+                list(ordered_pool_map(read, range(4), workers=2, threads=True))
+
+        summary = run.summary().set_index('stage')
+        self.assertEqual(summary.loc['write_stage', 'rows_read'], len(df))
+        self.assertEqual(summary.loc['write_stage', 'rows_written'], len(df))
+        self.assertGreaterEqual(summary.loc['write_stage', 'round_trips'], 2)
+        self.assertEqual(summary.loc['read_stage', 'round_trips'], 4)
+        self.assertTrue((summary.status == 'ok').all())
+        self.assertTrue((summary.peak_rss_mb > 0).all())
+
+        records = read_metrics(metrics_file)
+        self.assertEqual(len(records), 4)
+        batches = records[records.batch.notnull()]
+        self.assertEqual(list(batches.rows_written), [12, len(df) - 12])
+        self.assertEqual(records.run_id.nunique(), 1)
+
+
+class ProfilingTest(TestCase):
+    def test_stage_profiles(self):
+        def busy_stage():
+            total = 0
+            deadline = time.perf_counter() + .1
+            while time.perf_counter() < deadline:
+                total += len([str(i) for i in range(1000)])
+            return total
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with profiling(profile_dir, trace_allocations=True):
+                for _ in range(2):
+                    with logged('busy_stage'):
+                        busy_stage()
+                with logged('batched_stage', batch=0):
+                    busy_stage()
+
+            self.assertEqual(sorted(os.listdir(profile_dir)), [
+                'busy_stage.2.allocations.txt', 'busy_stage.2.collapsed', 'busy_stage.2.pstats',
+                'busy_stage.allocations.txt', 'busy_stage.collapsed', 'busy_stage.pstats',
+            ])
+
+            stats = pstats.Stats(os.path.join(profile_dir, 'busy_stage.pstats'))
+            self.assertTrue(any(func[2] == 'busy_stage' for func in stats.stats))
+
+            with open(os.path.join(profile_dir, 'busy_stage.collapsed')) as buff:
+                lines = buff.read().splitlines()
+            self.assertTrue(any(':busy_stage:' in line for line in lines))
+            self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+            self.assertFalse(any('solarprod-' in line for line in lines))
+
+    def test_concurrent_stages_profiled_apart(self):
+        def spin():
+            deadline = time.perf_counter() + .2
+            while time.perf_counter() < deadline:
+                [str(i) for i in range(1000)]
+
+        def stage_a():
+            spin()
+
+        def stage_b():
+            spin()
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with profiling(profile_dir):
+                StageGraph([Stage('a', stage_a), Stage('b', stage_b)]).run(workers=2)
+
+            # Each stage's samples only come from its own thread
+            for stage, other in [('a', 'b'), ('b', 'a')]:
+                with open(os.path.join(profile_dir, f'{stage}.collapsed')) as buff:
+                    lines = buff.read().splitlines()
+                self.assertTrue(lines)
+                self.assertTrue(all(line.startswith(f'stage-{stage};') for line in lines))
+                self.assertTrue(any(f':stage_{stage}:' in line for line in lines))
+                self.assertFalse(any(f':stage_{other}:' in line for line in lines))
+
+
+class StageGraphTest(TestCase):
+    def make_graph(self, calls, barrier=None, fail=None):
+        def stage(name):
+            def func():
+                if name == fail:
+                    raise RuntimeError(name)
+                if barrier is not None and name in ('a', 'b'):
+                    barrier.wait()
+                calls.append(name)
+            return func
+
+        return StageGraph([
+            Stage('a', stage('a')),
+            Stage('b', stage('b')),
+            Stage('a2', stage('a2'), depends_on=['a']),
+            Stage('c', stage('c'), depends_on=['a2', 'b']),
+            Stage('d', stage('d'), depends_on=['c']),
+        ])
+
+    def test_independent_stages_run_concurrently(self):
+        calls = []
+        # Each of a and b waits for the other, so this only finishes if they overlap
+        graph = self.make_graph(calls, barrier=threading.Barrier(2, timeout=5))
+        finished = graph.run(workers=2)
+
+        self.assertEqual(sorted(finished), sorted(graph.order))
+        self.assertLess(calls.index('a'), calls.index('a2'))
+        self.assertEqual(calls[-2:], ['c', 'd'])
+
+    def test_failures_stop_downstream_stages(self):
+        calls = []
+        graph = self.make_graph(calls, fail='a2')
+        with self.assertRaises(RuntimeError):
+            graph.run(workers=1)
+        self.assertEqual(sorted(calls), ['a', 'b'])
+
+    def test_select(self):
+        graph = self.make_graph([])
+        self.assertEqual(graph.select(), ['a', 'b', 'a2', 'c', 'd'])
+        self.assertEqual(graph.select(start='a2'), ['a2', 'c', 'd'])
+        self.assertEqual(graph.select(skip=['b', 'd']), ['a', 'a2', 'c'])
+        self.assertEqual(graph.select(only=['d', 'a']), ['a', 'd'])
+        self.assertEqual(graph.select(start='a', only=['b', 'c']), ['c'])
+        with self.assertRaises(ValueError):
+            graph.select(only=['e'])
+        with self.assertRaises(ValueError):
+            StageGraph([Stage('x', None, depends_on=['y']), Stage('y', None, depends_on=['x'])])
+
+
+class ConcurrentStagesTest(DuckDBTestCase):
+    def test_stages_share_session_concurrently(self):
+        nominal, detector = NominalProd(), Detector(slope_ratio_threshold=.8)
+        raw = make_production(range(1, 21), seed=2)
+        nominal_prod = nominal.nominal_production_for_batch(raw, raw.date.min())
+        self.conn.register('_nominal_prod', nominal_prod)
+        self.conn.execute('CREATE TABLE nominal_prod AS SELECT * FROM _nominal_prod')
+        expected = self.conn.execute(*detector.raw_detections_query(nominal_prod.date.min())).df()
+        homeowners = make_homeowners(800)
+        self.conn.close()
+
+        # Both stages run on cursors of the session's one database handle, each in its own thread
+        db_file = os.path.join(self.tmp_dir.name, 'test.ddb')
+        graph = StageGraph([
+            Stage('update_neighbors', data_plumbing.update_neighbors),
+            Stage('compute_raw_detections', lambda: detector.compute_raw_detections(chunk_size=5)),
+        ])
+        with patch.object(ibis_tools, 'LOCAL_DB_FILENAME', db_file), \
+                patch.object(data_plumbing, 'get_production_homeowners', lambda: homeowners):
+            with ibis_tools.connection_session():
+                data_plumbing.sync_homeowners()
+                finished = graph.run(workers=2)
+        self.assertEqual(sorted(finished), sorted(graph.order))
+
+        self.conn = duckdb.connect(db_file)
+        result = self.conn.execute('SELECT * FROM raw_detections ORDER BY homeowner_id, date').df()
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+        sort_cols = ['homeowner_id1', 'homeowner_id2']
+        neighbors = self.conn.execute('SELECT * FROM neighbors').df().sort_values(sort_cols).reset_index(drop=True)
+        expected = compute_neighbors(homeowners).sort_values(sort_cols).reset_index(drop=True)
+        pd.testing.assert_frame_equal(neighbors, expected, check_dtype=False)
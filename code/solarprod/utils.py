@@ -1,10 +1,71 @@
+import collections
 import contextlib
+import contextvars
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import easier as ezr
 
+from .metrics import measured
+from .profiling import profiled
+
 
 @contextlib.contextmanager
-def logged(tag):
+def logged(tag, batch=None):
+    """
+    Logs the start and end of a stage and measures it (see metrics.measured).  The
+    measurement is yielded and is logged as json when the stage completes.  Stages
+    (but not batches) are also profiled when profiling is on (see profiling.profiling).
+    """
     logger = ezr.get_logger(tag)
     logger.info(f'{tag}: starting')
-    yield
-    logger.info(f'{tag}: complete')
+    with measured(tag, batch) as measurement, profiled(tag) if batch is None else contextlib.nullcontext():
+        yield measurement
+    logger.info(f'{tag}: complete {json.dumps(measurement.to_record())}')
+
+
+def chunked(items, size):
+    """
+    Yields successive lists of at most size items from an iterable
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_pool_map(func, items, workers=1, threads=False):
+    """
+    Yields func(item) for every item, in the same order as the items.
+
+    If workers is greater than one, calls are made in a pool of that many processes
+    (or threads if threads is True, which is what you want for I/O bound work).
+    Items are pulled lazily from the iterable, so at most a couple of items per worker
+    are ever in flight.  This keeps memory bounded when items are large frames.
+    Threads run in a copy of the caller's context, so their work is measured as part
+    of the caller's stage (see metrics.measured).
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    items = iter(items)
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        def submit(item):
+            if threads:
+                return executor.submit(contextvars.copy_context().run, func, item)
+            return executor.submit(func, item)
+
+        pending = collections.deque()
+        for item in itertools.islice(items, 2 * workers):
+            pending.append(submit(item))
+
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(submit(item))
+            yield result